@@ -0,0 +1,3 @@
+from nanoBragg_multipanel.cli import main
+
+main()
@@ -0,0 +1,166 @@
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import h5py
+import numpy as np
+
+
+def _to_jsonable(value):
+    """convert numpy / flex containers into plain python so they hash the same way every time"""
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, np.ndarray):
+        return _to_jsonable(value.tolist())
+    if isinstance(value, np.generic):
+        return _to_jsonable(value.item())
+    return [_to_jsonable(v) for v in value]
+
+
+def background_cache_key(detector, beam, wavelengths, wavelength_weights, total_flux, Fbg_vs_stol=None,
+                         sample_thick_mm=100, density_gcm3=1, molecular_weight=18, beam_size_mm=0.001):
+    """
+    :param detector: dxtbx detector model (or its dictionary)
+    :param beam: dxtbx beam model (or its dictionary)
+    :param wavelengths: see sim_background
+    :param wavelength_weights: see sim_background
+    :param total_flux: see sim_background
+    :param Fbg_vs_stol: see sim_background (None means the sim_background default)
+    :param sample_thick_mm: see sim_background
+    :param density_gcm3: see sim_background
+    :param molecular_weight: see sim_background
+    :param beam_size_mm: see sim_background
+    :return: hex digest identifying the background these arguments produce
+    """
+    if not isinstance(detector, dict):
+        detector = detector.to_dict()
+    if not isinstance(beam, dict):
+        beam = beam.to_dict()
+    description = {"detector": detector, "beam": beam,
+                   "wavelengths": [float(w) for w in wavelengths],
+                   "wavelength_weights": [float(w) for w in wavelength_weights],
+                   "total_flux": float(total_flux),
+                   "Fbg_vs_stol": None if Fbg_vs_stol is None else [tuple(map(float, x)) for x in Fbg_vs_stol],
+                   "sample_thick_mm": float(sample_thick_mm), "density_gcm3": float(density_gcm3),
+                   "molecular_weight": float(molecular_weight), "beam_size_mm": float(beam_size_mm)}
+    blob = json.dumps(_to_jsonable(description), sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class BackgroundCache:
+
+    def __init__(self, cache_dir, max_bytes=20*1024**3):
+        """
+        On-disk cache of simulated backgrounds, one HDF5 file per key with one dataset per panel.
+        Panels are stored uncompressed and contiguous so they can be memory-mapped when loaded.
+        When the cache grows above max_bytes the least recently used files are removed.
+
+        :param cache_dir: folder where the cache files are stored (created if it doesnt exist)
+        :param max_bytes: size cap of the cache folder in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "background_%s.h5" % key)
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        """
+        :param key: cache key (see background_cache_key)
+        :return: list of read-only numpy memmaps (one per panel), or None if the key is not cached
+        """
+        fname = self.path(key)
+        if not os.path.exists(fname):
+            return None
+        layout = []
+        with h5py.File(fname, "r") as h:
+            for i_pan in range(h.attrs["num_panels"]):
+                dset = h["panel%d" % i_pan]
+                layout.append((dset.id.get_offset(), dset.shape, dset.dtype))
+        os.utime(fname, None)  # mark as recently used
+        panels = []
+        for offset, shape, dtype in layout:
+            panels.append(np.memmap(fname, mode="r", dtype=dtype, offset=offset, shape=shape))
+        return panels
+
+    def store(self, key, panels, description=None):
+        """
+        :param key: cache key (see background_cache_key)
+        :param panels: list of 2D arrays (numpy or flex), one per panel
+        :param description: optional string saved as an attribute, for bookkeeping
+        """
+        fname = self.path(key)
+        tmp_fname = "%s.tmp%d" % (fname, os.getpid())
+        with h5py.File(tmp_fname, "w") as h:
+            h.attrs["num_panels"] = len(panels)
+            if description is not None:
+                h.attrs["description"] = description
+            for i_pan, panel in enumerate(panels):
+                if not isinstance(panel, np.ndarray):
+                    panel = panel.as_numpy_array()
+                h.create_dataset("panel%d" % i_pan, data=np.asarray(panel, dtype=np.float64))
+        os.replace(tmp_fname, fname)
+        self.evict()
+
+    def evict(self):
+        """
+        remove least recently used cache files until the cache is below its size cap
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not (name.startswith("background_") and name.endswith(".h5")):
+                continue
+            fname = os.path.join(self.cache_dir, name)
+            stat = os.stat(fname)
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # always keep the most recent entry, even if it alone exceeds the cap
+        while total > self.max_bytes and len(entries) > 1:
+            _, size, fname = entries.pop(0)
+            os.remove(fname)
+            total -= size
+
+    def get_background(self, detector, beam, wavelengths, wavelength_weights, total_flux, pool=None,
+                       verbose=False, **bg_kwargs):
+        """
+        Load the background from the cache, or simulate (and cache) it if it isnt there
+
+        :param detector: dxtbx detector model
+        :param beam: dxtbx beam model
+        :param wavelengths: see sim_background
+        :param wavelength_weights: see sim_background
+        :param total_flux: see sim_background
+        :param pool: optional SimulationPool used to simulate the panels in parallel on a cache miss
+        :param verbose: print whether the cache was hit
+        :param bg_kwargs: other keyword arguments of sim_background (except pidx)
+        :return: list of numpy arrays (one per panel)
+        """
+        key_kwargs = {k: bg_kwargs[k] for k in ("Fbg_vs_stol", "sample_thick_mm", "density_gcm3",
+                                                 "molecular_weight", "beam_size_mm") if k in bg_kwargs}
+        key = background_cache_key(detector, beam, wavelengths, wavelength_weights, total_flux, **key_kwargs)
+        panels = self.load(key)
+        if panels is not None:
+            if verbose:
+                print("Loaded background %s from cache" % key)
+            return panels
+
+        if verbose:
+            print("Background %s not in cache, simulating it" % key)
+        if pool is not None:
+            panels = list(pool.simulate_background(wavelengths, wavelength_weights, total_flux, **bg_kwargs))
+        else:
+            from nanoBragg_multipanel.utils import sim_background
+            panels = [sim_background(detector, beam, wavelengths, wavelength_weights, total_flux, pidx=pidx,
+                                     **bg_kwargs).as_numpy_array()
+                      for pidx in range(len(detector))]
+        self.store(key, panels)
+        return self.load(key)
@@ -0,0 +1,255 @@
+"""
+Reproducible benchmarks of the simulation, writing and reading paths.
+Results are saved to a JSON file that can be compared with the results of another commit:
+
+  libtbx.python benchmark.py --out bench_new.json
+  libtbx.python benchmark.py --compare bench_old.json bench_new.json
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+import numpy as np
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODELS = ["jungfrau", "eiger", "eigermono"]
+SPECTRA = ["mono", "pink"]
+COMPRESSIONS = {"none": None, "lzf": {"compression": "lzf"}, "gzip": {"compression": "gzip", "compression_opts": 4}}
+
+
+def get_detector_model(name, tmpdir):
+    """
+    :param name: jungfrau, eiger (multi panel) or eigermono (single panel)
+    :param tmpdir: scratch folder
+    :return: dxtbx detector
+    """
+    if name == "jungfrau":
+        from nanoBragg_multipanel.jungfrau16M import get_crystfel_detector
+        return get_crystfel_detector(os.path.join(PACKAGE_DIR, "Jungfrau16M_swissFEL.geom"), detdist_override=250)
+    from nanoBragg_multipanel.eiger16M import get_multi_panel_eiger
+    return get_multi_panel_eiger(as_single_panel=name == "eigermono",
+                                 gaps_file=os.path.join(PACKAGE_DIR, "eiger_gaps.h5"))
+
+
+def get_spectrum(name, wavelength):
+    """
+    :param name: mono or pink (the BioCARS spectrum shipped with the package, every 2nd line)
+    :param wavelength: central wavelength in Angstrom
+    :return: wavelengths, weights
+    """
+    if name == "mono":
+        return [wavelength], [1]
+    wavelengths, weights = np.loadtxt(os.path.join(PACKAGE_DIR, "Xray-spectrum_N.lam")).T
+    wavelengths = wavelengths[::2]
+    weights = weights[::2]
+    wavelengths += wavelength - wavelengths[np.argmax(weights)]
+    return list(wavelengths), list(weights)
+
+
+def get_beam_and_crystal(wavelength=1.3, seed=8675309):
+    from dxtbx.model import Beam, Crystal
+    from scipy.spatial.transform import Rotation
+    beam = Beam((0, 0, 1), wavelength=wavelength)
+    rot = Rotation.random(1, random_state=seed)[0]
+    R = rot.as_matrix() if hasattr(rot, "as_matrix") else rot.as_dcm()
+    crystal = Crystal(np.dot(R, (79, 0, 0)), np.dot(R, (0, 79, 0)), np.dot(R, (0, 0, 38)), "P43212")
+    return beam, crystal
+
+
+def _best_of(func, repeats):
+    """run func repeats times, return the fastest wall time and the last result"""
+    best = None
+    result = None
+    for _ in range(repeats):
+        tstart = time.time()
+        result = func()
+        elapsed = time.time() - tstart
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_sim_spots(detector, beam, crystal, Famp, wavelengths, weights, panel_ids, repeats=1):
+    from nanoBragg_multipanel.utils import sim_spots
+
+    def run():
+        for pidx in panel_ids:
+            sim_spots(crystal, detector, beam, Famp, wavelengths, weights, total_flux=1e12, pidx=pidx,
+                      crystal_size_mm=0.050, beam_size_mm=0.001, mosaic_vol_A3=4000**3, profile="gauss",
+                      time_panels=False, noise_seed=0, calib_seed=0)
+    seconds, _ = _best_of(run, repeats)
+    num_pix = sum(np.prod(detector[pidx].get_image_size()) for pidx in panel_ids)
+    return {"seconds": seconds, "pixels_per_s": num_pix / seconds, "rate": num_pix / seconds}
+
+
+def bench_sim_background(detector, beam, wavelengths, weights, panel_ids, repeats=1):
+    from nanoBragg_multipanel.utils import sim_background
+
+    def run():
+        for pidx in panel_ids:
+            sim_background(detector, beam, wavelengths, weights, total_flux=1e12, pidx=pidx, sample_thick_mm=0.2)
+    seconds, _ = _best_of(run, repeats)
+    num_pix = sum(np.prod(detector[pidx].get_image_size()) for pidx in panel_ids)
+    return {"seconds": seconds, "pixels_per_s": num_pix / seconds, "rate": num_pix / seconds}
+
+
+def bench_writer(filename, detector, beam, num_images, compression_args):
+    from nanoBragg_multipanel.utils import H5AttributeGeomWriter
+    from nanoBragg_multipanel.parallel import get_stack_shape
+    image_shape = get_stack_shape(detector)
+    # poisson background-like data, so compression ratios are realistic
+    image = np.random.default_rng(0).poisson(2, image_shape).astype(np.float64)
+    tstart = time.time()
+    with H5AttributeGeomWriter(filename, image_shape=image_shape, num_images=num_images, detector=detector,
+                               beam=beam, compression_args=compression_args) as writer:
+        for _ in range(num_images):
+            writer.add_image(image)
+    seconds = time.time() - tstart
+    MB = image.nbytes*num_images / 1e6
+    return {"seconds": seconds, "shots_per_s": num_images / seconds, "MB_per_s": MB / seconds,
+            "file_MB": os.path.getsize(filename) / 1e6, "rate": MB / seconds}
+
+
+def load_format_class():
+    """import FormatHDF5AttributeGeometry from this package (it need not be installed in dxtbx)"""
+    import importlib.util
+    path = os.path.join(PACKAGE_DIR, "format", "FormatHDF5AttributeGeometry.py")
+    spec = importlib.util.spec_from_file_location("FormatHDF5AttributeGeometry", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.FormatHDF5AttributeGeometry
+
+
+def bench_reader(filename, format_class):
+    fmt = format_class(filename)
+    try:
+        num_images = fmt.get_num_images()
+        tstart = time.time()
+        nbytes = 0
+        for i in range(num_images):
+            data = fmt.get_raw_data(i)
+            nbytes += sum(p.size() for p in data)*8
+        seconds = time.time() - tstart
+    finally:
+        fmt.close()  # stops the read-ahead thread and releases the file, so it can be removed
+    MB = nbytes / 1e6
+    return {"seconds": seconds, "shots_per_s": num_images / seconds, "MB_per_s": MB / seconds, "rate": MB / seconds}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=PACKAGE_DIR,
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(models=MODELS, spectra=SPECTRA, num_panels=2, num_images=3, repeats=1, resolution=2,
+                   tmpdir=None, verbose=True):
+    """
+    :param models: detector models to benchmark (see MODELS)
+    :param spectra: spectra to simulate with (see SPECTRA)
+    :param num_panels: number of panels timed for the simulation benchmarks (the eigermono has only 1)
+    :param num_images: number of images written and read back per compression setting
+    :param repeats: repeat the simulation benchmarks and keep the fastest
+    :param resolution: resolution of the structure factors (Angstrom)
+    :param tmpdir: scratch folder for the detector and image files
+    :param verbose: print results as they come in
+    :return: dictionary with "meta" and "results" entries
+    """
+    from simtbx.nanoBragg.tst_nanoBragg_basic import fcalc_from_pdb
+    if tmpdir is None:
+        tmpdir = tempfile.mkdtemp()
+    beam, crystal = get_beam_and_crystal()
+    Famp = fcalc_from_pdb(resolution=resolution)
+    format_class = load_format_class()
+
+    results = {}
+
+    def record(name, entry):
+        results[name] = entry
+        if verbose:
+            print(name, " ".join("%s=%.4g" % (k, v) for k, v in sorted(entry.items())))
+
+    for model in models:
+        detector = get_detector_model(model, tmpdir)
+        panel_ids = list(range(min(num_panels, len(detector))))
+        for spec in spectra:
+            wavelengths, weights = get_spectrum(spec, beam.get_wavelength())
+            record("sim_spots/%s/%s" % (model, spec),
+                   bench_sim_spots(detector, beam, crystal, Famp, wavelengths, weights, panel_ids, repeats))
+            record("sim_background/%s/%s" % (model, spec),
+                   bench_sim_background(detector, beam, wavelengths, weights, panel_ids, repeats))
+        for comp_name, comp_args in COMPRESSIONS.items():
+            fname = os.path.join(tmpdir, "%s_%s.h5" % (model, comp_name))
+            record("write/%s/%s" % (model, comp_name), bench_writer(fname, detector, beam, num_images, comp_args))
+            record("read/%s/%s" % (model, comp_name), bench_reader(fname, format_class))
+            os.remove(fname)
+
+    meta = {"commit": _git_commit(), "host": socket.gethostname(), "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "num_panels": num_panels, "num_images": num_images, "repeats": repeats, "resolution": resolution}
+    return {"meta": meta, "results": results}
+
+
+def compare_results(old, new, threshold=0.1, verbose=True):
+    """
+    :param old: benchmark results (dictionary from run_benchmarks, or a JSON filename)
+    :param new: benchmark results (dictionary from run_benchmarks, or a JSON filename)
+    :param threshold: flag benchmarks whose rate dropped by more than this fraction
+    :param verbose: print a table of the rate ratios
+    :return: list of names of the benchmarks that regressed
+    """
+    if not isinstance(old, dict):
+        with open(old) as fin:
+            old = json.load(fin)
+    if not isinstance(new, dict):
+        with open(new) as fin:
+            new = json.load(fin)
+    regressions = []
+    for name in sorted(set(old["results"]) & set(new["results"])):
+        old_rate = old["results"][name]["rate"]
+        if old_rate <= 0:
+            if verbose:
+                print("%-40s %9s  (no old rate to compare to)" % (name, "n/a"))
+            continue
+        ratio = new["results"][name]["rate"] / old_rate
+        flag = ""
+        if ratio < 1 - threshold:
+            regressions.append(name)
+            flag = "  <-- REGRESSION"
+        if verbose:
+            print("%-40s %8.3fx%s" % (name, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Benchmark simulation, writing and reading")
+    parser.add_argument("--out", type=str, default="benchmark.json", help="output JSON file")
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--spectra", nargs="+", choices=SPECTRA, default=SPECTRA)
+    parser.add_argument("--panels", type=int, default=2, help="number of panels timed in the simulation benchmarks")
+    parser.add_argument("--images", type=int, default=3, help="number of images written and read per compression")
+    parser.add_argument("--repeats", type=int, default=1, help="keep the fastest of this many simulation runs")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None,
+                        help="compare two result files instead of running the benchmarks")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slow down reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare is not None:
+        regressions = compare_results(args.compare[0], args.compare[1], threshold=args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    results = run_benchmarks(models=args.models, spectra=args.spectra, num_panels=args.panels,
+                             num_images=args.images, repeats=args.repeats)
+    with open(args.out, "w") as fout:
+        json.dump(results, fout, indent=1, sort_keys=True)
+    print("Wrote %s" % args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Command line interface, driven by a JSON (or YAML) run config:
+
+  libtbx.python -m nanoBragg_multipanel config > run.json     # print the default config, then edit it
+  libtbx.python -m nanoBragg_multipanel simulate run.json
+  libtbx.python -m nanoBragg_multipanel background run.json --out background.h5
+  libtbx.python -m nanoBragg_multipanel benchmark --out bench.json
+  libtbx.python -m nanoBragg_multipanel startup run.json
+
+cctbx, dxtbx and h5py are only imported by the subcommands that need them, so --help is fast.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import copy
+import subprocess
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CONFIG = {
+    "model": "jungfrau",  # jungfrau, eiger or eigermono (single panel eiger)
+    "geom_file": os.path.join(PACKAGE_DIR, "Jungfrau16M_swissFEL.geom"),
+    "gaps_file": os.path.join(PACKAGE_DIR, "eiger_gaps.h5"),
+    "detdist_mm": 250,
+    "wavelength": 1.3,
+    "spectrum": {"type": "mono",  # mono, file or sase
+                 "file": os.path.join(PACKAGE_DIR, "Xray-spectrum_N.lam"), "stride": 2,
+                 "num_channels": None, "tolerance": None,
+                 "bandwidth_eV": 25, "spike_width_eV": 2, "sase_channels": 256},
+    "crystal": {"symbol": "P43212", "a": [79, 0, 0], "b": [0, 79, 0], "c": [0, 0, 38]},
+    "resolution": None,  # Angstrom, defaults to the highest resolution on the detector
+    "prune_fhkl": False,
+    "prepare_fhkl": False,  # expand the structure factors to P1 and convert them once (examples.py --prepFhkl)
+    "total_flux": 1e12,
+    "sim": {"crystal_size_mm": 0.050, "beam_size_mm": 0.001, "mosaic_vol_A3": 4000**3, "profile": "gauss",
+            "readout_noise_adu": 3, "cuda": False},
+    "background": {"enabled": True, "sample_thick_mm": 0.200, "cache_dir": None},
+    "num_images": 2,
+    "random_state": 8675309,
+    "nproc": 1,
+    "output": "images.h5",
+    "queue_size": 2,
+    "writer": {"dtype": "float64", "encoding": None, "compression_args": None},
+    "campaign": None,  # {"dir": "campaign", "shots_per_unit": 10} for a resumable campaign (see scheduler.py)
+}
+
+
+def _merge(base, override):
+    merged = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_config(filename=None):
+    """
+    :param filename: JSON or YAML (.yaml / .yml, needs PyYAML) run config, None for the defaults
+    :return: DEFAULT_CONFIG updated with the entries of the file
+    """
+    if filename is None:
+        return copy.deepcopy(DEFAULT_CONFIG)
+    with open(filename, "r") as fin:
+        if filename.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading YAML configs needs PyYAML: `libtbx.python -m pip install pyyaml`")
+            config = yaml.safe_load(fin)
+        else:
+            config = json.load(fin)
+    config = config or {}  # an empty YAML file
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise KeyError("Unknown config entries %s" % sorted(unknown))
+    return _merge(DEFAULT_CONFIG, config)
+
+
+def build_detector(config):
+    if config["model"] == "jungfrau":
+        from nanoBragg_multipanel.jungfrau16M import get_crystfel_detector
+        return get_crystfel_detector(config["geom_file"], detdist_override=config["detdist_mm"])
+    from nanoBragg_multipanel.eiger16M import get_multi_panel_eiger
+    return get_multi_panel_eiger(detdist_mm=config["detdist_mm"], as_single_panel=config["model"] == "eigermono",
+                                 gaps_file=config["gaps_file"])
+
+
+def build_spectra(config, beam):
+    """
+    :return: wavelengths and weights used for the background (and every shot, unless the spectrum is sase),
+        and the per-shot sase (energies, weights) arrays or None
+    """
+    import numpy as np
+    from nanoBragg_multipanel.spectrum import ENERGY_CONV
+    spec = config["spectrum"]
+    if spec["type"] == "mono":
+        return [beam.get_wavelength()], [1], None
+    if spec["type"] == "sase":
+        from nanoBragg_multipanel.spectrum import sase_spectra, to_wavelengths
+        energies, weights = sase_spectra(config["num_images"], ENERGY_CONV / beam.get_wavelength(),
+                                         bandwidth_eV=spec["bandwidth_eV"], spike_width_eV=spec["spike_width_eV"],
+                                         num_channels=spec["sase_channels"], seed=config["random_state"])
+        wavelengths, mean_weights = to_wavelengths(energies[0], weights.mean(axis=0))
+        return list(wavelengths), list(mean_weights), (energies, weights)
+    if spec["type"] != "file":
+        raise ValueError("Unknown spectrum type %s" % spec["type"])
+    wavelengths, weights = np.loadtxt(spec["file"]).T
+    if spec["num_channels"] is not None or spec["tolerance"] is not None:
+        from nanoBragg_multipanel.spectrum import compress_spectrum
+        wavelengths, weights, _ = compress_spectrum(wavelengths, weights, num_channels=spec["num_channels"],
+                                                    tolerance=spec["tolerance"])
+    else:
+        wavelengths = wavelengths[::spec["stride"]]
+        weights = weights[::spec["stride"]]
+    # shift the spectrum so its peak sits at the beam wavelength
+    wavelengths = wavelengths + beam.get_wavelength() - wavelengths[np.argmax(weights)]
+    return list(wavelengths), list(weights), None
+
+
+def compute_background(config, detector, beam, wavelengths, weights):
+    """
+    :return: numpy array of background pixels (Npanel x Nslow x Nfast), or None if disabled
+    """
+    import numpy as np
+    bg = config["background"]
+    if not bg["enabled"]:
+        return None
+    bg_kwargs = {"sample_thick_mm": bg["sample_thick_mm"]}
+    total_flux = config["total_flux"]
+    pool = None
+    if config["nproc"] > 1:
+        from nanoBragg_multipanel.parallel import SimulationPool
+        pool = SimulationPool(detector, beam, nproc=config["nproc"])
+    try:
+        if bg["cache_dir"] is not None:
+            from nanoBragg_multipanel.background_cache import BackgroundCache
+            panels = BackgroundCache(bg["cache_dir"]).get_background(detector, beam, wavelengths, weights,
+                                                                      total_flux=total_flux, pool=pool,
+                                                                      verbose=True, **bg_kwargs)
+            return np.array(panels)
+        if pool is not None:
+            return pool.simulate_background(wavelengths, weights, total_flux, **bg_kwargs)
+        from nanoBragg_multipanel.utils import sim_background
+        return np.array([sim_background(detector, beam, wavelengths, weights, total_flux, pidx=pidx,
+                                        **bg_kwargs).as_numpy_array() for pidx in range(len(detector))])
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def cmd_simulate(config):
+    import numpy as np
+    from dxtbx.model import Beam, Crystal
+    from simtbx.nanoBragg.tst_nanoBragg_basic import fcalc_from_pdb
+    from nanoBragg_multipanel.noise import DEFAULT_CALIB_SEED
+    from nanoBragg_multipanel.parallel import get_stack_shape, SimulationPool
+    from nanoBragg_multipanel.pipeline import BufferRing, run_pipeline, Shot
+    from nanoBragg_multipanel.scheduler import make_manifest, ShotScheduler, run_worker
+    from nanoBragg_multipanel.utils import sim_spots, H5AttributeGeomWriter
+
+    tstart = time.time()
+    detector = build_detector(config)
+    beam = Beam((0, 0, 1), wavelength=config["wavelength"])
+    wavelengths, weights, sase = build_spectra(config, beam)
+    if sase is not None and config["campaign"] is not None:
+        raise ValueError("sase spectra are only supported when writing a single output file")
+    image_shape = get_stack_shape(detector)
+
+    resolution = config["resolution"]
+    if resolution is None:
+        resolution = min([panel.get_max_resolution_at_corners(beam.get_s0()) for panel in detector])
+    Famp = fcalc_from_pdb(resolution=resolution)
+    if config["prune_fhkl"]:
+        from nanoBragg_multipanel.resolution import prune_structure_factors
+        Famp = prune_structure_factors(Famp, detector, beam, wavelengths)
+    if config["prepare_fhkl"]:
+        from nanoBragg_multipanel.structure_factors import prepare_structure_factors
+        Famp = prepare_structure_factors(Famp)
+    background = compute_background(config, detector, beam, wavelengths, weights)
+
+    is_a_gap = None
+    if config["model"] == "eigermono":
+        import h5py
+        with h5py.File(config["gaps_file"], "r") as h:
+            is_a_gap = h["is_a_gap"][()].astype(bool)
+
+    xtal = config["crystal"]
+    sim_kwargs = dict(config["sim"])
+    sim_kwargs["time_panels"] = False
+    total_flux = config["total_flux"]
+    pool = None
+    if config["nproc"] > 1:
+        pool = SimulationPool(detector, beam, Famp, nproc=config["nproc"], background=background)
+
+    def simulate(shot, out):
+        R = np.reshape(shot["rotation"], (3, 3))
+        crystal = Crystal(np.dot(R, xtal["a"]), np.dot(R, xtal["b"]), np.dot(R, xtal["c"]), xtal["symbol"])
+        shot_wavelengths, shot_weights = wavelengths, weights
+        if sase is not None:
+            from nanoBragg_multipanel.spectrum import to_wavelengths
+            shot_wavelengths, shot_weights = to_wavelengths(sase[0][shot["index"]], sase[1][shot["index"]])
+        if pool is not None:
+            pool.simulate_shot(crystal, shot_wavelengths, shot_weights, total_flux, out=out,
+                               noise_seed=shot["noise_seed"], **sim_kwargs)
+        else:
+            for pidx in range(len(detector)):
+                sim_spots(crystal, detector, beam, Famp[pidx] if isinstance(Famp, list) else Famp,
+                          shot_wavelengths, shot_weights, total_flux, pidx=pidx, noise_seed=shot["noise_seed"],
+                          background_raw_pixels=None if background is None else background[pidx],
+                          out=out[pidx], **sim_kwargs)
+        if is_a_gap is not None:
+            out[:, is_a_gap] = -1
+        return out
+
+    campaign = config["campaign"]
+    shots_per_unit = 10 if campaign is None else campaign.get("shots_per_unit", 10)
+    manifest = make_manifest(config["num_images"], shots_per_unit=shots_per_unit,
+                             random_state=config["random_state"],
+                             calib_seed=sim_kwargs.get("calib_seed", DEFAULT_CALIB_SEED))
+    writer_kwargs = dict(config["writer"])
+    buffers = BufferRing(image_shape, queue_size=config["queue_size"], dtype=writer_kwargs["dtype"])
+    try:
+        if campaign is not None:
+            scheduler = ShotScheduler.create(campaign["dir"], manifest)
+            run_worker(scheduler, lambda shot: simulate(shot, buffers.next()), detector, beam, image_shape,
+                       **writer_kwargs)
+            if scheduler.status()["done"] == scheduler.num_units:
+                scheduler.finalize()
+        else:
+            if sase is not None:
+                writer_kwargs["spectrum_channels"] = sase[0].shape[1]
+
+            def shots():
+                for shot in manifest["shots"]:
+                    image = simulate(shot, buffers.next())
+                    if sase is None:
+                        yield image
+                    else:
+                        yield Shot(image, spectrum=(sase[0][shot["index"]], sase[1][shot["index"]]))
+
+            with H5AttributeGeomWriter(config["output"], image_shape=image_shape, num_images=config["num_images"],
+                                       detector=detector, beam=beam, **writer_kwargs) as writer:
+                run_pipeline(shots(), writer, queue_size=config["queue_size"])
+            print("Wrote %s" % config["output"])
+    finally:
+        if pool is not None:
+            pool.close()
+    print("simulate took %.2f seconds" % (time.time() - tstart))
+
+
+def cmd_background(config, out):
+    from dxtbx.model import Beam
+    from nanoBragg_multipanel.parallel import get_stack_shape
+    from nanoBragg_multipanel.utils import H5AttributeGeomWriter
+    detector = build_detector(config)
+    beam = Beam((0, 0, 1), wavelength=config["wavelength"])
+    wavelengths, weights, _ = build_spectra(config, beam)
+    config["background"]["enabled"] = True
+    background = compute_background(config, detector, beam, wavelengths, weights)
+    if out is not None:
+        # a single image file, e.g. for dials.image_viewer
+        with H5AttributeGeomWriter(out, image_shape=get_stack_shape(detector), num_images=1, detector=detector,
+                                   beam=beam) as writer:
+            writer.add_image(background)
+        print("Wrote %s" % out)
+
+
+def measure_startup(config, repeats=3, nproc=2, mp_context="spawn"):
+    """
+    :param config: run config, its detector is handed to the pool
+    :param repeats: keep the fastest of this many measurements
+    :param nproc: number of pool workers to start
+    :param mp_context: multiprocessing start method of the pool
+    :return: seconds for `python -m nanoBragg_multipanel --help`, and for creating a SimulationPool with the
+        detector and beam of the config until every worker has run a first task
+        (the workers import dxtbx and build the models later, with their first panel)
+    """
+    from dxtbx.model import Beam
+    from nanoBragg_multipanel.parallel import SimulationPool
+    package_name = os.path.basename(PACKAGE_DIR)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(PACKAGE_DIR)] + [p for p in sys.path if p])
+    help_times = []
+    for _ in range(repeats):
+        tstart = time.time()
+        subprocess.check_call([sys.executable, "-m", package_name, "--help"], env=env,
+                              stdout=subprocess.DEVNULL)
+        help_times.append(time.time() - tstart)
+    detector = build_detector(config)
+    beam = Beam((0, 0, 1), wavelength=config["wavelength"])
+    pool_times = []
+    for _ in range(repeats):
+        tstart = time.time()
+        with SimulationPool(detector, beam, nproc=nproc, mp_context=mp_context) as pool:
+            pool.wait_ready()
+            pool_times.append(time.time() - tstart)
+    results = {"help_seconds": min(help_times), "pool_ready_seconds": min(pool_times)}
+    print("--help: %.3f seconds, SimulationPool with %d %s workers ready for tasks: %.3f seconds"
+          % (results["help_seconds"], nproc, mp_context, results["pool_ready_seconds"]))
+    return results
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog="nanoBragg_multipanel", description="Simulate multi panel detector images")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("config", help="print the default run config (JSON)")
+    sim_parser = sub.add_parser("simulate", help="simulate images as described by a run config")
+    sim_parser.add_argument("config", help="JSON or YAML run config (missing entries take their default)")
+    bg_parser = sub.add_parser("background", help="simulate (and cache) the background of a run config")
+    bg_parser.add_argument("config", help="JSON or YAML run config")
+    bg_parser.add_argument("--out", type=str, default=None, help="also write the background as an image file")
+    sub.add_parser("benchmark", add_help=False, help="run benchmark.py (pass its arguments after the subcommand)")
+    startup_parser = sub.add_parser("startup", help="measure the startup time of --help and of a SimulationPool")
+    startup_parser.add_argument("config", nargs="?", default=None, help="run config with the detector to use")
+    startup_parser.add_argument("--nproc", type=int, default=2)
+    startup_parser.add_argument("--repeats", type=int, default=3)
+    startup_parser.add_argument("--context", type=str, default="spawn", choices=["fork", "spawn", "forkserver"])
+
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "benchmark":
+        from nanoBragg_multipanel.benchmark import main as benchmark_main
+        return benchmark_main(argv[1:])
+    args = parser.parse_args(argv)
+    if args.command == "config":
+        print(json.dumps(DEFAULT_CONFIG, indent=1))
+    elif args.command == "simulate":
+        cmd_simulate(load_config(args.config))
+    elif args.command == "background":
+        cmd_background(load_config(args.config), args.out)
+    elif args.command == "startup":
+        measure_startup(load_config(args.config), repeats=args.repeats, nproc=args.nproc, mp_context=args.context)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,54 @@
-from dxtbx.model import Detector, Panel
+from dxtbx.model import Detector, DetectorFactory, Panel
+import os
+import json
+import hashlib
 import h5py
 import numpy as np
-from scipy.ndimage import label
+from scipy.ndimage import label, find_objects
+
+# eiger 16M panels are 529420 pixels, smaller connected regions are bad regions and not panels
+EIGER_PANEL_PIXELS = (200000, 530000)
+
+# gaps file (path, modification time) -> (mask digest, mask shape), and detector dictionaries by cache key
+_MASK_DIGESTS = {}
+_DETECTOR_CACHE = {}
+
+
+def panelize_gapped_detector(dxtbx_model, is_a_gap, min_panel_pixels=0, max_panel_pixels=None):
+  """
+  Split a monolithic detector whose image contains gaps into one panel per connected region.
+  Regions are labeled once and their bounding boxes extracted in a single pass
+
+  :param dxtbx_model: dxtbx geometry of the monolithic detector (single node model)
+  :param is_a_gap: a 2D numpy array the same shape as the detector image, True means the pixel is a gap
+  :param min_panel_pixels: connected regions with this many pixels or fewer are not panels
+  :param max_panel_pixels: connected regions with this many pixels or more are not panels (None for no limit)
+  :return: dxtbx multi panel model, panels are ordered by the position of their first pixel (row major)
+  """
+  multi_det = Detector()
+  # we will make a new detector where each panel has its own origin, but all share the same fast,slow scan directions
+  detector_origin = np.array(dxtbx_model[0].get_origin())
+  F = np.array(dxtbx_model[0].get_fast_axis())
+  S = np.array(dxtbx_model[0].get_slow_axis())
+  pixsize = dxtbx_model[0].get_pixel_size()[0]
+  panel_dict = dxtbx_model[0].to_dict()
+
+  labs, nlabs = label(np.logical_not(is_a_gap))
+  npixels = np.bincount(labs.ravel(), minlength=nlabs+1)
+  for i, bbox in enumerate(find_objects(labs), 1):
+    if bbox is None or npixels[i] <= min_panel_pixels:
+      continue
+    if max_panel_pixels is not None and npixels[i] >= max_panel_pixels:
+      continue
+    slc_slow, slc_fast = bbox
+    jmin, imin = slc_slow.start, slc_fast.start  # location of first pixel in the region
+    jmax, imax = slc_slow.stop-1, slc_fast.stop-1
+    panel_dict["origin"] = tuple(detector_origin + F*imin*pixsize + S*jmin*pixsize)
+    # NOTE: image size is the extent between the first and last pixel, as in the original eiger panelization
+    panel_dict["image_size"] = (int(imax-imin), int(jmax-jmin))
+    multi_det.add_panel(Panel.from_dict(panel_dict))
+
+  return multi_det
 
 
 def panelize_eiger(eiger_dxtbx_model, is_a_gap):
@@ -13,48 +60,54 @@ def panelize_eiger(eiger_dxtbx_model, is_a_gap):
     is_a_gap = np.array(eiger_image)==-1
   :return: dxtbx multi panel model for eiger 16M
   """
-  multiEiger = Detector()
-  # we will make a new detector where wach panel has its own origin, but all share the same fast,slow scan directions
-  detector_origin = np.array(eiger_dxtbx_model[0].get_origin())
-  F = np.array(eiger_dxtbx_model[0].get_fast_axis())
-  S = np.array(eiger_dxtbx_model[0].get_slow_axis())
-  pixsize = eiger_dxtbx_model[0].get_pixel_size()[0]
-  panel_dict = eiger_dxtbx_model[0].to_dict()
-
-  is_a_panel = np.logical_not(is_a_gap)
-  labs, nlabs = label(is_a_panel)
-
-  for i in range(nlabs+1):
-    region = labs == i
-    npixels = np.sum(region)
-    # there might be some other connected regions that are not panels (bad regions for example)
-    if 200000 < npixels < 530000:  # panel size is 529420 pixels, I think
-      ypos, xpos = np.where(region)
-      jmin, imin = min(ypos), min(xpos)  # location of first pixel in the region
-      jmax, imax = max(ypos), max(xpos)
-      panel_shape = (int(imax-imin), int(jmax-jmin))
-      panel_origin = detector_origin + F*imin*pixsize + S*jmin*pixsize
-      panel_dict["origin"] = tuple(panel_origin)
-      panel_dict["image_size"] = panel_shape
-      panel = Panel.from_dict(panel_dict)
-      multiEiger.add_panel(panel)
-
-  return multiEiger
-
-
-def get_multi_panel_eiger(detdist_mm=200, pixsize_mm=0.075, as_single_panel=False):
+  min_pixels, max_pixels = EIGER_PANEL_PIXELS
+  return panelize_gapped_detector(eiger_dxtbx_model, is_a_gap, min_pixels, max_pixels)
+
+
+def _load_gaps(gaps_file):
+  """
+  :return: the is_a_gap mask (None if its digest is already known), its sha1 digest and its shape
+  """
+  key = os.path.abspath(gaps_file), os.path.getmtime(gaps_file)
+  if key in _MASK_DIGESTS:
+    digest, shape = _MASK_DIGESTS[key]
+    return None, digest, shape
+  with h5py.File(gaps_file, "r") as h:
+    is_a_gap = h["is_a_gap"][()].astype(bool)
+  digest = hashlib.sha1(np.packbits(is_a_gap).tobytes() + str(is_a_gap.shape).encode()).hexdigest()
+  _MASK_DIGESTS[key] = digest, is_a_gap.shape
+  return is_a_gap, digest, is_a_gap.shape
+
+
+def get_multi_panel_eiger(detdist_mm=200, pixsize_mm=0.075, as_single_panel=False, gaps_file="eiger_gaps.h5",
+                          cache_dir=None):
     """
+    The detector is cached (in memory, and in cache_dir if given) keyed by the gap mask and the geometry
+    arguments, so the mask is loaded and panelized only once
 
     :param detdist_mm: sample to detector in mm
     :param pixsize_mm: pix in mm
     :param as_single_panel: whether to return as just a large single panel camera
+    :param gaps_file: hdf5 file with the is_a_gap mask
+    :param cache_dir: optional folder where the panelized detectors are saved as JSON, re-used across runs
     :return: dxtbx detector
     """
     # load a file specifying the gap positions
     # this is a 2D array
     # usually -1 is a gap, so you can create this array by doing
     # is_a_gap = np.array(eiger_image)==-1  (pseudo)
-    is_a_gap = h5py.File("eiger_gaps.h5", "r")["is_a_gap"][()]
+    is_a_gap, digest, mask_shape = _load_gaps(gaps_file)
+    cache_key = "eiger_%s_%r_%r_%s" % (digest, float(detdist_mm), float(pixsize_mm),
+                                        "single" if as_single_panel else "multi")
+    cache_file = None if cache_dir is None else os.path.join(cache_dir, cache_key + ".json")
+    if cache_key not in _DETECTOR_CACHE and cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file, "r") as fin:
+            _DETECTOR_CACHE[cache_key] = json.load(fin)
+    if cache_key in _DETECTOR_CACHE:
+        return DetectorFactory.from_dict(_DETECTOR_CACHE[cache_key])
+    if is_a_gap is None:
+        with h5py.File(gaps_file, "r") as h:
+            is_a_gap = h["is_a_gap"][()].astype(bool)
 
     # to view:
     #import pylab as plt
@@ -62,7 +115,7 @@ def get_multi_panel_eiger(detdist_mm=200, pixsize_mm=0.075, as_single_panel=Fals
     #plt.show()
     # its not perfect, some small regions are also flagged, we shall filter them though
 
-    ydim,xdim = is_a_gap.shape
+    ydim,xdim = mask_shape
 
     center_x = xdim/2. * pixsize_mm
     center_y = ydim/2. * pixsize_mm
@@ -88,7 +141,17 @@ def get_multi_panel_eiger(detdist_mm=200, pixsize_mm=0.075, as_single_panel=Fals
     master_det.add_panel(master_panel)
 
     if as_single_panel:
-        return master_det
+        det = master_det
     else:
-        return panelize_eiger(master_det, is_a_gap)
+        det = panelize_eiger(master_det, is_a_gap)
+
+    _DETECTOR_CACHE[cache_key] = det.to_dict()
+    if cache_file is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = cache_file + ".tmp%d" % os.getpid()
+        with open(tmp_file, "w") as fout:
+            json.dump(_DETECTOR_CACHE[cache_key], fout)
+        os.replace(tmp_file, cache_file)
+    return det
 
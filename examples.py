@@ -6,18 +6,33 @@ parser.add_argument("--cuda", action="store_true", help="try to simulate with cu
 parser.add_argument("--model", choices=["jungfrau", "eiger", "eigermono"], type=str, default="jungfrau", help="sepcifies a detector model; eigermono is a single panel eiger")
 parser.add_argument("--pinkbeam", action="store_true", help="whether to simulate a pink beam")
 parser.add_argument("--pinkstride", type=int, choices=[1,2,3], default=2, help="stride for reading spectrum (value of 3 will then simulate every 3rd wavelength in the spectrum)")
+parser.add_argument("--pinkchannels", type=int, default=None, help="re-bin the full spectrum into this many energy channels, conserving flux and mean energy (overrides --pinkstride)")
+parser.add_argument("--pinktol", type=float, default=None, help="re-bin the full spectrum into as few channels as possible with an intensity error below this value, e.g. 0.01 (overrides --pinkstride)")
+parser.add_argument("--bgcache", type=str, default=None, help="folder for caching the simulated background across runs")
+parser.add_argument("--prepFhkl", action="store_true", help="expand the structure factors to P1 and convert them once, instead of on every panel of every shot (and share them with the --nproc workers)")
+parser.add_argument("--pruneFhkl", action="store_true", help="give each panel only the structure factors within its resolution range")
+parser.add_argument("--trace", type=str, default=None, help="record the time spent in each simulation phase and save a chrome trace (JSON) to this file")
+parser.add_argument("--nproc", type=int, default=1, help="number of processes for simulating panels in parallel")
+parser.add_argument("--encoding", choices=["uint16", "int32", "jungfrau"], default=None, help="store images as detector-like integers (saturating at the trusted range), 4-8x smaller than float64")
+parser.add_argument("--sparse", type=float, default=None, help="only store pixels above this value (peak-only file, the other pixels read back as the expected background)")
+parser.add_argument("--sparseMask", action="store_true", help="in the peak-only file also keep every pixel near a predicted Bragg spot (roi.predicted_spot_mask), can be used without --sparse")
+parser.add_argument("--sase", action="store_true", help="simulate every shot with its own random SASE (XFEL) spectrum, stored in the output file")
+parser.add_argument("--nimg", type=int, default=2, help="number of shots to simulate")
+parser.add_argument("--campaign", type=str, default=None, help="folder of a resumable simulation campaign: shots are split into work units that any number of processes (on any number of hosts) running this same command pick up, and a restart skips finished units")
+parser.add_argument("--shotsPerUnit", type=int, default=10, help="shots per work unit (and output file) of a --campaign")
+parser.add_argument("--dtype", choices=["float64", "float32", "int32"], default="float64", help="datatype of the saved images, float32 halves memory and file size (int32 rounds the noisy pixels)")
 args = parser.parse_args()
+SPARSE = args.sparse is not None or args.sparseMask
+if args.sase and (SPARSE or args.campaign is not None):
+  parser.error("--sase is only supported when writing a single dense file")
+if SPARSE and args.campaign is not None:
+  parser.error("--sparse and --sparseMask are not supported with --campaign")
 
 import numpy as np
 from scipy.spatial.transform.rotation import Rotation
-try:
-  from cfelpyutils.crystfel_utils import load_crystfel_geometry
-except ImportError:
-  print("You must first install cfelpyutils using `libtbx.python -m pip install cfelpyutils --user`")
-  exit()
 from dxtbx.model import Beam, Crystal
-from nanoBragg_multipanel.jungfrau16M import convert_crystfel_to_dxtbx, load_detector_from_expt
 from nanoBragg_multipanel.utils import sim_spots, sim_background, H5AttributeGeomWriter
+from nanoBragg_multipanel.pipeline import run_pipeline, BufferRing, Shot
 
 imgfile_out = "%s_images.h5" % args.model
 
@@ -28,11 +43,12 @@ if args.model.startswith('eiger'):
   else:
     detector= get_multi_panel_eiger()
 else:  # elif args.model == "jungfrau":
+  # needs cfelpyutils, see jungfrau16M._load_crystfel_geometry
+  from nanoBragg_multipanel.jungfrau16M import get_crystfel_detector
   input_file = "Jungfrau16M_swissFEL.geom"
   output_file = input_file.replace(".geom", ".expt")  # this file will store dxtbx detector
-  convert_crystfel_to_dxtbx(input_file, output_file, detdist_override=250)  # override the detector distance (mm)
-  # get the detector
-  detector = load_detector_from_expt(output_file)
+  # get the detector, override the detector distance (mm)
+  detector = get_crystfel_detector(input_file, detdist_override=250, output_filename=output_file)
 
 # get the beam
 wavelength = 1.3
@@ -58,26 +74,69 @@ weights = [1]
 if args.pinkbeam:
   # read in a spectrum measured from Biocars at Argonne
   wavelengths, weights = np.loadtxt("Xray-spectrum_N.lam").T
-  wavelengths = wavelengths[::args.pinkstride]
-  weights = weights[::args.pinkstride]
+  if args.pinkchannels is not None or args.pinktol is not None:
+    from nanoBragg_multipanel.spectrum import compress_spectrum
+    Nlines = len(wavelengths)
+    wavelengths, weights, spec_err = compress_spectrum(wavelengths, weights, num_channels=args.pinkchannels,
+                                                       tolerance=args.pinktol)
+    print("Reduced spectrum from %d lines to %d channels, intensity error=%.4f" % (Nlines, len(wavelengths), spec_err))
+  else:
+    wavelengths = wavelengths[::args.pinkstride]
+    weights = weights[::args.pinkstride]
   # shift wavelengths to desired beam wavelength set above
   peak_pink_wave = wavelengths[np.argmax(weights)]
   shift = beam.get_wavelength() - peak_pink_wave
   wavelengths += shift
   imgfile_out = "pink_" + imgfile_out
 
+if args.pruneFhkl:
+  from nanoBragg_multipanel.resolution import prune_structure_factors
+  Famp = prune_structure_factors(Famp, detector, beam, wavelengths)
+
+if args.prepFhkl:
+  # expand to P1 and convert the structure factors once, instead of on every panel of every shot
+  from nanoBragg_multipanel.structure_factors import prepare_structure_factors
+  Famp = prepare_structure_factors(Famp, verbose=not args.pruneFhkl)
+
 fast_dim, slow_dim = detector[0].get_image_size()
 img_sh = (len(detector), slow_dim, fast_dim)  # note for hdf5 we must abide by numpy convention for array shape
-Nimg = 2
+Nimg = args.nimg
+
+if args.sase:
+  # one random spectrum per shot, all generated at once
+  from nanoBragg_multipanel.spectrum import sase_spectra, to_wavelengths, ENERGY_CONV
+  sase_energies, sase_weights = sase_spectra(Nimg, ENERGY_CONV / beam.get_wavelength(), seed=8675309)
 
 # Note: for efficiency, if simulating many crystal shots, we only compute background once
-# consider generating background once and subsequently loading from disk, replacing this section fo code with a section that loads background from disk
+# use --bgcache to compute it once and subsequently load it from disk
 background_on_panels = []
-for pidx in range(len(detector)):
-  print("\rDoing background panel %d" % (pidx), end="")
-  water = sim_background(DETECTOR=detector, BEAM=beam, pidx=pidx, sample_thick_mm=0.200,
-                         wavelengths=wavelengths, wavelength_weights=weights, total_flux=1e12)
-  background_on_panels.append(water)
+bg_pool = None
+if args.nproc > 1:
+  from nanoBragg_multipanel.parallel import SimulationPool
+  bg_pool = SimulationPool(detector, beam, nproc=args.nproc)
+
+if args.bgcache is not None:
+  from nanoBragg_multipanel.background_cache import BackgroundCache
+  background_on_panels = BackgroundCache(args.bgcache).get_background(
+    detector, beam, wavelengths, weights, total_flux=1e12, pool=bg_pool, verbose=True, sample_thick_mm=0.200)
+  background_stack = np.array(background_on_panels)
+elif bg_pool is not None:
+  background_stack = bg_pool.simulate_background(sample_thick_mm=0.200, wavelengths=wavelengths,
+                                                 wavelength_weights=weights, total_flux=1e12)
+else:
+  for pidx in range(len(detector)):
+    print("\rDoing background panel %d" % (pidx), end="")
+    water = sim_background(DETECTOR=detector, BEAM=beam, pidx=pidx, sample_thick_mm=0.200,
+                           wavelengths=wavelengths, wavelength_weights=weights, total_flux=1e12)
+    background_on_panels.append(water)
+
+if bg_pool is not None:
+  bg_pool.close()
+
+if SPARSE:
+  from nanoBragg_multipanel.utils import SparseShotWriter
+  if background_on_panels:
+    background_stack = np.array([bg.as_numpy_array() if hasattr(bg, "as_numpy_array") else bg for bg in background_on_panels])
 
 if args.model=='eigermono':
   # NOTE if doing a monolithic eiger you might want to put the gaps as untrusted values
@@ -85,11 +144,50 @@ if args.model=='eigermono':
   is_a_gap = h5py.File("eiger_gaps.h5", "r")["is_a_gap"][()]  # use this mask
 
 rotations = Rotation.random(Nimg, random_state=8675309)
-with H5AttributeGeomWriter(imgfile_out, image_shape=img_sh, num_images=Nimg, detector=detector, beam=beam,
-                           dtype=np.float64, compression_args=None) as writer:
+timer = None
+if args.trace is not None:
+  from nanoBragg_multipanel.profiling import PhaseTimer
+  timer = PhaseTimer()
+pool = None
+if args.nproc > 1:
+  # workers stay alive across shots, detector/beam/Famp/background are shipped to them only once
+  pool = SimulationPool(detector, beam, Famp, nproc=args.nproc, background=background_stack)
 
-  for i_img in range(Nimg):
-    output_panels = []
+# simulate the spots, consider changing this function and/or its arguments to meet your needs
+if args.model.startswith("eiger"):
+  readout_adu = 0
+else:
+  readout_adu = 3
+ADC_OFFSET = 10  # added to every pixel with the noise
+
+
+# images are simulated into a few preallocated buffers instead of allocating a new one every shot
+QUEUE_SIZE = 2
+buffers = BufferRing(img_sh, queue_size=QUEUE_SIZE, dtype=args.dtype)
+
+
+def get_crystal(R):
+  """dxtbx crystal model for the crystal rotation matrix R"""
+  A = np.dot(R,real_a)
+  B = np.dot(R,real_b)
+  C = np.dot(R,real_c)
+  return Crystal(A,B,C, lookup_symbol)  # instantiate dxtbx crystal model (these are usually stored in expt files output by DIALS after indexing)
+
+
+def simulate_image(R, output_panels, noise_seed=None, shot_wavelengths=None, shot_weights=None):
+  """simulates one multi panel image for the crystal rotation matrix R, into the buffer output_panels"""
+  if shot_wavelengths is None:
+    shot_wavelengths, shot_weights = wavelengths, weights
+  crystal = get_crystal(R)
+
+  if pool is not None:
+    pool.simulate_shot(crystal, shot_wavelengths, shot_weights, total_flux=1e12, crystal_size_mm=0.050,
+                       beam_size_mm=0.001, cuda=args.cuda, mosaic_vol_A3=4000**3,
+                       profile="gauss", readout_noise_adu=readout_adu, adc_offset=ADC_OFFSET, timer=timer,
+                       noise_seed=noise_seed, out=output_panels)
+    if args.model == "eigermono":
+      output_panels[:, is_a_gap] = -1
+  else:
     for pidx in range(len(detector)):
       # only show params for first panel, otherwise too much output
       if pidx == 0:
@@ -97,28 +195,67 @@ with H5AttributeGeomWriter(imgfile_out, image_shape=img_sh, num_images=Nimg, det
       else:
         show_params = False
 
-      # rotate the crystal randomly
-      R = rotations[i_img].as_dcm()
-      A = np.dot(R,real_a)
-      B = np.dot(R,real_b)
-      C = np.dot(R,real_c)
-      crystal = Crystal(A,B,C, lookup_symbol)  # instantiate dxtbx crystal model (these are usually stored in expt files output by DIALS after indexing)
-
-      # simulate the spots, consider changing this function and/or its arguments to meet your needs
-      if args.model.startswith("eiger"):
-        readout_adu = 0
-      else:
-        readout_adu = 3
-
-      panel_pixels = sim_spots(crystal, detector, beam, Famp, wavelengths, weights, pidx=pidx, crystal_size_mm=0.050,
+      panel_Famp = Famp[pidx] if args.pruneFhkl else Famp
+      panel_pixels = sim_spots(crystal, detector, beam, panel_Famp, shot_wavelengths, shot_weights, pidx=pidx, crystal_size_mm=0.050,
                          beam_size_mm=0.001, total_flux=1e12, time_panels=True, show_params=show_params, cuda=args.cuda,
                          mosaic_vol_A3=4000**3, profile="gauss", background_raw_pixels=background_on_panels[pidx],
-                        readout_noise_adu=readout_adu)
+                        readout_noise_adu=readout_adu, adc_offset=ADC_OFFSET, timer=timer, noise_seed=noise_seed,
+                        out=output_panels[pidx])
       if args.model == "eigermono":
         panel_pixels[is_a_gap] = -1
 
-      output_panels.append(panel_pixels)
+  if timer is not None:
+    timer.next_shot()
+  return output_panels
+
+
+def simulate_shots():
+  """yields one simulated multi panel image per crystal orientation"""
+  for i_img in range(Nimg):
+    # rotate the crystal randomly
+    R = rotations[i_img].as_dcm()
+    if args.sase:
+      # the flex_Beam of each spectrum is built once and shared by all panels (see utils.get_xray_beams)
+      shot_wavelengths, shot_weights = to_wavelengths(sase_energies[i_img], sase_weights[i_img])
+      image = simulate_image(R, buffers.next(), shot_wavelengths=shot_wavelengths, shot_weights=shot_weights)
+      yield Shot(image, spectrum=(sase_energies[i_img], sase_weights[i_img]))
+    elif args.sparseMask:
+      from nanoBragg_multipanel.roi import predicted_spot_mask
+      mask = predicted_spot_mask(get_crystal(R), detector, beam, wavelengths, weights,
+                                 Famp=None if args.pruneFhkl else Famp)
+      yield Shot(simulate_image(R, buffers.next()), mask=mask)
+    else:
+      yield simulate_image(R, buffers.next())
+
+
+if args.campaign is not None:
+  # resumable campaign: run this same command in as many processes / on as many hosts as you like
+  from nanoBragg_multipanel.scheduler import make_manifest, ShotScheduler, run_worker
+  manifest = make_manifest(Nimg, shots_per_unit=args.shotsPerUnit, random_state=8675309)
+  scheduler = ShotScheduler.create(args.campaign, manifest)
+  run_worker(scheduler, lambda shot: simulate_image(np.reshape(shot["rotation"], (3, 3)), buffers.next(),
+                                                    noise_seed=shot["noise_seed"]),
+             detector, beam, img_sh, dtype=args.dtype, encoding=args.encoding)
+  if scheduler.status()["done"] == scheduler.num_units:
+    scheduler.finalize()
+else:
+  if SPARSE:
+    # pixels that are not kept are read back as the background, plus the ADC offset added with the noise
+    writer = SparseShotWriter(imgfile_out.replace(".h5", "_sparse.h5"), image_shape=img_sh, detector=detector,
+                              beam=beam, threshold=args.sparse, background=background_stack + ADC_OFFSET)
+  else:
+    writer = H5AttributeGeomWriter(imgfile_out, image_shape=img_sh, num_images=Nimg, detector=detector, beam=beam,
+                                   dtype=args.dtype, compression_args=None, encoding=args.encoding,
+                                   spectrum_channels=sase_energies.shape[1] if args.sase else None)
+  # images are saved to hdf5 by a background thread while the next shot is simulated
+  with writer:
+    run_pipeline(simulate_shots(), writer, queue_size=QUEUE_SIZE)
+
+if pool is not None:
+  pool.close()
+elif args.prepFhkl and not args.pruneFhkl:
+  Famp.report()
 
-    # save the image to hdf5
-    output_panels = np.array(output_panels)
-    writer.add_image(output_panels)
+if timer is not None:
+  timer.report()
+  timer.to_chrome_trace(args.trace)
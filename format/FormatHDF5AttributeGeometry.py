@@ -1,10 +1,14 @@
 from __future__ import absolute_import, division
 
+import os
+import hashlib
+import threading
 import numpy as np
 import h5py
 import json
 from copy import deepcopy
 import ast
+from collections import OrderedDict
 
 from dxtbx.format.FormatHDF5 import FormatHDF5
 from dials.array_family import flex
@@ -12,36 +16,211 @@ from dxtbx.format.FormatStill import FormatStill
 from dxtbx.model import Beam
 
 
+# process-wide cache of the parsed geometry attribute strings, keyed by their hash.
+# files written by the same run (e.g. shards) carry identical strings, so they are parsed once
+_GEOMETRY_CACHE = OrderedDict()
+_GEOMETRY_CACHE_SIZE = 16
+
+
+def _parse_model_string(model_str):
+    try:
+        return json.loads(model_str)
+    except ValueError:
+        return ast.literal_eval(model_str)  # older files
+
+
+# Jungfrau encoded frames (see H5AttributeGeomWriter): 2 gain bits (G0=0b00, G1=0b01, G2=0b11) above 14 ADC bits.
+# Kept here as this format class must not depend on the nanoBragg_multipanel package
+_JUNGFRAU_STAGE_OF_BITS = np.array([0, 1, 2, 2])
+_JUNGFRAU_ADC_MASK = 2**14 - 1
+
+
+def _read_frame_float64(dset, index, out=None, gain_divisors=None, untrusted=None):
+    """
+    read one frame as float64 with a single HDF5 read, HDF5 converts the stored dtype during the read
+    (which decodes the uint16 and int32 encodings). Jungfrau encoded frames are decoded with gain_divisors,
+    and pixels stored as the untrusted value are set to the lower trusted value of their panel
+    (untrusted is the tuple returned by _untrusted_decoding)
+    """
+    if out is None:
+        out = np.empty(dset.shape[1:], np.float64)
+    if gain_divisors is None and untrusted is None:
+        dset.read_direct(out, source_sel=np.s_[index])
+        return out
+    raw = dset[index]
+    if gain_divisors is None:
+        out[...] = raw
+    else:
+        stage = _JUNGFRAU_STAGE_OF_BITS[raw >> 14]
+        np.multiply(raw & _JUNGFRAU_ADC_MASK, gain_divisors[stage], out=out)
+    if untrusted is not None:
+        untrusted_value, lower = untrusted
+        np.copyto(out, np.broadcast_to(lower, out.shape), where=raw == untrusted_value)
+    return out
+
+
+def _untrusted_decoding(dset, detector):
+    """
+    :return: (stored value of untrusted pixels, lower trusted value of each panel) if the encoding of dset
+        reserves such a value (see H5AttributeGeomWriter), else None
+    """
+    if "untrusted_value" not in dset.attrs:
+        return None
+    lower = np.array([panel.get_trusted_range()[0] for panel in detector], dtype=np.float64)
+    return int(dset.attrs["untrusted_value"]), lower[:, None, None]
+
+
+def _jungfrau_gain_divisors(dset):
+    """
+    :return: pixel value per ADC count in each gain stage if dset holds jungfrau encoded frames, else None
+    """
+    encoding = dset.attrs.get("encoding")
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    if encoding != "jungfrau":
+        return None
+    return np.array(json.loads(dset.attrs["gain_divisors"]), dtype=np.float64)
+
+
+class _SparseFrames:
+    """
+    Presents the pixel lists written by SparseShotWriter (group sparse_images) like the dense images dataset:
+    frames are rebuilt on demand from the background (read once and kept) and the stored pixels
+    """
+    def __init__(self, group):
+        self.group = group
+        self.attrs = group.attrs
+        num_images = int(group.attrs.get("num_images_written", group["shot_start"].shape[0]))
+        self.shape = (num_images,) + tuple(int(n) for n in group.attrs["image_shape"])
+        self._background = None
+
+    @property
+    def background(self):
+        if self._background is None:
+            if "background" in self.group:
+                self._background = self.group["background"][()].astype(np.float64)
+            else:
+                self._background = np.zeros(self.shape[1:], np.float64)
+        return self._background
+
+    def read_direct(self, out, source_sel):
+        index = int(source_sel)
+        start = int(self.group["shot_start"][index])
+        sl = slice(start, start + int(self.group["shot_count"][index]))
+        out[...] = self.background
+        out[self.group["panel"][sl], self.group["slow"][sl], self.group["fast"][sl]] = self.group["value"][sl]
+
+    def __getitem__(self, index):
+        out = np.empty(self.shape[1:], np.float64)
+        self.read_direct(out, index)
+        return out
+
+
+class _FramePrefetcher(threading.Thread):
+    """
+    Background thread reading the frames following the one last requested, so the next
+    get_raw_data calls find them already decoded in memory
+    """
+    def __init__(self, dset, num_frames, memory_budget_bytes, gain_divisors=None, untrusted=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dset = dset
+        self.gain_divisors = gain_divisors
+        self.untrusted = untrusted
+        frame_bytes = max(int(np.prod(dset.shape[1:]))*8, 1)
+        self.num_frames = max(1, min(int(num_frames), int(memory_budget_bytes // frame_bytes)))
+        self.frames = {}
+        self.hits = 0
+        self.misses = 0
+        self._next = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+        self.start()
+
+    def _wanted(self):
+        stop = min(self._next + self.num_frames, self.dset.shape[0])
+        return [i for i in range(self._next, stop) if i not in self.frames]
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not self._wanted():
+                    self._cond.wait()
+                if self._shutdown:
+                    return
+                index = self._wanted()[0]
+            frame = _read_frame_float64(self.dset, index, gain_divisors=self.gain_divisors, untrusted=self.untrusted)
+            with self._cond:
+                # only keep it if it is still inside the read-ahead window
+                if self._next <= index < self._next + self.num_frames:
+                    self.frames[index] = frame
+
+    def pop(self, index):
+        """
+        :return: the prefetched frame (or None), and move the read-ahead window past index
+        """
+        with self._cond:
+            frame = self.frames.pop(index, None)
+            if frame is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._next = index + 1
+            for i in list(self.frames):
+                if not self._next <= i < self._next + self.num_frames:
+                    del self.frames[i]
+            self._cond.notify()
+        return frame
+
+    def stop(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify()
+
+
 class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
     """
     Class for reading HDF5 files for arbitrary geometries
     focused on performance
     """
+    # number of recently decoded frames kept in memory (for viewers re-requesting the same image)
+    RAW_DATA_CACHE_SIZE = 2
+    # number of frames to read ahead on a background thread (0 disables), and the memory they may use
+    PREFETCH_FRAMES = int(os.environ.get("NANOBRAGG_MULTIPANEL_PREFETCH", 0))
+    PREFETCH_MEMORY_MB = float(os.environ.get("NANOBRAGG_MULTIPANEL_PREFETCH_MB", 1024))
+
     @staticmethod
     def understand(image_file):
         try:
-            img_handle = h5py.File(image_file, "r")
-            keys = img_handle.keys()
-        except (IOError, AttributeError) as err:
+            with h5py.File(image_file, "r") as img_handle:
+                if "images" in img_handle:
+                    attrs = img_handle["images"].attrs
+                elif "sparse_images" in img_handle:
+                    attrs = img_handle["sparse_images"].attrs
+                else:
+                    return False
+                if "dxtbx_detector_string" not in attrs:
+                    return False
+                if "dxtbx_beam_string" not in attrs:
+                    return False
+                #if "gain" in img_handle:
+                #    return False
+                return True
+        except (IOError, OSError, AttributeError, KeyError) as err:
             return False
-        if "images" not in keys:
-            return False
-        images = img_handle["images"]
-        if "dxtbx_detector_string" not in images.attrs:
-            return False
-        if "dxtbx_beam_string" not in images.attrs:
-            return False
-        #if "gain" in keys:
-        #    return False
-        return True
 
     def _start(self):
         self._handle = h5py.File(self._image_file, "r")
         self.HAS_SPECTRUM_BEAM = False
         if hasattr(Beam, "set_spectrum"):
             self.HAS_SPECTRUM_BEAM = True
-        self._image_dset = self._handle["images"]
+        if "images" in self._handle:
+            self._image_dset = self._handle["images"]
+        else:
+            self._image_dset = _SparseFrames(self._handle["sparse_images"])  # pixel lists, see SparseShotWriter
+        self._gain_divisors = _jungfrau_gain_divisors(self._image_dset)
         self._geometry_define()
+        self._untrusted = _untrusted_decoding(self._image_dset, self._cctbx_detector)
         self._has_spectra = False
         self._has_central_wavelengths = False 
         self._energies = None
@@ -49,6 +228,35 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
         self._central_wavelengths = None
         self._check_per_shot_spectra()
         self._ENERGY_CONV = 12398.419739640716
+        self._read_buffer = None
+        self._spare_buffer = None  # frame evicted from the raw data cache, re-used by the next read
+        self._raw_data_cache = OrderedDict()
+        self._prefetcher = None  # started by the first get_raw_data, see _read_frame
+
+    @property
+    def prefetch_stats(self):
+        """
+        :return: (hits, misses) of the read-ahead thread, a high hit fraction means reading is not the bottleneck
+        """
+        if self._prefetcher is None:
+            return 0, 0
+        return self._prefetcher.hits, self._prefetcher.misses
+
+    def close(self):
+        """
+        stop the read-ahead thread (if any) and close the file
+        """
+        if getattr(self, "_prefetcher", None) is not None:
+            self._prefetcher.stop()
+            self._prefetcher.join()
+            self._prefetcher = None
+        if getattr(self, "_handle", None) is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __del__(self):
+        if getattr(self, "_prefetcher", None) is not None:
+            self._prefetcher.stop()
 
     def _geometry_define(self):
         det_str = self._image_dset.attrs["dxtbx_detector_string"]
@@ -58,8 +266,15 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
             beam_str = beam_str.decode()
         except AttributeError:
             pass
-        det_dict = ast.literal_eval(det_str)
-        beam_dict = ast.literal_eval(beam_str)
+        key = hashlib.sha1(det_str.encode() + b"\0" + beam_str.encode()).hexdigest()
+        if key in _GEOMETRY_CACHE:
+            _GEOMETRY_CACHE.move_to_end(key)
+        else:
+            _GEOMETRY_CACHE[key] = _parse_model_string(det_str), _parse_model_string(beam_str)
+            while len(_GEOMETRY_CACHE) > _GEOMETRY_CACHE_SIZE:
+                _GEOMETRY_CACHE.popitem(last=False)
+        # each file gets its own models (shared by its images), so changing them does not affect other files
+        det_dict, beam_dict = _GEOMETRY_CACHE[key]
         self._cctbx_detector = self._detector_factory.from_dict(det_dict)
         self._cctbx_beam = self._beam_factory.from_dict(beam_dict)
 
@@ -79,13 +294,40 @@ class FormatHDF5AttributeGeometry(FormatHDF5, FormatStill):
     def get_num_images(self):
         return self._image_dset.shape[0]
 
+    def _read_frame(self, index):
+        if self._prefetcher is None and self.PREFETCH_FRAMES > 0:
+            # only files whose images are read start reading ahead
+            self._prefetcher = _FramePrefetcher(self._image_dset, self.PREFETCH_FRAMES,
+                                                self.PREFETCH_MEMORY_MB*1e6, self._gain_divisors, self._untrusted)
+        if self._prefetcher is not None:
+            frame = self._prefetcher.pop(index)
+            if frame is not None:
+                return frame
+        if self.RAW_DATA_CACHE_SIZE > 0 or self._prefetcher is not None:
+            # owned by the cache, read into the buffer of the frame last evicted from it (if any)
+            out, self._spare_buffer = self._spare_buffer, None
+            return _read_frame_float64(self._image_dset, index, out=out, gain_divisors=self._gain_divisors,
+                                       untrusted=self._untrusted)
+        if self._read_buffer is None:
+            self._read_buffer = np.empty(self._image_dset.shape[1:], np.float64)
+        return _read_frame_float64(self._image_dset, index, out=self._read_buffer, gain_divisors=self._gain_divisors,
+                                   untrusted=self._untrusted)
+
+    def _get_frame(self, index):
+        if index in self._raw_data_cache:
+            self._raw_data_cache.move_to_end(index)
+            return self._raw_data_cache[index]
+        frame = self._read_frame(index)
+        if self.RAW_DATA_CACHE_SIZE > 0:
+            self._raw_data_cache[index] = frame
+            while len(self._raw_data_cache) > self.RAW_DATA_CACHE_SIZE:
+                self._spare_buffer = self._raw_data_cache.popitem(last=False)[1]
+        return frame
+
     def get_raw_data(self, index=0):
-        self.panels = self._image_dset[index]
-        if self.panels.dtype == np.float64:
-            flex_data = [flex.double(p) for p in self._image_dset[index]]
-        else:
-            flex_data = [flex.double(p.astype(np.float64)) for p in self._image_dset[index]]
-        return tuple(flex_data)
+        self.panels = self._get_frame(index)
+        # one copy per panel, the flex arrays own their memory so the cached frame stays untouched
+        return tuple([flex.double(p) for p in self.panels])
 
     def get_detectorbase(self, index=None):
         raise NotImplementedError
@@ -1,25 +1,29 @@
 from __future__ import print_function
 
-try:
-  from cfelpyutils.crystfel_utils import load_crystfel_geometry
-except ImportError:
-  print("You must first install cfelpyutils using `libtbx.python -m pip install cfelpyutils --user`")
-  exit()
+import os
+import json
+import hashlib
 
-from dxtbx.model import Panel, Detector
+from dxtbx.model import Panel, Detector, DetectorFactory
 from dxtbx.model import ExperimentList, Experiment
 
+# detector dictionaries by cache key, see get_crystfel_detector
+_DETECTOR_CACHE = {}
 
-def convert_crystfel_to_dxtbx(geom_filename, output_filename, detdist_override=None):
-  """
-  :param geom_filename: a crystfel geometry file https://www.desy.de/~twhite/crystfel/manual-crystfel_geometry.html
-  :param output_filename: filename for a dxtbx experiment containing a single detector model (this is a json file)
-  :param detdist_override: alter the detector distance stored in the crystfel geometry to this value (in millimeters)
-  """
-  geom = load_crystfel_geometry(geom_filename)
 
-  dxtbx_det = Detector()
+def _load_crystfel_geometry(geom_filename):
+  try:
+    from cfelpyutils.crystfel_utils import load_crystfel_geometry
+  except ImportError:
+    raise ImportError("You must first install cfelpyutils using `libtbx.python -m pip install cfelpyutils --user`")
+  return load_crystfel_geometry(geom_filename)
 
+
+def _panel_descriptions(geom, detdist_override=None):
+  """
+  :return: list of (panel_name, dxtbx panel dictionary), in the order of the geometry file
+  """
+  descriptions = []
   for panel_name in geom['panels'].keys():
     P = geom['panels'][panel_name]
     FAST = P['fsx'], P['fsy'], P['fsz']
@@ -55,14 +59,137 @@ def convert_crystfel_to_dxtbx(geom_filename, output_filename, detdist_override=N
       'thickness': 0,  # note for a thick detector set this to appropriate value
       'trusted_range': (-1.0, 1e6),  # set as you wish
       'type': 'SENSOR_PAD'}
-    dxtbx_node = Panel.from_dict(panel_description)
-    dxtbx_det.add_panel(dxtbx_node)
-
-  E =Experiment()
-  E.detector = dxtbx_det
-  El = ExperimentList()
-  El.append(E)
-  El.as_file(output_filename)  # this can be loaded into nanoBragg
+    descriptions.append((panel_name, panel_description))
+  return descriptions
+
+
+def _rigid_groups(geom, panel_names, collection=None):
+  """
+  :return: dictionary of {panel_name: group_name} for the rigid groups of a collection, empty if the
+    groups of the collection do not cover every panel exactly once
+  """
+  groups = geom.get('rigid_groups', {})
+  collections = geom.get('rigid_group_collections', {})
+  if collection is None:
+    if not collections:
+      return {}
+    collection = sorted(collections.keys())[0]
+  if collection not in collections:
+    raise KeyError("No rigid group collection %s in the geometry, options are %s" % (collection, sorted(collections)))
+  group_of = {}
+  for group_name in collections[collection]:
+    for panel_name in groups[group_name]:
+      if panel_name in group_of:
+        return {}
+      group_of[panel_name] = group_name
+  if set(group_of) != set(panel_names):
+    return {}
+  return group_of
+
+
+def _build_hierarchy(descriptions, group_of):
+  """
+  detector root (at the detector distance) -> rigid groups -> panels.
+  Panels are added in the order of descriptions, so panel indices match the flat detector
+  """
+  det = Detector()
+  root = det.hierarchy()
+  detdist_mm = -descriptions[0][1]['origin'][2]
+  root.set_frame((1, 0, 0), (0, 1, 0), (0, 0, -detdist_mm))
+  root.set_name("root")
+  group_nodes = {}
+  for panel_name, panel_description in descriptions:
+    parent = root
+    group_name = group_of.get(panel_name)
+    if group_name is not None:
+      if group_name not in group_nodes:
+        group_nodes[group_name] = root.add_group()
+        group_nodes[group_name].set_frame((1, 0, 0), (0, 1, 0), (0, 0, -detdist_mm))
+        group_nodes[group_name].set_name(group_name)
+      parent = group_nodes[group_name]
+    node = parent.add_panel(Panel.from_dict(panel_description))
+    # set_frame takes lab coordinates, the frame relative to the parent is derived from it
+    node.set_frame(panel_description['fast_axis'], panel_description['slow_axis'], panel_description['origin'])
+  return det
+
+
+def get_crystfel_detector(geom_filename, detdist_override=None, output_filename=None, hierarchy=True,
+                          rigid_group_collection=None, cache_dir=None):
+  """
+  Convert a crystfel geometry to a dxtbx detector, in memory. Results are cached (in memory, and in
+  cache_dir if given) keyed by the geometry file contents and the conversion arguments
+
+  :param geom_filename: a crystfel geometry file https://www.desy.de/~twhite/crystfel/manual-crystfel_geometry.html
+  :param detdist_override: alter the detector distance stored in the crystfel geometry to this value (in millimeters)
+  :param output_filename: optionally also write a dxtbx experiment containing the detector model (json file)
+  :param hierarchy: build a hierarchical detector, root -> crystfel rigid groups -> panels, so the whole detector
+    can be moved by updating the root (see set_detector_distance). Panels are flat under the root if the geometry
+    has no rigid group collection covering every panel once
+  :param rigid_group_collection: name of the crystfel rigid group collection (default is the first by name)
+  :param cache_dir: optional folder where converted detectors are saved as JSON, re-used across runs
+  :return: dxtbx detector, panel i is the i-th panel in the geometry file
+  """
+  with open(geom_filename, "rb") as fin:
+    digest = hashlib.sha1(fin.read()).hexdigest()
+  cache_key = "crystfel_%s_%r_%s_%s" % (digest, None if detdist_override is None else float(detdist_override),
+                                         "hier" if hierarchy else "flat", rigid_group_collection)
+  cache_file = None if cache_dir is None else os.path.join(cache_dir, cache_key + ".json")
+  if cache_key not in _DETECTOR_CACHE and cache_file is not None and os.path.exists(cache_file):
+    with open(cache_file, "r") as fin:
+      _DETECTOR_CACHE[cache_key] = json.load(fin)
+
+  if cache_key in _DETECTOR_CACHE:
+    dxtbx_det = DetectorFactory.from_dict(_DETECTOR_CACHE[cache_key])
+  else:
+    geom = _load_crystfel_geometry(geom_filename)
+    descriptions = _panel_descriptions(geom, detdist_override)
+    if hierarchy:
+      group_of = _rigid_groups(geom, [name for name, _ in descriptions], rigid_group_collection)
+      dxtbx_det = _build_hierarchy(descriptions, group_of)
+    else:
+      dxtbx_det = Detector()
+      for _, panel_description in descriptions:
+        dxtbx_det.add_panel(Panel.from_dict(panel_description))
+
+    _DETECTOR_CACHE[cache_key] = dxtbx_det.to_dict()
+    if cache_file is not None:
+      if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+      tmp_file = cache_file + ".tmp%d" % os.getpid()
+      with open(tmp_file, "w") as fout:
+        json.dump(_DETECTOR_CACHE[cache_key], fout)
+      os.replace(tmp_file, cache_file)
+
+  if output_filename is not None:
+    E = Experiment()
+    E.detector = dxtbx_det
+    El = ExperimentList()
+    El.append(E)
+    El.as_file(output_filename)  # this can be loaded into nanoBragg
+  return dxtbx_det
+
+
+def set_detector_distance(detector, detdist_mm):
+  """
+  Move a hierarchical detector (see get_crystfel_detector) along the beam by updating its root node,
+  every group and panel follows
+
+  :param detector: dxtbx detector with a hierarchy
+  :param detdist_mm: new distance of the root node from the sample (in millimeters)
+  """
+  root = detector.hierarchy()
+  x, y, _ = root.get_origin()
+  root.set_frame(root.get_fast_axis(), root.get_slow_axis(), (x, y, -detdist_mm))
+
+
+def convert_crystfel_to_dxtbx(geom_filename, output_filename, detdist_override=None):
+  """
+  :param geom_filename: a crystfel geometry file https://www.desy.de/~twhite/crystfel/manual-crystfel_geometry.html
+  :param output_filename: filename for a dxtbx experiment containing a single detector model (this is a json file)
+  :param detdist_override: alter the detector distance stored in the crystfel geometry to this value (in millimeters)
+  :return: the dxtbx detector (flat, one node per panel), see get_crystfel_detector for a hierarchical model
+  """
+  return get_crystfel_detector(geom_filename, detdist_override, output_filename=output_filename, hierarchy=False)
 
 
 def load_detector_from_expt(expt_file, exp_id=0):
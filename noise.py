@@ -0,0 +1,113 @@
+from __future__ import print_function
+
+import numpy as np
+
+# calibration errors are a property of the detector, so they use a fixed seed unless one is given
+# (the same default as nanoBragg's calib_seed)
+DEFAULT_CALIB_SEED = 123456789
+
+
+class NoiseModel:
+
+    def __init__(self, quantum_gain=1, adc_offset=10, readout_noise_adu=3, calibration_noise=0.03,
+                 flicker_noise=0, calib_seed=DEFAULT_CALIB_SEED):
+        """
+        Detector noise model of nanoBragg's add_noise, applied with numpy to a whole stack of panels.
+        For each pixel, in the same order as nanoBragg:
+          1) flicker (1/f) noise scales the expected photons
+          2) poisson photon counting noise
+          3) calibration noise, a per-pixel gain error that is the same on every shot (seeded by calib_seed)
+          4) conversion to ADU (quantum_gain, adc_offset) plus gaussian readout noise
+        The detector PSF is not modeled (sim_spots sets it to 0 as well).
+
+        :param quantum_gain: ADU per photon (sim_spots gain parameter)
+        :param adc_offset: offset to pixel values
+        :param readout_noise_adu: readout noise level (standard deviation in ADU)
+        :param calibration_noise: relative standard deviation of the per-pixel gain error (nanoBragg default is 0.03)
+        :param flicker_noise: relative standard deviation of source intensity fluctuations
+        :param calib_seed: seed for the per-pixel calibration errors, keep it fixed for all shots of one detector
+        """
+        if calib_seed is None:
+            raise ValueError("calib_seed is required, the calibration errors must be the same on every shot")
+        self.quantum_gain = quantum_gain
+        self.adc_offset = adc_offset
+        self.readout_noise_adu = readout_noise_adu
+        self.calibration_noise = calibration_noise
+        self.flicker_noise = flicker_noise
+        self.calib_seed = calib_seed
+        self._calib_factors = None
+
+    def calibration_factors(self, shape):
+        """
+        :param shape: shape of the image stack (Npanel x Nslow x Nfast)
+        :return: per-pixel gain factors, fixed for a given calib_seed and shape
+        """
+        if self._calib_factors is None or self._calib_factors.shape != tuple(shape):
+            calib_rng = np.random.default_rng(self.calib_seed)
+            self._calib_factors = 1 + self.calibration_noise*calib_rng.standard_normal(shape)
+        return self._calib_factors
+
+    def apply(self, expected_photons, rng, out=None):
+        """
+        :param expected_photons: noiseless image stack in photons (e.g. from sim_spots with add_noise=False)
+        :param rng: numpy random Generator (e.g. np.random.default_rng(seed))
+        :param out: optional float array to store the result in
+        :return: one noisy realization in ADU, same shape as expected_photons
+        """
+        expected_photons = np.asarray(expected_photons)
+        if self.flicker_noise > 0:
+            expected_photons = expected_photons*(1 + self.flicker_noise*rng.standard_normal(expected_photons.shape))
+        photons = rng.poisson(np.clip(expected_photons, 0, None))
+        if out is None:
+            out = np.empty(expected_photons.shape)
+        np.multiply(photons, self.quantum_gain, out=out, casting="unsafe")
+        if self.calibration_noise > 0:
+            out *= self.calibration_factors(expected_photons.shape)
+        out += self.adc_offset
+        if self.readout_noise_adu > 0:
+            out += self.readout_noise_adu*rng.standard_normal(expected_photons.shape)
+        return out
+
+    def realizations(self, expected_photons, num, seed=None):
+        """
+        generator of noisy realizations of a single noiseless image stack
+
+        :param expected_photons: noiseless image stack in photons
+        :param num: number of realizations
+        :param seed: seed for the poisson, flicker and readout noise
+        """
+        rng = np.random.default_rng(seed)
+        for _ in range(num):
+            yield self.apply(expected_photons, rng)
+
+    def batch(self, expected_photons, num, seed=None, dtype=np.float64):
+        """
+        :param expected_photons: noiseless image stack in photons
+        :param num: number of realizations
+        :param seed: seed for the poisson, flicker and readout noise
+        :param dtype: datatype of the returned array (float32 halves the memory)
+        :return: array of noisy realizations (num x expected_photons.shape)
+        """
+        rng = np.random.default_rng(seed)
+        expected_photons = np.asarray(expected_photons)
+        out = np.empty((num,) + expected_photons.shape, dtype=dtype)
+        for i in range(num):
+            self.apply(expected_photons, rng, out=out[i])
+        return out
+
+
+def add_noise(expected_photons, seed=None, num_realizations=None, calib_seed=DEFAULT_CALIB_SEED, **noise_kwargs):
+    """
+    convenience wrapper around NoiseModel
+
+    :param expected_photons: noiseless image stack in photons
+    :param seed: seed for the poisson, flicker and readout noise
+    :param num_realizations: if None return one noisy image, else an array of this many realizations
+    :param calib_seed: seed for the per-pixel calibration errors, the default gives the same errors on every call
+    :param noise_kwargs: other arguments of NoiseModel
+    :return: noisy image(s) in ADU
+    """
+    model = NoiseModel(calib_seed=calib_seed, **noise_kwargs)
+    if num_realizations is None:
+        return model.apply(expected_photons, np.random.default_rng(seed))
+    return model.batch(expected_photons, num_realizations, seed=seed)
@@ -0,0 +1,249 @@
+from __future__ import print_function
+
+import os
+import multiprocessing
+import numpy as np
+
+from nanoBragg_multipanel.profiling import PhaseTimer
+from nanoBragg_multipanel.structure_factors import PreparedFhkl, _SharedFhkl
+
+
+# per-process state, populated once by _init_worker when a pool process starts
+_WORKER_STATE = {}
+
+
+def _init_worker(detector_dict, beam_dict, Famp, background):
+    """
+    runs once in each pool process; keeps the detector and beam (and Famp) alive for every subsequent panel
+    the worker simulates. dxtbx is only imported once the worker gets its first task (see _worker_models),
+    so starting the pool stays cheap
+    """
+    _WORKER_STATE["detector_dict"] = detector_dict
+    _WORKER_STATE["beam_dict"] = beam_dict
+    if isinstance(Famp, _SharedFhkl):
+        Famp = PreparedFhkl.from_shared(Famp)
+    _WORKER_STATE["Famp"] = Famp
+    _WORKER_STATE["background"] = background
+    _WORKER_STATE["flex_background"] = {}
+
+
+def _worker_models():
+    """
+    :return: the dxtbx detector and beam of this worker, built on the first call
+    """
+    if "detector" not in _WORKER_STATE:
+        from dxtbx.model import DetectorFactory, BeamFactory
+        _WORKER_STATE["detector"] = DetectorFactory.from_dict(_WORKER_STATE["detector_dict"])
+        _WORKER_STATE["beam"] = BeamFactory.from_dict(_WORKER_STATE["beam_dict"])
+    return _WORKER_STATE["detector"], _WORKER_STATE["beam"]
+
+
+def _worker_background(pidx):
+    background = _WORKER_STATE["background"]
+    if background is None:
+        return None
+    cache = _WORKER_STATE["flex_background"]
+    if pidx not in cache:
+        from scitbx.array_family import flex
+        cache[pidx] = flex.double(np.ascontiguousarray(background[pidx], dtype=np.float64))
+    return cache[pidx]
+
+
+def _spots_task(args):
+    pidx, crystal_dict, wavelengths, wavelength_weights, total_flux, sim_kwargs, timed, dtype = args
+    from nanoBragg_multipanel.utils import sim_spots
+    from dxtbx.model import CrystalFactory
+    crystal = CrystalFactory.from_dict(crystal_dict)
+    kwargs = dict(sim_kwargs)
+    timer = None
+    if timed is not None:
+        shot, record_memory = timed
+        timer = PhaseTimer(record_memory=record_memory)
+        timer.shot = shot
+        kwargs["timer"] = timer
+    if kwargs.get("background_raw_pixels") is None:
+        kwargs["background_raw_pixels"] = _worker_background(pidx)
+    Famp = _WORKER_STATE["Famp"]
+    if isinstance(Famp, (list, tuple)):
+        Famp = Famp[pidx]  # per-panel structure factors, e.g. from resolution.prune_structure_factors
+    detector, beam = _worker_models()
+    fast_dim, slow_dim = detector[pidx].get_image_size()
+    # convert in the worker, so smaller dtypes also shrink the transfer back to the parent
+    pixels = sim_spots(crystal, detector, beam, Famp,
+                       wavelengths, wavelength_weights, total_flux, pidx=pidx,
+                       out=np.empty((slow_dim, fast_dim), dtype), **kwargs)
+    if timer is not None:
+        return pidx, pixels, timer.events
+    return pidx, pixels
+
+
+def _background_task(args):
+    pidx, wavelengths, wavelength_weights, total_flux, bg_kwargs = args
+    from nanoBragg_multipanel.utils import sim_background
+    detector, beam = _worker_models()
+    raw_pixels = sim_background(detector, beam, wavelengths,
+                                wavelength_weights, total_flux, pidx=pidx, **bg_kwargs)
+    return pidx, raw_pixels.as_numpy_array()
+
+
+def _ping(_):
+    """trivial task, used to wait until the pool workers have started (see SimulationPool.wait_ready)"""
+    return os.getpid()
+
+
+def get_stack_shape(detector):
+    """
+    :param detector: dxtbx detector model
+    :return: shape of a multi panel image (Npanel x Nslow x Nfast), numpy convention
+    """
+    sizes = set(tuple(panel.get_image_size()) for panel in detector)
+    if len(sizes) != 1:
+        raise ValueError("All panels must have the same image size to be stacked, got %s" % sorted(sizes))
+    fast_dim, slow_dim = sizes.pop()
+    return len(detector), slow_dim, fast_dim
+
+
+def allocate_shot_buffer(detector, dtype=np.float32):
+    """
+    :param detector: dxtbx detector model
+    :param dtype: datatype of the buffer, float32 (or an integer type once noise is added) halves the memory of float64
+    :return: numpy array (Npanel x Nslow x Nfast) to pass as `out` to simulate_shot / sim_spots, shot after shot
+    """
+    return np.empty(get_stack_shape(detector), dtype=dtype)
+
+
+class SimulationPool:
+
+    def __init__(self, detector, beam, Famp=None, nproc=None, background=None, mp_context=None):
+        """
+        Pool of long-lived worker processes that simulate panels of a multi panel detector in parallel.
+        The detector, beam, structure factors and (optional) background are shipped to each worker
+        once when the worker starts, so per-shot traffic is only the crystal model and simulation args.
+
+        :param detector: dxtbx detector model
+        :param beam: dxtbx beam model
+        :param Famp: cctbx miller array (or a float default amplitude), see sim_spots,
+            or a list with one entry per panel (see resolution.prune_structure_factors).
+            A structure_factors.PreparedFhkl is placed in shared memory once and read by every worker
+        :param nproc: number of worker processes (defaults to min(number of cpus, number of panels))
+        :param background: optional numpy array (Npanel x Nslow x Nfast) of background pixels,
+            added to every shot (see sim_background / simulate_background)
+        :param mp_context: multiprocessing start method ("fork", "spawn", "forkserver"), or None for the default
+        """
+        self.detector = detector
+        self.beam = beam
+        self.image_shape = get_stack_shape(detector)
+        if nproc is None:
+            nproc = min(multiprocessing.cpu_count(), len(detector))
+        self.nproc = int(nproc)
+        if background is not None:
+            background = np.asarray(background, dtype=np.float64)
+            if background.shape != self.image_shape:
+                raise ValueError("background shape %s does not match detector shape %s"
+                                 % (background.shape, self.image_shape))
+        self._shared_Famp = None
+        if isinstance(Famp, PreparedFhkl):
+            self._shared_Famp = Famp
+            Famp = Famp.share()
+        ctx = multiprocessing.get_context(mp_context)
+        self._pool = ctx.Pool(self.nproc, initializer=_init_worker,
+                              initargs=(detector.to_dict(), beam.to_dict(), Famp, background))
+
+    def wait_ready(self):
+        """
+        block until the workers have started and run a first (trivial) task
+
+        :return: number of distinct worker processes that answered
+        """
+        return len(set(self._pool.map(_ping, range(self.nproc), chunksize=1)))
+
+    def _run(self, task, task_args, out, timer=None):
+        if out is None:
+            out = np.empty(self.image_shape)
+        for result in self._pool.imap_unordered(task, task_args):
+            out[result[0]] = result[1]
+            if timer is not None:
+                timer.merge(result[2])
+        return out
+
+    def simulate_shot(self, crystal, wavelengths, wavelength_weights, total_flux, out=None, timer=None,
+                      **sim_kwargs):
+        """
+        simulate all panels of one shot
+
+        :param crystal: dxtbx crystal model
+        :param wavelengths: see sim_spots
+        :param wavelength_weights: see sim_spots
+        :param total_flux: see sim_spots
+        :param out: optional numpy array (Npanel x Nslow x Nfast) to store the result in, re-use it across shots
+            to avoid allocating a new frame every shot (see allocate_shot_buffer). Its dtype (e.g. float32 or
+            int32) is applied in the workers
+        :param timer: a profiling.PhaseTimer, the phases recorded in the workers are merged into it
+        :param sim_kwargs: any other keyword argument of sim_spots (except pidx)
+        :return: numpy array of simulated pixels (Npanel x Nslow x Nfast)
+        """
+        sim_kwargs.setdefault("time_panels", False)
+        crystal_dict = crystal.to_dict()
+        timed = None if timer is None else (timer.shot, timer.record_memory)
+        dtype = np.float64 if out is None else out.dtype
+        task_args = [(pidx, crystal_dict, list(wavelengths), list(wavelength_weights), total_flux, sim_kwargs,
+                      timed, dtype)
+                     for pidx in range(len(self.detector))]
+        return self._run(_spots_task, task_args, out, timer)
+
+    def simulate_background(self, wavelengths, wavelength_weights, total_flux, out=None, **bg_kwargs):
+        """
+        simulate the background on all panels
+
+        :param wavelengths: see sim_background
+        :param wavelength_weights: see sim_background
+        :param total_flux: see sim_background
+        :param out: optional numpy array (Npanel x Nslow x Nfast) to store the result in
+        :param bg_kwargs: any other keyword argument of sim_background (except pidx)
+        :return: numpy array of background pixels (Npanel x Nslow x Nfast)
+        """
+        task_args = [(pidx, list(wavelengths), list(wavelength_weights), total_flux, bg_kwargs)
+                     for pidx in range(len(self.detector))]
+        return self._run(_background_task, task_args, out)
+
+    def close(self):
+        """
+        shut down the worker processes (if instantiated using `with`, then this is done automatically)
+        """
+        self._pool.close()
+        self._pool.join()
+        if self._shared_Famp is not None:
+            self._shared_Famp.unshare()
+            self._shared_Famp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._pool.terminate()
+        self.close()
+
+
+def simulate_shot(crystal, detector, beam, Famp, wavelengths, wavelength_weights, total_flux,
+                  nproc=None, pool=None, background=None, **sim_kwargs):
+    """
+    Simulate every panel of a multi panel detector, fanning the panels out over a process pool
+
+    :param crystal: dxtbx crystal model
+    :param detector: dxtbx detector model
+    :param beam: dxtbx beam model
+    :param Famp: see sim_spots
+    :param wavelengths: see sim_spots
+    :param wavelength_weights: see sim_spots
+    :param total_flux: see sim_spots
+    :param nproc: number of processes, only used if pool is None
+    :param pool: a SimulationPool instance; re-use one across shots so the workers stay alive
+    :param background: numpy array (Npanel x Nslow x Nfast) of background pixels, only used if pool is None
+    :param sim_kwargs: any other keyword argument of sim_spots (except pidx)
+    :return: numpy array of simulated pixels (Npanel x Nslow x Nfast)
+    """
+    if pool is not None:
+        return pool.simulate_shot(crystal, wavelengths, wavelength_weights, total_flux, **sim_kwargs)
+    with SimulationPool(detector, beam, Famp, nproc=nproc, background=background) as pool:
+        return pool.simulate_shot(crystal, wavelengths, wavelength_weights, total_flux, **sim_kwargs)
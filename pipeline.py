@@ -0,0 +1,297 @@
+from __future__ import print_function
+
+import time
+import threading
+import multiprocessing
+import queue
+
+import numpy as np
+
+_STOP = None  # sentinel that tells the writer to finish
+
+
+class Shot:
+
+    def __init__(self, image, spectrum=None, mask=None):
+        """
+        A shot yielded to run_pipeline together with its spectrum (for writers storing per-shot spectra)
+        or its mask of pixels to keep (for SparseShotWriter)
+
+        :param image: image (Npanel x Nslow x Nfast)
+        :param spectrum: optional (energies, weights) of the shot, see H5AttributeGeomWriter.add_image
+        :param mask: optional boolean array (image shape), see SparseShotWriter.add_image
+        """
+        self.image = image
+        self.spectrum = spectrum
+        self.mask = mask
+
+
+def _write_shot(writer, image, spectrum, mask):
+    kwargs = {}
+    if spectrum is not None:
+        kwargs["spectrum"] = spectrum
+    if mask is not None:
+        kwargs["mask"] = mask
+    writer.add_image(image, **kwargs)
+
+
+class PipelineStats:
+
+    def __init__(self):
+        """
+        throughput bookkeeping for a shot pipeline
+        """
+        self.num_shots = 0
+        self.num_bytes = 0
+        self.write_time = 0
+        self.producer_wait_time = 0  # time the producer was blocked on a full queue (back-pressure)
+        self.tstart = time.time()
+        self.tstop = None
+
+    @property
+    def elapsed(self):
+        tstop = self.tstop if self.tstop is not None else time.time()
+        return tstop - self.tstart
+
+    @property
+    def shots_per_sec(self):
+        return self.num_shots / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def MB_per_sec(self):
+        return self.num_bytes / 1e6 / self.elapsed if self.elapsed > 0 else 0
+
+    def summary(self):
+        return ("%d shots (%.1f MB) in %.2f s: %.3f shots/s, %.2f MB/s, writer busy %.2f s, producer blocked %.2f s"
+                % (self.num_shots, self.num_bytes/1e6, self.elapsed, self.shots_per_sec, self.MB_per_sec,
+                   self.write_time, self.producer_wait_time))
+
+
+class BufferRing:
+
+    def __init__(self, shape, queue_size, dtype=np.float32):
+        """
+        Preallocated image buffers, handed out in turn, for producers that feed a writer queue.
+        A buffer is only re-used once the writer is done with it: at most queue_size images wait in the queue,
+        one is being written and one is being filled, so queue_size + 2 buffers are allocated
+
+        :param shape: shape of one image (Npanel x Nslow x Nfast)
+        :param queue_size: maxsize of the writer queue
+        :param dtype: datatype of the buffers
+        """
+        self.buffers = [np.empty(shape, dtype=dtype) for _ in range(queue_size + 2)]
+        self._index = 0
+
+    def next(self):
+        """
+        :return: the next buffer to fill
+        """
+        buf = self.buffers[self._index]
+        self._index = (self._index + 1) % len(self.buffers)
+        return buf
+
+
+class ShotWriterThread(threading.Thread):
+
+    def __init__(self, writer, maxsize=4):
+        """
+        Drains a bounded queue of images into an H5AttributeGeomWriter on a background thread,
+        so writing overlaps the simulation of the next shot
+
+        :param writer: an open H5AttributeGeomWriter
+        :param maxsize: maximum number of images waiting in the queue; put() blocks when it is full
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stats = PipelineStats()
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            if self.error is not None:
+                continue  # keep draining so the producer never blocks forever
+            image, spectrum, mask = item
+            try:
+                twrite = time.time()
+                _write_shot(self.writer, image, spectrum, mask)
+                self.stats.write_time += time.time() - twrite
+                self.stats.num_shots += 1
+                self.stats.num_bytes += image.nbytes
+            except Exception as err:
+                self.error = err
+
+    def put(self, image, spectrum=None, mask=None):
+        """
+        :param image: image to write (Npanel x Nslow x Nfast), it should not be modified after this call
+        :param spectrum: optional (energies, weights) of the shot, see H5AttributeGeomWriter.add_image
+        :param mask: optional boolean array of pixels to keep, see SparseShotWriter.add_image
+        """
+        if self.error is not None:
+            raise self.error
+        twait = time.time()
+        self.queue.put((image, spectrum, mask))
+        self.stats.producer_wait_time += time.time() - twait
+
+    def close(self):
+        """
+        wait for all queued images to be written, then stop the thread
+        """
+        self.queue.put(_STOP)
+        self.join()
+        self.stats.tstop = time.time()
+        if self.error is not None:
+            raise self.error
+        return self.stats
+
+
+def _writer_process_main(image_queue, result_queue, writer_kwargs):
+    stats = PipelineStats()
+    error = None
+    try:
+        from nanoBragg_multipanel.utils import H5AttributeGeomWriter
+        with H5AttributeGeomWriter(**writer_kwargs) as writer:
+            while True:
+                item = image_queue.get()
+                if item is _STOP:
+                    break
+                if error is not None:
+                    continue
+                image, spectrum, mask = item
+                try:
+                    twrite = time.time()
+                    _write_shot(writer, image, spectrum, mask)
+                    stats.write_time += time.time() - twrite
+                    stats.num_shots += 1
+                    stats.num_bytes += image.nbytes
+                except Exception as err:
+                    error = "%s: %s" % (type(err).__name__, err)
+    except Exception as err:  # opening or closing the file failed, the parent stops waiting on this process
+        if error is None:
+            error = "%s: %s" % (type(err).__name__, err)
+    finally:
+        result_queue.put((stats.num_shots, stats.num_bytes, stats.write_time, error))
+
+
+class ShotWriterProcess:
+
+    def __init__(self, maxsize=4, mp_context=None, poll_interval=1, **writer_kwargs):
+        """
+        Like ShotWriterThread, but the H5AttributeGeomWriter lives in a separate process, so CPU heavy
+        compression (e.g. gzip) does not compete with the producer for the GIL.
+        Images are pickled through the queue, so prefer ShotWriterThread for uncompressed output.
+
+        :param maxsize: maximum number of images waiting in the queue; put() blocks when it is full
+        :param mp_context: multiprocessing start method, or None for the default
+        :param poll_interval: seconds between checks that the writer process is still alive while put()
+            or close() wait on it
+        :param writer_kwargs: arguments of H5AttributeGeomWriter; detector and beam are sent as dictionaries
+        """
+        if not writer_kwargs.get("detector_and_beam_are_dicts", False):
+            writer_kwargs["detector"] = writer_kwargs["detector"].to_dict()
+            writer_kwargs["beam"] = writer_kwargs["beam"].to_dict()
+            writer_kwargs["detector_and_beam_are_dicts"] = True
+        ctx = multiprocessing.get_context(mp_context)
+        self.queue = ctx.Queue(maxsize=maxsize)
+        self._result_queue = ctx.Queue()
+        self._result = None
+        self.poll_interval = poll_interval
+        self.stats = PipelineStats()
+        self._proc = ctx.Process(target=_writer_process_main, args=(self.queue, self._result_queue, writer_kwargs))
+        self._proc.daemon = True
+        self._proc.start()
+
+    def _get_result(self):
+        """wait for the (num_shots, num_bytes, write_time, error) the writer process sends when it ends"""
+        while self._result is None:
+            try:
+                self._result = self._result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if not self._proc.is_alive():
+                    try:  # it may have sent its result just before exiting
+                        self._result = self._result_queue.get(timeout=self.poll_interval)
+                    except queue.Empty:
+                        self._result = 0, 0, 0, "died with exit code %s" % self._proc.exitcode
+        return self._result
+
+    def _raise_if_dead(self):
+        if not self._proc.is_alive():
+            error = self._get_result()[3]
+            raise RuntimeError("Writer process failed: %s" % (error or "exited before the last image"))
+
+    def put(self, image, spectrum=None, mask=None):
+        """
+        :param image: image to write (Npanel x Nslow x Nfast)
+        :param spectrum: optional (energies, weights) of the shot, see H5AttributeGeomWriter.add_image
+        :param mask: not supported, the writer process holds an H5AttributeGeomWriter
+        """
+        if mask is not None:
+            raise ValueError("The writer process does not support masks, use a SparseShotWriter with a writer thread")
+        self._raise_if_dead()
+        twait = time.time()
+        while True:
+            try:
+                self.queue.put((image, spectrum, mask), timeout=self.poll_interval)
+                break
+            except queue.Full:
+                self._raise_if_dead()
+        self.stats.producer_wait_time += time.time() - twait
+
+    def close(self):
+        """
+        wait for all queued images to be written, then stop the process
+        """
+        while self._proc.is_alive():
+            try:
+                self.queue.put(_STOP, timeout=self.poll_interval)
+                break
+            except queue.Full:
+                pass
+        num_shots, num_bytes, write_time, error = self._get_result()
+        self._proc.join()
+        self.stats.tstop = time.time()
+        self.stats.num_shots = num_shots
+        self.stats.num_bytes = num_bytes
+        self.stats.write_time = write_time
+        if error is not None:
+            raise RuntimeError("Writer process failed: %s" % error)
+        return self.stats
+
+
+def run_pipeline(shots, writer=None, queue_size=4, use_process=False, verbose=True, **writer_kwargs):
+    """
+    Write simulated shots while the next ones are being simulated
+
+    :param shots: iterable (e.g. a generator) yielding images (Npanel x Nslow x Nfast),
+        or Shot instances for writers storing per-shot spectra
+    :param writer: an open H5AttributeGeomWriter or SparseShotWriter (used with a writer thread)
+    :param queue_size: maximum number of shots held in memory waiting to be written
+    :param use_process: write from a separate process, writer must then be None and
+        writer_kwargs are passed to H5AttributeGeomWriter in that process
+    :param verbose: print throughput stats when done
+    :return: PipelineStats instance
+    """
+    if use_process:
+        if writer is not None:
+            raise ValueError("With use_process=True, pass H5AttributeGeomWriter arguments instead of a writer")
+        sink = ShotWriterProcess(maxsize=queue_size, **writer_kwargs)
+    else:
+        if writer is None:
+            raise ValueError("writer is required unless use_process=True")
+        sink = ShotWriterThread(writer, maxsize=queue_size)
+        sink.start()
+    try:
+        for item in shots:
+            if isinstance(item, Shot):
+                sink.put(np.asarray(item.image), item.spectrum, item.mask)
+            else:
+                sink.put(np.asarray(item))
+    finally:
+        stats = sink.close()
+    if verbose:
+        print(stats.summary())
+    return stats
@@ -0,0 +1,159 @@
+from __future__ import print_function
+
+import os
+import json
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss_bytes():
+    """
+    :return: resident memory of this process in bytes (peak resident memory where the current value is unavailable)
+    """
+    try:
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1]) * _PAGE_SIZE
+    except (IOError, OSError, ValueError, IndexError):
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Phase:
+
+    def __init__(self, timer, name, panel):
+        self.timer = timer
+        self.name = name
+        self.panel = panel
+
+    def __enter__(self):
+        self.rss_start = current_rss_bytes() if self.timer.record_memory else 0
+        self.tstart = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        tstop = time.time()
+        rss_stop = current_rss_bytes() if self.timer.record_memory else 0
+        self.timer.events.append({"name": self.name, "panel": self.panel, "shot": self.timer.shot,
+                                  "pid": os.getpid(), "start": self.tstart, "duration": tstop - self.tstart,
+                                  "rss": rss_stop, "rss_delta": rss_stop - self.rss_start})
+
+
+class PhaseTimer:
+
+    def __init__(self, record_memory=True):
+        """
+        Records the duration (and resident memory) of each phase of a simulation, per panel and per shot.
+        Pass an instance as `timer` to sim_spots, PanelSimulatorSession.run or SimulationPool.simulate_shot
+
+        :param record_memory: also record resident memory after each phase, and its change during the phase
+        """
+        self.record_memory = record_memory
+        self.events = []
+        self.shot = 0
+
+    def phase(self, name, panel=None):
+        """
+        context manager timing one phase, e.g.
+          with timer.phase("add_spots", panel=pidx):
+              SIM.add_nanoBragg_spots()
+        """
+        return _Phase(self, name, panel)
+
+    def next_shot(self):
+        """subsequent phases are attributed to the next shot"""
+        self.shot += 1
+
+    def merge(self, events):
+        """
+        :param events: events recorded by another PhaseTimer (e.g. in a worker process)
+        """
+        self.events.extend(events)
+
+    def aggregate(self, by="name"):
+        """
+        :param by: "name" (per phase), "panel" or "shot"
+        :return: ordered dictionary of {key: {"count", "total", "mean", "max", "max_rss_delta"}}
+        """
+        stats = OrderedDict()
+        for ev in self.events:
+            key = ev[by]
+            if key not in stats:
+                stats[key] = {"count": 0, "total": 0., "max": 0., "max_rss_delta": 0}
+            entry = stats[key]
+            entry["count"] += 1
+            entry["total"] += ev["duration"]
+            entry["max"] = max(entry["max"], ev["duration"])
+            entry["max_rss_delta"] = max(entry["max_rss_delta"], ev["rss_delta"])
+        for entry in stats.values():
+            entry["mean"] = entry["total"] / entry["count"]
+        return stats
+
+    def report(self):
+        """
+        print the time spent in each phase, largest first
+        """
+        stats = self.aggregate("name")
+        grand_total = sum(entry["total"] for entry in stats.values())
+        print("%-20s %8s %10s %10s %10s %7s %12s" % ("phase", "count", "total(s)", "mean(s)", "max(s)", "frac",
+                                                     "max dRSS(MB)"))
+        for name, entry in sorted(stats.items(), key=lambda kv: -kv[1]["total"]):
+            print("%-20s %8d %10.4f %10.4f %10.4f %7.3f %12.1f"
+                  % (name, entry["count"], entry["total"], entry["mean"], entry["max"],
+                     entry["total"] / grand_total if grand_total > 0 else 0, entry["max_rss_delta"] / 1e6))
+
+    def to_json(self, filename):
+        """
+        :param filename: write the raw events and the per phase/panel/shot aggregates here
+        """
+        output = {"events": self.events,
+                  "per_phase": self.aggregate("name"),
+                  "per_panel": [(k, v) for k, v in self.aggregate("panel").items()],
+                  "per_shot": [(k, v) for k, v in self.aggregate("shot").items()]}
+        with open(filename, "w") as fout:
+            json.dump(output, fout, indent=1)
+
+    def to_chrome_trace(self, filename):
+        """
+        :param filename: write a timeline that can be opened with chrome://tracing or https://ui.perfetto.dev
+            (one row per process and panel). With no recorded events the trace is valid but empty
+        """
+        t0 = min([ev["start"] for ev in self.events] or [0])
+        trace = []
+        for ev in self.events:
+            trace.append({"name": ev["name"], "ph": "X", "ts": (ev["start"] - t0)*1e6, "dur": ev["duration"]*1e6,
+                          "pid": ev["pid"], "tid": -1 if ev["panel"] is None else ev["panel"],
+                          "args": {"shot": ev["shot"], "rss_MB": ev["rss"] / 1e6,
+                                   "rss_delta_MB": ev["rss_delta"] / 1e6}})
+        with open(filename, "w") as fout:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, fout)
+
+
+class _NullPhase:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class NullTimer:
+    """stand-in for PhaseTimer that records nothing"""
+    _phase = _NullPhase()
+
+    def phase(self, name, panel=None):
+        return self._phase
+
+    def next_shot(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
@@ -0,0 +1,112 @@
+from __future__ import print_function
+
+import time
+import numpy as np
+
+
+def _panel_border_lab_coords(panel):
+    """lab coordinates (mm) of the centers of every pixel on the border of a panel"""
+    fast_dim, slow_dim = panel.get_image_size()
+    pix_fast, pix_slow = panel.get_pixel_size()
+    origin = np.array(panel.get_origin())
+    F = np.array(panel.get_fast_axis())
+    S = np.array(panel.get_slow_axis())
+    fs = np.arange(fast_dim) + 0.5
+    ss = np.arange(slow_dim) + 0.5
+    border_f = np.concatenate([fs, fs, np.full(slow_dim, 0.5), np.full(slow_dim, fast_dim-0.5)])
+    border_s = np.concatenate([np.full(fast_dim, 0.5), np.full(fast_dim, slow_dim-0.5), ss, ss])
+    return origin + border_f[:, None]*pix_fast*F + border_s[:, None]*pix_slow*S
+
+
+def _beam_hits_panel(panel, unit_s0):
+    D = np.array(panel.get_D_matrix()).reshape((3, 3))
+    v = np.dot(D, unit_s0)
+    if v[2] <= 0:
+        return False
+    fast_dim, slow_dim = panel.get_image_size()
+    pix_fast, pix_slow = panel.get_pixel_size()
+    f = v[0]/v[2]/pix_fast
+    s = v[1]/v[2]/pix_slow
+    return 0 <= f <= fast_dim and 0 <= s <= slow_dim
+
+
+def get_panel_resolution_range(panel, beam, wavelengths, pad_frac=0.02):
+    """
+    Resolution range a panel can record over a whole spectrum. On a flat panel the scattering angle is
+    smallest and largest on its border (unless the direct beam hits the panel), so only the border is checked
+
+    :param panel: dxtbx panel
+    :param beam: dxtbx beam model (used for the beam direction)
+    :param wavelengths: wavelengths in Angstrom
+    :param pad_frac: widen the range by this fraction on both ends (for mosaicity and spot size)
+    :return: d_min, d_max in Angstrom (d_max is None if the direct beam hits the panel)
+    """
+    unit_s0 = np.array(beam.get_unit_s0())
+    xyz = _panel_border_lab_coords(panel)
+    cos_2theta = np.dot(xyz, unit_s0) / np.linalg.norm(xyz, axis=1)
+    two_theta = np.arccos(np.clip(cos_2theta, -1, 1))
+    d_min = np.min(wavelengths) / (2*np.sin(two_theta.max()/2)) * (1-pad_frac)
+    if _beam_hits_panel(panel, unit_s0) or two_theta.min() <= 0:
+        d_max = None
+    else:
+        d_max = np.max(wavelengths) / (2*np.sin(two_theta.min()/2)) * (1+pad_frac)
+    return d_min, d_max
+
+
+def _fhkl_grid_bytes(ma):
+    """memory of the dense h,k,l grid nanoBragg builds from a miller array (8 bytes per grid point)"""
+    if ma.size() == 0:
+        return 0
+    hkl = np.array(ma.expand_to_p1().indices())
+    extent = hkl.max(axis=0) - hkl.min(axis=0) + 1
+    return int(np.prod(extent)) * 8
+
+
+def _time_fhkl_setup(detector, beam, Famp, pidx):
+    from simtbx.nanoBragg import nanoBragg
+    SIM = nanoBragg(detector, beam, panel_id=int(pidx))
+    tstart = time.time()
+    SIM.Fhkl = Famp
+    tsetup = time.time() - tstart
+    SIM.free_all()
+    return tsetup
+
+
+def prune_structure_factors(Famp, detector, beam, wavelengths, pad_frac=0.02, time_setup=False, verbose=True):
+    """
+    Give each panel only the structure factors it can record
+
+    :param Famp: cctbx miller array of structure factor amplitudes
+    :param detector: dxtbx detector model
+    :param beam: dxtbx beam model
+    :param wavelengths: wavelengths in Angstrom (the whole spectrum)
+    :param pad_frac: see get_panel_resolution_range
+    :param time_setup: also measure the time nanoBragg spends ingesting the full and the pruned arrays
+    :param verbose: print the memory (and setup time) saved
+    :return: list of miller arrays, one per panel (can be passed as Famp to SimulationPool and PanelSimulatorSession)
+    """
+    full_grid = _fhkl_grid_bytes(Famp)
+    pruned = []
+    grid_bytes = []
+    for pidx, panel in enumerate(detector):
+        d_min, d_max = get_panel_resolution_range(panel, beam, wavelengths, pad_frac=pad_frac)
+        panel_Famp = Famp.resolution_filter(d_max=0 if d_max is None else d_max, d_min=d_min)
+        grid_bytes.append(_fhkl_grid_bytes(panel_Famp))
+        if panel_Famp.size() == 0:
+            panel_Famp = 0.  # no reflections on this panel, sim_spots treats a float as a default amplitude
+        pruned.append(panel_Famp)
+        if verbose:
+            print("Panel %d: d_min=%.2f d_max=%s, %d / %d reflections"
+                  % (pidx, d_min, "inf" if d_max is None else "%.2f" % d_max,
+                     0 if isinstance(panel_Famp, float) else panel_Famp.size(), Famp.size()))
+
+    if verbose:
+        print("nanoBragg Fhkl grids: %.1f MB per panel before pruning, %.1f MB per panel on average after"
+              % (full_grid/1e6, np.mean(grid_bytes)/1e6))
+    if time_setup:
+        tfull = sum(_time_fhkl_setup(detector, beam, Famp, pidx) for pidx in range(len(detector)))
+        tpruned = sum(_time_fhkl_setup(detector, beam, pruned[pidx], pidx) for pidx in range(len(detector))
+                      if not isinstance(pruned[pidx], float))
+        if verbose:
+            print("Fhkl setup over all panels: %.4f seconds before pruning, %.4f seconds after" % (tfull, tpruned))
+    return pruned
@@ -0,0 +1,244 @@
+from __future__ import print_function
+
+import numpy as np
+
+from nanoBragg_multipanel.utils import sim_spots, determine_Ncells_abc
+from nanoBragg_multipanel.noise import NoiseModel, DEFAULT_CALIB_SEED
+from nanoBragg_multipanel.structure_factors import PreparedFhkl
+
+
+def get_p1_indices(crystal, Famp=None, d_min=None):
+    """
+    :param crystal: dxtbx crystal model
+    :param Famp: cctbx miller array, its indices are expanded to P1 (including Friedel mates), or a
+        structure_factors.PreparedFhkl (already P1, used with its Friedel mates).
+        If None (or a float default amplitude), all indices of the crystal's unit cell out to d_min are used
+    :param d_min: high resolution limit in Angstrom (required if Famp is not a miller array)
+    :return: numpy array of miller indices (N x 3)
+    """
+    if isinstance(Famp, PreparedFhkl):
+        hkl = np.unique(np.vstack([Famp.indices, -Famp.indices]), axis=0)
+        if d_min is not None:
+            from cctbx import uctbx
+            from cctbx.array_family import flex
+            d_spacings = uctbx.unit_cell(Famp.unit_cell_tuple).d(flex.miller_index([tuple(x) for x in hkl.tolist()]))
+            hkl = hkl[np.array(d_spacings) >= d_min]
+        return hkl.astype(np.int32)
+    if Famp is not None and not isinstance(Famp, float):
+        ma = Famp.expand_to_p1()
+        if not ma.anomalous_flag():
+            ma = ma.generate_bijvoet_mates()
+        if d_min is not None:
+            ma = ma.resolution_filter(d_min=d_min)
+        return np.array(ma.indices(), dtype=np.int32)
+    if d_min is None:
+        raise ValueError("d_min is required when no structure factors are given")
+    from cctbx import crystal as cctbx_crystal
+    from cctbx import miller
+    symm = cctbx_crystal.symmetry(unit_cell=crystal.get_unit_cell(), space_group_info=crystal.get_space_group().info())
+    mset = miller.build_set(symm, anomalous_flag=True, d_min=d_min).expand_to_p1()
+    return np.array(mset.indices(), dtype=np.int32)
+
+
+def predict_spots(crystal, detector, beam, wavelengths, wavelength_weights=None, Famp=None, d_min=None,
+                  mos_spread_deg=0, Ncells_abc=None, ewald_pad=0.001):
+    """
+    Predict where Bragg reflections land on each panel for a still shot with an arbitrary spectrum.
+    A reflection is predicted if the wavelength that puts it on the Ewald sphere falls inside the
+    spectrum, widened by the reflection's own bandwidth (from mosaic spread and mosaic domain size)
+
+    :param crystal: dxtbx crystal model
+    :param detector: dxtbx detector model
+    :param beam: dxtbx beam model (used for the beam direction)
+    :param wavelengths: wavelengths in Angstrom
+    :param wavelength_weights: weights for each wavelength, wavelengths with 0 weight are ignored
+    :param Famp: cctbx miller array, see get_p1_indices
+    :param d_min: high resolution limit in Angstrom, defaults to the detector corners at the shortest wavelength
+    :param mos_spread_deg: mosaic spread (degrees)
+    :param Ncells_abc: number of unit cells along each axis of a mosaic domain
+    :param ewald_pad: extra relative bandwidth added to every reflection
+    :return: list with one entry per panel, each a (fast_px, slow_px) tuple of numpy arrays
+    """
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    if wavelength_weights is not None:
+        wavelengths = wavelengths[np.asarray(wavelength_weights) > 0]
+    wave_min, wave_max = wavelengths.min(), wavelengths.max()
+
+    if d_min is None:
+        s0_min = np.array(beam.get_unit_s0()) / wave_min
+        d_min = min([panel.get_max_resolution_at_corners(tuple(s0_min)) for panel in detector])
+
+    hkl = get_p1_indices(crystal, Famp, d_min)
+    Amat = np.array(crystal.get_A()).reshape((3, 3))
+    q = np.dot(hkl, Amat.T)  # reciprocal lattice vectors (1/Angstrom)
+    qnorm = np.linalg.norm(q, axis=1)
+    unit_s0 = np.array(beam.get_unit_s0())
+    q_dot_s0 = np.dot(q, unit_s0)
+    keep = (q_dot_s0 < 0) & (qnorm > 0)
+    q, qnorm, q_dot_s0 = q[keep], qnorm[keep], q_dot_s0[keep]
+
+    # wavelength at which each reflection is on the Ewald sphere: |s0/lambda + q| = 1/lambda
+    wave_hkl = -2*q_dot_s0 / qnorm**2
+
+    # relative bandwidth each reflection accepts
+    sin_theta = np.clip(wave_hkl*qnorm/2, 1e-6, 1)
+    tan_theta = np.tan(np.arcsin(sin_theta))
+    rel_tol = ewald_pad + np.deg2rad(mos_spread_deg) / tan_theta
+    if Ncells_abc is not None:
+        cell_len = np.mean(crystal.get_unit_cell().parameters()[:3])
+        rel_tol = rel_tol + 1. / (np.mean(Ncells_abc)*cell_len*qnorm)
+    on_ewald = (wave_hkl >= wave_min*(1-rel_tol)) & (wave_hkl <= wave_max*(1+rel_tol))
+    q, wave_hkl = q[on_ewald], np.clip(wave_hkl[on_ewald], wave_min, wave_max)
+
+    s1 = unit_s0[None] / wave_hkl[:, None] + q  # diffracted beam directions
+
+    spots = []
+    for panel in detector:
+        D = np.array(panel.get_D_matrix()).reshape((3, 3))
+        v = np.dot(s1, D.T)
+        hits = v[:, 2] > 0
+        x_mm = v[hits, 0] / v[hits, 2]
+        y_mm = v[hits, 1] / v[hits, 2]
+        pix_fast, pix_slow = panel.get_pixel_size()
+        fast_px = x_mm / pix_fast
+        slow_px = y_mm / pix_slow
+        fast_dim, slow_dim = panel.get_image_size()
+        inside = (fast_px >= 0) & (fast_px < fast_dim) & (slow_px >= 0) & (slow_px < slow_dim)
+        spots.append((fast_px[inside], slow_px[inside]))
+    return spots
+
+
+def merge_rois(rois, merge_distance=0):
+    """
+    :param rois: list of (fast_min, fast_max, slow_min, slow_max)
+    :param merge_distance: also merge boxes separated by at most this many pixels
+    :return: list of non-overlapping boxes covering the input boxes
+    """
+    boxes = [list(b) for b in rois]
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for box in sorted(boxes):
+            for other in out:
+                if (box[0] <= other[1] + merge_distance + 1 and other[0] <= box[1] + merge_distance + 1 and
+                        box[2] <= other[3] + merge_distance + 1 and other[2] <= box[3] + merge_distance + 1):
+                    other[0], other[1] = min(other[0], box[0]), max(other[1], box[1])
+                    other[2], other[3] = min(other[2], box[2]), max(other[3], box[3])
+                    merged = True
+                    break
+            else:
+                out.append(box)
+        boxes = out
+    return [tuple(b) for b in boxes]
+
+
+def get_panel_rois(fast_px, slow_px, image_size, pad=10, merge_distance=4):
+    """
+    :param fast_px: fast-scan positions of predicted spots (pixels)
+    :param slow_px: slow-scan positions of predicted spots (pixels)
+    :param image_size: panel size (fast_dim, slow_dim)
+    :param pad: half width of the box around each spot (pixels)
+    :param merge_distance: merge boxes that are this close (pixels)
+    :return: list of (fast_min, fast_max, slow_min, slow_max) inclusive pixel bounds
+    """
+    fast_dim, slow_dim = image_size
+    rois = []
+    for f, s in zip(fast_px, slow_px):
+        rois.append((max(int(f) - pad, 0), min(int(f) + pad, fast_dim-1),
+                     max(int(s) - pad, 0), min(int(s) + pad, slow_dim-1)))
+    return merge_rois(rois, merge_distance)
+
+
+def predicted_spot_mask(crystal, detector, beam, wavelengths, wavelength_weights=None, Famp=None, pad=3,
+                        **predict_kwargs):
+    """
+    :param crystal: dxtbx crystal model
+    :param detector: dxtbx detector model
+    :param beam: dxtbx beam model
+    :param wavelengths: see predict_spots
+    :param wavelength_weights: see predict_spots
+    :param Famp: see predict_spots
+    :param pad: half width of the box masked around each predicted spot (pixels)
+    :param predict_kwargs: other keyword arguments of predict_spots
+    :return: boolean numpy array (Npanel x Nslow x Nfast), True near predicted spots (e.g. for SparseShotWriter)
+    """
+    spots = predict_spots(crystal, detector, beam, wavelengths, wavelength_weights, Famp=Famp, **predict_kwargs)
+    fast_dim, slow_dim = detector[0].get_image_size()
+    mask = np.zeros((len(detector), slow_dim, fast_dim), bool)
+    for pidx, (fast_px, slow_px) in enumerate(spots):
+        for fmin, fmax, smin, smax in get_panel_rois(fast_px, slow_px, detector[pidx].get_image_size(), pad=pad,
+                                                     merge_distance=0):
+            mask[pidx, smin:smax+1, fmin:fmax+1] = True
+    return mask
+
+
+def simulate_shot_sparse(crystal, detector, beam, Famp, wavelengths, wavelength_weights, total_flux,
+                         pad=10, merge_distance=4, max_roi_fraction=0.5, background=None,
+                         mosaic_vol_A3=3000**3, mos_spread=0, ewald_pad=0.001, add_noise=True,
+                         verbose=False, **sim_kwargs):
+    """
+    Simulate a shot by running nanoBragg only in padded regions around predicted Bragg spots.
+    Panels with no predicted spots are not simulated, the background and noise (if requested) are applied to them
+    with noise.NoiseModel
+
+    :param crystal: dxtbx crystal model
+    :param detector: dxtbx detector model
+    :param beam: dxtbx beam model
+    :param Famp: see sim_spots
+    :param wavelengths: see sim_spots
+    :param wavelength_weights: see sim_spots
+    :param total_flux: see sim_spots
+    :param pad: half width of the region simulated around each predicted spot (pixels)
+    :param merge_distance: merge regions that are this close (pixels)
+    :param max_roi_fraction: if the regions cover more than this fraction of a panel, simulate the whole panel
+    :param background: optional list of per-panel background arrays (numpy or flex) added to the full panels
+    :param mosaic_vol_A3: see sim_spots
+    :param mos_spread: see sim_spots
+    :param ewald_pad: see predict_spots
+    :param add_noise: see sim_spots
+    :param verbose: print how many panels and pixels were simulated
+    :param sim_kwargs: other keyword arguments of sim_spots
+    :return: numpy array of simulated pixels (Npanel x Nslow x Nfast)
+    """
+    spots = predict_spots(crystal, detector, beam, wavelengths, wavelength_weights, Famp=Famp,
+                          mos_spread_deg=mos_spread, Ncells_abc=determine_Ncells_abc(crystal, mosaic_vol_A3),
+                          ewald_pad=ewald_pad)
+    fast_dim, slow_dim = detector[0].get_image_size()
+    shot = np.zeros((len(detector), slow_dim, fast_dim))
+    sim_kwargs.setdefault("time_panels", False)
+    num_sim_panels = 0
+    num_sim_pixels = 0
+    noise_model = noise_rng = None
+    for pidx, (fast_px, slow_px) in enumerate(spots):
+        panel_size = detector[pidx].get_image_size()
+        rois = get_panel_rois(fast_px, slow_px, panel_size, pad=pad, merge_distance=merge_distance)
+        roi_pixels = sum((r[1]-r[0]+1)*(r[3]-r[2]+1) for r in rois)
+        if roi_pixels > max_roi_fraction*panel_size[0]*panel_size[1]:
+            rois = None
+            roi_pixels = panel_size[0]*panel_size[1]
+        panel_bg = None if background is None else background[pidx]
+        if rois is not None and not rois:
+            # no spots on this panel, apply the background and noise without building a nanoBragg instance
+            if panel_bg is not None:
+                if not isinstance(panel_bg, np.ndarray):
+                    panel_bg = panel_bg.as_numpy_array()
+                shot[pidx] = panel_bg.reshape(shot[pidx].shape)*sim_kwargs.get("background_scale", 1)
+            if add_noise:
+                if noise_model is None:
+                    noise_model = NoiseModel(quantum_gain=sim_kwargs.get("gain", 1),
+                                             adc_offset=sim_kwargs.get("adc_offset", 10),
+                                             readout_noise_adu=sim_kwargs.get("readout_noise_adu", 3),
+                                             calib_seed=sim_kwargs.get("calib_seed") or DEFAULT_CALIB_SEED)
+                    noise_rng = np.random.default_rng(sim_kwargs.get("noise_seed"))
+                noise_model.apply(shot[pidx], noise_rng, out=shot[pidx])
+            continue
+        num_sim_panels += 1
+        num_sim_pixels += roi_pixels
+        shot[pidx] = sim_spots(crystal, detector, beam, Famp, wavelengths, wavelength_weights, total_flux,
+                               pidx=pidx, mosaic_vol_A3=mosaic_vol_A3, mos_spread=mos_spread, add_noise=add_noise,
+                               background_raw_pixels=panel_bg, rois=rois, **sim_kwargs)
+    if verbose:
+        print("Simulated spots on %d / %d panels, %.3f%% of the pixels"
+              % (num_sim_panels, len(detector), 100.*num_sim_pixels / shot.size))
+    return shot
@@ -0,0 +1,337 @@
+from __future__ import print_function
+
+import os
+import json
+import time
+import errno
+import socket
+import uuid
+import numpy as np
+
+from nanoBragg_multipanel.shards import shard_filename, finalize_shards
+from nanoBragg_multipanel.noise import DEFAULT_CALIB_SEED
+
+MANIFEST_NAME = "manifest.json"
+
+
+def make_manifest(num_shots, shots_per_unit=10, random_state=8675309, wavelengths=None, wavelength_weights=None,
+                  calib_seed=DEFAULT_CALIB_SEED):
+    """
+    describe every shot of a simulation campaign up front, so any worker can simulate any shot reproducibly
+
+    :param num_shots: number of shots in the campaign
+    :param shots_per_unit: shots per work unit (one output file per unit)
+    :param random_state: seed for the random crystal orientations (scipy Rotation.random) and the per-shot seeds
+    :param wavelengths: optional spectrum, either one list of wavelengths for all shots, or one list per shot
+    :param wavelength_weights: weights for wavelengths, same layout
+    :param calib_seed: seed for the per-pixel calibration errors, one value for the whole campaign since they are a
+        property of the detector
+    :return: manifest dictionary, pass it to ShotScheduler.create
+    """
+    from scipy.spatial.transform import Rotation
+    rotations = Rotation.random(num_shots, random_state=random_state)
+    seeds = np.random.RandomState(random_state).randint(1, 2**31-1, size=(num_shots, 2))
+    per_shot_spectra = wavelengths is not None and len(wavelengths) == num_shots and np.ndim(wavelengths[0]) == 1
+    shots = []
+    for i_shot in range(num_shots):
+        rot = rotations[i_shot]
+        R = rot.as_matrix() if hasattr(rot, "as_matrix") else rot.as_dcm()
+        shot = {"index": i_shot, "rotation": np.array(R).ravel().tolist(),
+                "noise_seed": int(seeds[i_shot, 0]), "mosaic_seed": int(seeds[i_shot, 1])}
+        if wavelengths is not None:
+            shot["wavelengths"] = list(map(float, wavelengths[i_shot] if per_shot_spectra else wavelengths))
+            shot["wavelength_weights"] = list(map(float, wavelength_weights[i_shot] if per_shot_spectra
+                                                  else wavelength_weights))
+        shots.append(shot)
+    num_units = int(np.ceil(num_shots / float(shots_per_unit)))
+    return {"num_shots": num_shots, "shots_per_unit": shots_per_unit, "num_units": num_units,
+            "random_state": random_state, "calib_seed": calib_seed, "shots": shots}
+
+
+class ShotScheduler:
+
+    def __init__(self, campaign_dir, lease_timeout=3600):
+        """
+        Work queue for a simulation campaign on a shared filesystem. The shots of a manifest are split into
+        work units, and any number of local or cluster processes lease units through lock files
+        (hard linked into place, which is atomic on local and network filesystems).
+        A unit is done once its output file is complete, so a restarted campaign skips it.
+        Leases are renewed while a unit is simulated; a lease older than lease_timeout seconds
+        (or held by a dead process on this host) is taken over by the next worker.
+
+        :param campaign_dir: folder holding the manifest (see create), the lock files and the per-unit outputs
+        :param lease_timeout: seconds without renewal after which a lease is considered stale
+        """
+        self.campaign_dir = campaign_dir
+        self.lease_timeout = lease_timeout
+        with open(os.path.join(campaign_dir, MANIFEST_NAME), "r") as fin:
+            self.manifest = json.load(fin)
+        self.num_units = self.manifest["num_units"]
+        self.prefix = os.path.join(campaign_dir, "unit")
+        self._hostname = socket.gethostname()
+        self._tokens = {}  # token of each lease held by this process
+
+    @classmethod
+    def create(cls, campaign_dir, manifest, **kwargs):
+        """
+        write the manifest of a new campaign, or open an existing campaign (its manifest is kept, so
+        restarting with the same command resumes the campaign)
+
+        :param campaign_dir: see __init__
+        :param manifest: dictionary from make_manifest
+        :param kwargs: passed to __init__
+        :return: ShotScheduler instance
+        """
+        if not os.path.exists(campaign_dir):
+            try:
+                os.makedirs(campaign_dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        manifest_file = os.path.join(campaign_dir, MANIFEST_NAME)
+        if not os.path.exists(manifest_file):
+            tmp_file = "%s.%s.%d" % (manifest_file, socket.gethostname(), os.getpid())
+            with open(tmp_file, "w") as fout:
+                json.dump(manifest, fout)
+            try:
+                os.link(tmp_file, manifest_file)  # fails if another process created the manifest first
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(tmp_file)
+        sched = cls(campaign_dir, **kwargs)
+        if sched.manifest["num_shots"] != manifest["num_shots"]:
+            print("Warning: resuming campaign %s with its existing manifest of %d shots"
+                  % (campaign_dir, sched.manifest["num_shots"]))
+        return sched
+
+    def unit_shots(self, unit):
+        """
+        :param unit: work unit index
+        :return: list of shot dictionaries (see make_manifest) in the unit
+        """
+        per_unit = self.manifest["shots_per_unit"]
+        return self.manifest["shots"][unit*per_unit: (unit+1)*per_unit]
+
+    def output_filename(self, unit):
+        return shard_filename(self.prefix, unit)
+
+    def _lock_filename(self, unit):
+        return "%s_%05d.lock" % (self.prefix, unit)
+
+    def is_done(self, unit):
+        return os.path.exists(self.output_filename(unit))
+
+    def _read_lease(self, lock_file):
+        """
+        :return: (owner dictionary, modification time) of a lock file, or None if it is gone
+        """
+        try:
+            mtime = os.path.getmtime(lock_file)
+            with open(lock_file, "r") as fin:
+                owner = json.load(fin)
+        except (OSError, IOError, ValueError):
+            return None
+        return owner, mtime
+
+    def _lease_is_stale(self, owner, mtime):
+        if time.time() - mtime > self.lease_timeout:
+            return True
+        if owner.get("host") == self._hostname:
+            try:
+                os.kill(owner["pid"], 0)
+            except OSError as err:
+                return err.errno == errno.ESRCH
+        return False
+
+    def _remove_lock(self, lock_file, token, mtime=None):
+        """
+        remove a lock file, but only if it still holds the lease with this token (and modification time).
+        The lock is first renamed to a name private to this process (atomic, only one process gets it),
+        then checked, and put back if it turned out to be another lease
+
+        :return: True if the lock was removed
+        """
+        private_file = "%s.remove.%s.%d" % (lock_file, self._hostname, os.getpid())
+        try:
+            os.rename(lock_file, private_file)
+        except OSError:
+            return False
+        lease = self._read_lease(private_file)
+        if lease is not None and lease[0].get("token") == token and (mtime is None or lease[1] == mtime):
+            os.remove(private_file)
+            return True
+        try:
+            os.link(private_file, lock_file)
+        except OSError:
+            pass  # yet another process locked the unit meanwhile, the owner of the moved lease notices in renew
+        os.remove(private_file)
+        return False
+
+    def _create_lock(self, lock_file, token):
+        """
+        :return: True if the lock file was created. It is written under a temporary name and hard linked into
+            place (fails if the lock exists, atomic on local and network filesystems), so it is never seen empty
+        """
+        tmp_file = "%s.tmp.%s.%d" % (lock_file, self._hostname, os.getpid())
+        with open(tmp_file, "w") as fout:
+            json.dump({"host": self._hostname, "pid": os.getpid(), "time": time.time(), "token": token}, fout)
+        try:
+            os.link(tmp_file, lock_file)
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return False
+            raise
+        finally:
+            os.remove(tmp_file)
+        return True
+
+    def lease(self, unit):
+        """
+        :param unit: work unit index
+        :return: True if this process now holds the unit
+        """
+        if self.is_done(unit):
+            return False
+        lock_file = self._lock_filename(unit)
+        lease = self._read_lease(lock_file)
+        if lease is not None and self._lease_is_stale(*lease):
+            if not self._remove_lock(lock_file, lease[0].get("token"), lease[1]):
+                return False  # renewed, or taken over by another worker
+        token = uuid.uuid4().hex
+        if not self._create_lock(lock_file, token):
+            return False
+        self._tokens[unit] = token
+        if self.is_done(unit):  # finished by another worker between the check and the lock
+            self.release(unit)
+            return False
+        return True
+
+    def owns(self, unit):
+        """
+        :param unit: work unit index
+        :return: True if this process still holds the lease of the unit (it is lost once another worker
+            takes over the lease as stale)
+        """
+        token = self._tokens.get(unit)
+        lease = self._read_lease(self._lock_filename(unit))
+        return token is not None and lease is not None and lease[0].get("token") == token
+
+    def renew(self, unit):
+        """
+        keep the lease of a unit alive (call regularly while simulating it)
+
+        :return: False if the lease was lost, then stop working on the unit
+        """
+        if not self.owns(unit):
+            return False
+        os.utime(self._lock_filename(unit), None)
+        return True
+
+    def release(self, unit):
+        """give up the lease of a unit, a lease taken over by another worker is left alone"""
+        token = self._tokens.pop(unit, None)
+        if token is not None:
+            self._remove_lock(self._lock_filename(unit), token)
+
+    def next_unit(self):
+        """
+        :return: index of a unit now leased by this process, or None if every unit is done or leased
+        """
+        for unit in range(self.num_units):
+            if self.lease(unit):
+                return unit
+        return None
+
+    def status(self):
+        """
+        :return: dictionary with the number of done, leased and pending units
+        """
+        done = sum(self.is_done(unit) for unit in range(self.num_units))
+        leased = sum(not self.is_done(unit) and os.path.exists(self._lock_filename(unit))
+                     for unit in range(self.num_units))
+        return {"done": done, "leased": leased, "pending": self.num_units - done - leased}
+
+    def finalize(self, master_filename=None):
+        """
+        once every unit is done, stitch the unit outputs into one master file (see shards.finalize_shards).
+        Only the first process to call this writes the master file, so every worker can call it when it runs out
+        of units (remove <campaign_dir>/unit_finalize.lock to write it again)
+
+        :param master_filename: defaults to <campaign_dir>/unit_master.h5
+        :return: name of the master file, or None if another process finalized (or is finalizing) the campaign
+        """
+        status = self.status()
+        if status["done"] != self.num_units:
+            raise RuntimeError("Campaign %s is not finished: %s" % (self.campaign_dir, status))
+        lock_file = "%s_finalize.lock" % self.prefix
+        try:
+            os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError as err:
+            if err.errno == errno.EEXIST:
+                return None
+            raise
+        try:
+            return finalize_shards(self.prefix, master_filename)
+        except BaseException:
+            os.remove(lock_file)
+            raise
+
+
+def run_worker(scheduler, simulate, detector, beam, image_shape, max_units=None, verbose=True, **writer_kwargs):
+    """
+    pull work units until none are left, writing one file per unit with H5AttributeGeomWriter.
+    Start as many of these as you like, on one or many hosts, pointing at the same campaign folder
+
+    :param scheduler: ShotScheduler instance
+    :param simulate: function taking a shot dictionary (see make_manifest) and returning the image
+        (Npanel x Nslow x Nfast)
+    :param detector: dxtbx detector model (stored in the output files)
+    :param beam: dxtbx beam model (stored in the output files)
+    :param image_shape: shape of one image
+    :param max_units: stop after this many units (default is to run until the campaign is done)
+    :param verbose: print progress
+    :param writer_kwargs: other arguments of H5AttributeGeomWriter, e.g. dtype and compression_args
+    :return: list of the units this worker completed
+    """
+    from nanoBragg_multipanel.utils import H5AttributeGeomWriter
+    completed = []
+    while max_units is None or len(completed) < max_units:
+        unit = scheduler.next_unit()
+        if unit is None:
+            break
+        shots = scheduler.unit_shots(unit)
+        out_file = scheduler.output_filename(unit)
+        # written under a temporary name, so a unit only counts as done once its file is complete
+        tmp_file = "%s.tmp.%s.%d" % (out_file, socket.gethostname(), os.getpid())
+        tstart = time.time()
+        lease_lost = False
+        try:
+            with H5AttributeGeomWriter(tmp_file, image_shape=image_shape, num_images=len(shots),
+                                       detector=detector, beam=beam, **writer_kwargs) as writer:
+                for shot in shots:
+                    writer.add_image(simulate(shot))
+                    if not scheduler.renew(unit):
+                        lease_lost = True
+                        break
+            if lease_lost or not scheduler.owns(unit):
+                lease_lost = True
+                os.remove(tmp_file)
+            else:
+                os.rename(tmp_file, out_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        finally:
+            scheduler.release(unit)
+        if lease_lost:
+            if verbose:
+                print("Lost the lease of unit %d (taken over as stale), leaving it to its new owner" % unit)
+            continue
+        completed.append(unit)
+        if verbose:
+            print("Unit %d (%d shots) done in %.2f seconds, campaign status: %s"
+                  % (unit, len(shots), time.time()-tstart, scheduler.status()))
+    return completed
@@ -0,0 +1,96 @@
+from __future__ import print_function
+
+import os
+import glob
+import h5py
+
+# per-shot datasets (first axis is the image index) that are stitched into the master alongside images
+PER_SHOT_DSETS = ["images", "spectrum_energies", "spectrum_weights", "central_wavelengths"]
+GEOM_ATTRS = ["dxtbx_detector_string", "dxtbx_beam_string"]
+# image encoding attributes (see H5AttributeGeomWriter), must match across shards when present
+ENCODING_ATTRS = ["encoding", "gain_divisors", "untrusted_value"]
+
+
+def shard_filename(prefix, rank):
+    """
+    :param prefix: output prefix shared by all workers, e.g. "jungfrau_run1"
+    :param rank: index of the worker writing the shard
+    :return: name of the shard file the worker should write with H5AttributeGeomWriter
+    """
+    return "%s_shard%05d.h5" % (prefix, rank)
+
+
+def write_master(master_filename, shard_filenames):
+    """
+    Create a master file whose datasets are HDF5 virtual datasets spanning all shards, in order.
+    No image data are copied; the master can be opened with FormatHDF5AttributeGeometry as if it were
+    a single file written by H5AttributeGeomWriter. Shards are referenced by paths relative to the master,
+    so keep them next to each other when moving the files.
+
+    :param master_filename: path of the master file to create
+    :param shard_filenames: list of shard files written by H5AttributeGeomWriter
+    :return: total number of images in the master
+    """
+    if not shard_filenames:
+        raise ValueError("No shard files given")
+    master_dir = os.path.dirname(os.path.abspath(master_filename))
+
+    # collect the per-shot datasets of every shard, and check they are consistent
+    layouts = {}
+    geom_attrs = None
+    for fname in shard_filenames:
+        with h5py.File(fname, "r") as h:
+            if "images" not in h:
+                raise KeyError("Shard %s has no images dataset" % fname)
+            # a resizable shard can be allocated past the last image it holds
+            num_shots = int(h["images"].attrs.get("num_images_written", h["images"].shape[0]))
+            attrs = {name: h["images"].attrs[name] for name in GEOM_ATTRS}
+            attrs.update({name: h["images"].attrs[name] for name in ENCODING_ATTRS if name in h["images"].attrs})
+            if geom_attrs is None:
+                geom_attrs = attrs
+            elif attrs != geom_attrs:
+                raise ValueError("Shard %s has a different detector, beam or encoding than the first shard" % fname)
+            relname = os.path.relpath(os.path.abspath(fname), master_dir)
+            for name in PER_SHOT_DSETS:
+                if name not in h:
+                    continue
+                dset = h[name]
+                if dset.shape[0] < num_shots:
+                    raise ValueError("%s in shard %s does not have one entry per image" % (name, fname))
+                layouts.setdefault(name, []).append((relname, dset.shape, dset.dtype, num_shots))
+
+    num_images = sum(count for _, _, _, count in layouts["images"])
+    with h5py.File(master_filename, "w") as master:
+        for name, sources in layouts.items():
+            if len(sources) != len(shard_filenames):
+                raise ValueError("%s is only present in some of the shards" % name)
+            item_shapes = set(shape[1:] for _, shape, _, _ in sources)
+            dtypes = set(dtype for _, _, dtype, _ in sources)
+            if len(item_shapes) != 1 or len(dtypes) != 1:
+                raise ValueError("%s has inconsistent shapes or dtypes across shards" % name)
+            layout = h5py.VirtualLayout(shape=(num_images,) + item_shapes.pop(), dtype=dtypes.pop())
+            start = 0
+            for relname, shape, _, count in sources:
+                layout[start: start+count] = h5py.VirtualSource(relname, name, shape=shape)[:count]
+                start += count
+            master.create_virtual_dataset(name, layout, fillvalue=0)
+        for attr_name, value in geom_attrs.items():
+            master["images"].attrs[attr_name] = value
+        master["images"].attrs["num_images_written"] = num_images
+    return num_images
+
+
+def finalize_shards(prefix, master_filename=None):
+    """
+    build the master file for all shards written with shard_filename(prefix, rank)
+
+    :param prefix: output prefix shared by all workers
+    :param master_filename: defaults to prefix + "_master.h5"
+    :return: name of the master file
+    """
+    if master_filename is None:
+        master_filename = "%s_master.h5" % prefix
+    shard_filenames = sorted(glob.glob("%s_shard[0-9][0-9][0-9][0-9][0-9].h5" % prefix))
+    num_images = write_master(master_filename, shard_filenames)
+    print("Wrote %s spanning %d images in %d shards" % (master_filename, num_images, len(shard_filenames)))
+    return master_filename
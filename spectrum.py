@@ -0,0 +1,172 @@
+from __future__ import print_function
+
+import numpy as np
+
+ENERGY_CONV = 12398.419739640716  # eV * Angstrom
+
+
+def _channels_from_groups(energies, weights, groups):
+    """flux-weighted mean energy and summed flux of each group of spectrum lines"""
+    chan_E = np.array([np.average(energies[g], weights=weights[g]) for g in groups])
+    chan_w = np.array([weights[g].sum() for g in groups])
+    return chan_E, chan_w
+
+
+def _quantile_groups(weights, num_channels):
+    """split lines (sorted by energy) into groups carrying roughly equal flux"""
+    cdf = np.cumsum(weights) / weights.sum()
+    # assign each line to a channel by the flux fraction at its center
+    center = cdf - 0.5*weights/weights.sum()
+    labels = np.minimum((center*num_channels).astype(int), num_channels-1)
+    return [np.where(labels == i)[0] for i in np.unique(labels)]
+
+
+def _merge_sequence(energies, weights):
+    """
+    greedy merging of neighboring lines, always merging the pair that least increases the
+    flux-weighted energy variance (Ward's criterion)
+    yields the groups after each merge, starting with one line per group
+    """
+    groups = [[i] for i in range(len(energies))]
+    w = weights.astype(np.float64).copy()
+    E = energies.astype(np.float64).copy()
+    yield [np.array(g) for g in groups]
+    while len(groups) > 1:
+        cost = w[:-1]*w[1:] / (w[:-1] + w[1:]) * (E[:-1] - E[1:])**2
+        i = int(np.argmin(cost))
+        wsum = w[i] + w[i+1]
+        E[i] = (w[i]*E[i] + w[i+1]*E[i+1]) / wsum
+        w[i] = wsum
+        E = np.delete(E, i+1)
+        w = np.delete(w, i+1)
+        groups[i] = groups[i] + groups.pop(i+1)
+        yield [np.array(g) for g in groups]
+
+
+def spectrum_intensity_error(energies, weights, chan_energies, chan_weights, kernel_rel=0.005):
+    """
+    Estimate how much a reduced spectrum changes spot intensities. A Bragg reflection integrates the
+    spectrum over a small energy window (set by mosaicity and domain size), so both spectra are
+    smoothed with a gaussian of that width and compared.
+
+    :param energies: energies of the original spectrum (eV)
+    :param weights: fluxes of the original spectrum
+    :param chan_energies: energies of the reduced spectrum (eV)
+    :param chan_weights: fluxes of the reduced spectrum
+    :param kernel_rel: width (sigma) of the energy window a reflection integrates, relative to the mean energy
+    :return: relative L1 difference between the smoothed spectra (0 means identical)
+    """
+    energies = np.asarray(energies, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    mean_E = np.average(energies, weights=weights)
+    sigma = kernel_rel*mean_E
+    grid = np.linspace(energies.min()-4*sigma, energies.max()+4*sigma, 2048)
+
+    def smooth(E, w):
+        return (w[:, None]*np.exp(-0.5*((grid[None] - E[:, None])/sigma)**2)).sum(0)
+
+    orig = smooth(energies, weights)
+    reduced = smooth(np.asarray(chan_energies, dtype=np.float64), np.asarray(chan_weights, dtype=np.float64))
+    return np.abs(orig-reduced).sum() / orig.sum()
+
+
+def compress_spectrum(wavelengths, weights, num_channels=None, tolerance=None, method="merge",
+                      kernel_rel=0.005):
+    """
+    Re-bin a spectrum into fewer energy channels. Each channel sits at the flux-weighted mean energy
+    of the lines it replaces and carries their summed flux, so the total flux and the mean energy of
+    the spectrum are conserved.
+
+    :param wavelengths: wavelengths in Angstrom
+    :param weights: flux (or relative weight) of each wavelength
+    :param num_channels: number of channels in the reduced spectrum
+    :param tolerance: instead of num_channels, use the fewest channels whose intensity error
+        (see spectrum_intensity_error) is at most this value, e.g. 0.01. Only for method "merge"
+    :param method: "merge" (greedy merging of neighboring lines, minimizing energy variance)
+        or "quantile" (channels carrying equal flux)
+    :param kernel_rel: see spectrum_intensity_error
+    :return: reduced wavelengths (Angstrom), reduced weights, intensity error
+    """
+    if (num_channels is None) == (tolerance is None):
+        raise ValueError("Specify exactly one of num_channels or tolerance")
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    keep = weights > 0
+    energies = ENERGY_CONV / wavelengths[keep]
+    weights = weights[keep]
+    order = np.argsort(energies)
+    energies = energies[order]
+    weights = weights[order]
+
+    if method == "quantile":
+        if num_channels is None:
+            raise ValueError("method quantile requires num_channels")
+        groups = _quantile_groups(weights, min(int(num_channels), len(energies)))
+        chan_E, chan_w = _channels_from_groups(energies, weights, groups)
+    elif method == "merge":
+        chan_E, chan_w = energies, weights
+        for groups in _merge_sequence(energies, weights):
+            E, w = _channels_from_groups(energies, weights, groups)
+            if num_channels is not None:
+                chan_E, chan_w = E, w
+                if len(groups) <= num_channels:
+                    break
+            else:
+                if spectrum_intensity_error(energies, weights, E, w, kernel_rel) > tolerance:
+                    break
+                chan_E, chan_w = E, w
+    else:
+        raise ValueError("Unknown method %s" % method)
+
+    err = spectrum_intensity_error(energies, weights, chan_E, chan_w, kernel_rel)
+    order = np.argsort(chan_E)[::-1]  # return in increasing wavelength, like the input files
+    return ENERGY_CONV / chan_E[order], chan_w[order], err
+
+
+def sase_spectra(num_shots, central_energy_eV, bandwidth_eV=25, spike_width_eV=2, num_channels=256,
+                 energy_jitter_eV=0, seed=None):
+    """
+    Random SASE (self-amplified spontaneous emission) spectra for many shots at once. Each spectrum is a
+    gaussian envelope (the average spectrum) multiplied by the intensity of a complex gaussian random field
+    whose correlation length is spike_width_eV, giving the spiky, shot-to-shot varying lines of an XFEL pulse
+
+    :param num_shots: number of spectra
+    :param central_energy_eV: mean photon energy (eV)
+    :param bandwidth_eV: full width at half maximum of the average spectrum (eV)
+    :param spike_width_eV: full width at half maximum of the individual spikes (eV)
+    :param num_channels: number of energy channels, spanning 4 bandwidths around the central energy
+    :param energy_jitter_eV: standard deviation of the shot-to-shot jitter of the envelope center (eV)
+    :param seed: seed for the random number generator
+    :return: energies (num_shots x num_channels, eV) and weights (num_shots x num_channels, each row sums to 1),
+        the layout of the spectrum_energies and spectrum_weights datasets (see H5AttributeGeomWriter)
+    """
+    rng = np.random.default_rng(seed)
+    energies = central_energy_eV + np.linspace(-2*bandwidth_eV, 2*bandwidth_eV, num_channels)
+    dE = energies[1] - energies[0]
+
+    # white complex noise, correlated over the spike width by a gaussian filter in the fourier domain
+    noise = rng.standard_normal((num_shots, num_channels)) + 1j*rng.standard_normal((num_shots, num_channels))
+    sigma_spike = spike_width_eV / 2.3548
+    freqs = np.fft.fftfreq(num_channels, d=dE)
+    field = np.fft.ifft(np.fft.fft(noise, axis=1) * np.exp(-2*(np.pi*freqs*sigma_spike)**2), axis=1)
+
+    centers = central_energy_eV + energy_jitter_eV*rng.standard_normal(num_shots)
+    sigma_bw = bandwidth_eV / 2.3548
+    envelope = np.exp(-0.5*((energies[None] - centers[:, None]) / sigma_bw)**2)
+    weights = envelope * np.abs(field)**2
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.repeat(energies[None], num_shots, axis=0), weights
+
+
+def to_wavelengths(energies, weights, min_weight_frac=1e-3):
+    """
+    :param energies: energies of one spectrum (eV), e.g. a row from sase_spectra
+    :param weights: weights of one spectrum
+    :param min_weight_frac: drop channels whose weight is below this fraction of the largest weight
+        (they cost simulation time but add almost nothing)
+    :return: wavelengths (Angstrom) and weights, to pass to sim_spots / SimulationPool.simulate_shot
+    """
+    energies = np.asarray(energies, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    keep = weights >= min_weight_frac*weights.max()
+    return ENERGY_CONV / energies[keep], weights[keep]
@@ -0,0 +1,188 @@
+from __future__ import print_function
+
+import sys
+import time
+import numpy as np
+
+
+class _SharedFhkl:
+    """picklable handle to the arrays of a PreparedFhkl placed in shared memory, see PreparedFhkl.share"""
+
+    def __init__(self, unit_cell_tuple, indices_name, amplitudes_name, num_refl, prepare_time):
+        self.unit_cell_tuple = unit_cell_tuple
+        self.indices_name = indices_name
+        self.amplitudes_name = amplitudes_name
+        self.num_refl = num_refl
+        self.prepare_time = prepare_time
+
+
+def _attach_shared_memory(name):
+    """
+    attach to a shared memory segment created by another process, without registering it with the
+    resource tracker: only the creating process (see PreparedFhkl.share / unshare) may unlink it.
+    Before python 3.13 attaching always registers the segment, so registering is switched off meanwhile
+    """
+    from multiprocessing import shared_memory
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class PreparedFhkl:
+
+    def __init__(self, unit_cell_tuple, indices, amplitudes, prepare_time=0):
+        """
+        Structure factors in the form nanoBragg ingests them (P1 miller indices and amplitudes), prepared once
+        and attached to any number of nanoBragg instances, panels and shots. Use from_miller_array to build one.
+        Can be passed as Famp to sim_spots, PanelSimulatorSession and SimulationPool (which shares the arrays
+        with its workers through shared memory)
+
+        :param unit_cell_tuple: unit cell parameters (a, b, c, alpha, beta, gamma)
+        :param indices: numpy array of P1 miller indices (N x 3)
+        :param amplitudes: numpy array of structure factor amplitudes (N)
+        :param prepare_time: seconds spent preparing the arrays (reported by report)
+        """
+        self.unit_cell_tuple = tuple(unit_cell_tuple)
+        self.indices = indices
+        self.amplitudes = amplitudes
+        self.prepare_time = prepare_time
+        self.attach_time = 0
+        self.num_attached = 0
+        self._flex = None
+        self._shm = []
+        self._owns_shm = True
+
+    @classmethod
+    def from_miller_array(cls, Famp, generate_friedel_mates=False):
+        """
+        :param Famp: cctbx miller array of structure factor amplitudes, expanded to P1 here (once)
+        :param generate_friedel_mates: add Friedel mates to a non-anomalous array
+            (by default the indices are used as is, which matches SIM.Fhkl = Famp for a P1 array)
+        :return: PreparedFhkl instance
+        """
+        tstart = time.time()
+        ma = Famp.expand_to_p1()
+        if generate_friedel_mates and not ma.anomalous_flag():
+            ma = ma.generate_bijvoet_mates()
+        indices = np.array(ma.indices(), dtype=np.int32).reshape((-1, 3))
+        amplitudes = np.array(ma.data(), dtype=np.float64)
+        prepared = cls(ma.unit_cell().parameters(), indices, amplitudes)
+        prepared._flex = ma.indices(), ma.data()
+        prepared.prepare_time = time.time() - tstart
+        return prepared
+
+    @property
+    def flex_tuple(self):
+        """miller indices and amplitudes as flex arrays, built once per process"""
+        if self._flex is None:
+            from cctbx.array_family import flex
+            self._flex = (flex.miller_index([tuple(hkl) for hkl in self.indices.tolist()]),
+                          flex.double(np.ascontiguousarray(self.amplitudes)))
+        return self._flex
+
+    def attach(self, SIM):
+        """
+        set the structure factors of a nanoBragg instance. Like SIM.Fhkl = Famp this also sets the unit cell,
+        so do it before setting Amatrix
+
+        :param SIM: nanoBragg instance
+        """
+        tstart = time.time()
+        SIM.unit_cell_tuple = self.unit_cell_tuple
+        SIM.Fhkl_tuple = self.flex_tuple
+        self.attach_time += time.time() - tstart
+        self.num_attached += 1
+
+    @property
+    def hkl_min(self):
+        return self.indices.min(axis=0)
+
+    @property
+    def grid_shape(self):
+        return tuple(self.indices.max(axis=0) - self.hkl_min + 1)
+
+    @property
+    def grid_bytes(self):
+        """memory of the dense h,k,l grid nanoBragg builds from these structure factors (8 bytes per grid point)"""
+        return int(np.prod(self.grid_shape)) * 8
+
+    def share(self):
+        """
+        copy the arrays to shared memory, release them with unshare once every process is done
+
+        :return: picklable handle, rebuild the PreparedFhkl in another process with from_shared
+        """
+        from multiprocessing import shared_memory
+        names = []
+        for arr in (self.indices, self.amplitudes):
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+            self._shm.append(shm)
+            names.append(shm.name)
+        return _SharedFhkl(self.unit_cell_tuple, names[0], names[1], len(self.amplitudes), self.prepare_time)
+
+    @classmethod
+    def from_shared(cls, handle):
+        """
+        :param handle: returned by share (in another process)
+        :return: PreparedFhkl whose arrays are read-only views of the shared memory
+        """
+        shm_indices = _attach_shared_memory(handle.indices_name)
+        shm_amplitudes = _attach_shared_memory(handle.amplitudes_name)
+        indices = np.ndarray((handle.num_refl, 3), dtype=np.int32, buffer=shm_indices.buf)
+        amplitudes = np.ndarray((handle.num_refl,), dtype=np.float64, buffer=shm_amplitudes.buf)
+        indices.flags.writeable = False
+        amplitudes.flags.writeable = False
+        prepared = cls(handle.unit_cell_tuple, indices, amplitudes, handle.prepare_time)
+        prepared._shm = [shm_indices, shm_amplitudes]  # keep the buffers alive as long as the views
+        prepared._owns_shm = False
+        return prepared
+
+    def unshare(self):
+        """free the shared memory created by share (in a process that attached with from_shared, just detach)"""
+        for shm in self._shm:
+            shm.close()
+            if self._owns_shm:
+                shm.unlink()
+        self._shm = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_flex"] = None
+        state["_shm"] = []
+        state["_owns_shm"] = True
+        state["indices"] = np.array(self.indices)
+        state["amplitudes"] = np.array(self.amplitudes)
+        return state
+
+    def report(self):
+        """
+        print the one-time preparation cost and the time spent attaching to nanoBragg instances in this process
+        """
+        print("Prepared %d structure factors in %.4f seconds (dense grid %s, %.1f MB); attached %d times, %.4f seconds"
+              % (len(self.amplitudes), self.prepare_time, "x".join(str(n) for n in self.grid_shape),
+                 self.grid_bytes / 1e6, self.num_attached, self.attach_time))
+
+
+def prepare_structure_factors(Famp, generate_friedel_mates=False, verbose=False):
+    """
+    :param Famp: cctbx miller array, a float default amplitude, or a list of those (one per panel,
+        see resolution.prune_structure_factors)
+    :param generate_friedel_mates: see PreparedFhkl.from_miller_array
+    :param verbose: print the preparation time
+    :return: PreparedFhkl (or a list with one entry per panel), floats are passed through
+    """
+    if isinstance(Famp, (list, tuple)):
+        return [prepare_structure_factors(F, generate_friedel_mates, verbose) for F in Famp]
+    if isinstance(Famp, (float, PreparedFhkl)):
+        return Famp
+    prepared = PreparedFhkl.from_miller_array(Famp, generate_friedel_mates)
+    if verbose:
+        prepared.report()
+    return prepared
@@ -0,0 +1,101 @@
+"""
+Tests of the integer image encodings of utils.encode_image and H5AttributeGeomWriter (no cctbx needed), run from
+the folder containing nanoBragg_multipanel:
+
+  libtbx.python -m pytest nanoBragg_multipanel/tests
+"""
+from __future__ import print_function
+
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+from nanoBragg_multipanel.utils import (encode_image, H5AttributeGeomWriter, JUNGFRAU_ADC_MAX, JUNGFRAU_GAIN_DIVISORS,
+                                        UNTRUSTED_VALUES, _trusted_range_arrays)
+
+TRUSTED_RANGE = (-1, 1e6)
+DETECTOR = {"panels": [{"trusted_range": TRUSTED_RANGE}, {"trusted_range": TRUSTED_RANGE}]}
+IMAGE_SHAPE = (2, 3, 4)
+
+
+def _decode(encoded, encoding, gain_divisors=JUNGFRAU_GAIN_DIVISORS):
+    """same decoding as FormatHDF5AttributeGeometry (which needs dxtbx to import)"""
+    encoded = np.asarray(encoded)
+    if encoding == "jungfrau":
+        stage = np.array([0, 1, 2, 2])[encoded >> 14]
+        decoded = (encoded & JUNGFRAU_ADC_MAX)*np.array(gain_divisors)[stage]
+    else:
+        decoded = encoded.astype(np.float64)
+    if encoding in UNTRUSTED_VALUES:
+        decoded[encoded == UNTRUSTED_VALUES[encoding]] = TRUSTED_RANGE[0]
+    return decoded
+
+
+@pytest.mark.parametrize("encoding", ["uint16", "int32"])
+def test_integer_round_trip(encoding):
+    image = np.array([0, 0.4, 1.6, 10, 12345.3, 65534])
+    assert np.all(_decode(encode_image(image, encoding), encoding) == np.rint(image))
+
+
+def test_jungfrau_round_trip():
+    image = np.array([0, 3.2, JUNGFRAU_ADC_MAX, 2e4, 3e5, 5e6])
+    decoded = _decode(encode_image(image, "jungfrau"), "jungfrau")
+    # each gain stage rounds to its own ADC step
+    stage = np.searchsorted(JUNGFRAU_ADC_MAX*np.array(JUNGFRAU_GAIN_DIVISORS[:2]), image)
+    assert np.all(np.abs(decoded - image) <= np.array(JUNGFRAU_GAIN_DIVISORS)[stage] / 2.)
+    # saturates in the last stage, one below the untrusted value
+    assert encode_image([1e9], "jungfrau")[0] == UNTRUSTED_VALUES["jungfrau"] - 1
+
+
+def test_saturation():
+    trusted_range = _trusted_range_arrays(DETECTOR)
+    image = np.full(IMAGE_SHAPE, 2e6)
+    assert np.all(encode_image(image, "int32", trusted_range) == TRUSTED_RANGE[1])
+    assert np.all(encode_image(image, "uint16") == UNTRUSTED_VALUES["uint16"] - 1)
+
+
+@pytest.mark.parametrize("encoding", ["uint16", "jungfrau"])
+def test_untrusted_pixels(encoding):
+    image = np.zeros(IMAGE_SHAPE)
+    image[0, 0, 0] = -1  # e.g. a gap
+    # a valid pixel that would be stored as the untrusted value
+    image[1, 0, 0] = UNTRUSTED_VALUES[encoding] if encoding == "uint16" else JUNGFRAU_ADC_MAX*JUNGFRAU_GAIN_DIVISORS[2]
+    encoded = encode_image(image, encoding)
+    assert np.flatnonzero(encoded == UNTRUSTED_VALUES[encoding]).tolist() == [0]
+    decoded = _decode(encoded, encoding)
+    assert decoded[0, 0, 0] == TRUSTED_RANGE[0]
+    assert np.all(decoded[1] >= 0)
+
+
+def test_int32_keeps_negative_pixels():
+    image = -np.ones(IMAGE_SHAPE)
+    assert np.all(encode_image(image, "int32", _trusted_range_arrays(DETECTOR)) == -1)
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        encode_image(np.zeros(3), "float8")
+
+
+def test_writer_encoding(tmpdir):
+    filename = str(tmpdir.join("encoded.h5"))
+    images = np.random.RandomState(0).uniform(0, 1e5, size=(3,) + IMAGE_SHAPE)
+    images[:, 0, 1, 1] = -1
+    with H5AttributeGeomWriter(filename, IMAGE_SHAPE, 3, DETECTOR, {}, detector_and_beam_are_dicts=True,
+                               encoding="jungfrau") as writer:
+        writer.add_images(images)
+    with h5py.File(filename, "r") as h:
+        dset = h["images"]
+        assert dset.dtype == np.uint16
+        assert dset.attrs["encoding"] == "jungfrau"
+        assert dset.attrs["untrusted_value"] == UNTRUSTED_VALUES["jungfrau"]
+        gain_divisors = json.loads(dset.attrs["gain_divisors"])
+        decoded = _decode(dset[()], "jungfrau", gain_divisors)
+    assert np.all(decoded[:, 0, 1, 1] == TRUSTED_RANGE[0])
+    assert np.allclose(decoded[images >= 0], images[images >= 0], atol=max(JUNGFRAU_GAIN_DIVISORS) / 2.)
+
+    with pytest.raises(ValueError):
+        H5AttributeGeomWriter(filename, IMAGE_SHAPE, 1, DETECTOR, {}, detector_and_beam_are_dicts=True,
+                              mode="a", encoding="uint16")
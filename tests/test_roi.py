@@ -0,0 +1,55 @@
+"""
+Tests of the region of interest simulation of roi.py (needs cctbx, dxtbx and simtbx), run from the folder
+containing nanoBragg_multipanel:
+
+  libtbx.python -m pytest nanoBragg_multipanel/tests
+"""
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+pytest.importorskip("simtbx")
+
+from dxtbx.model import BeamFactory, Crystal, DetectorFactory
+
+from nanoBragg_multipanel.roi import get_panel_rois, predict_spots
+from nanoBragg_multipanel.utils import sim_spots
+
+WAVELENGTHS = [1.29, 1.3, 1.31]
+WEIGHTS = [0.5, 1, 0.5]
+
+
+def _models():
+    detector = DetectorFactory.simple("PAD", 80, (12.8, 12.8), "+x", "-y", (0.1, 0.1), (256, 256))
+    beam = BeamFactory.simple(1.3)
+    crystal = Crystal((79.1, 3.2, -1.7), (-3.1, 78.8, 4.0), (0.9, -1.9, 38.2), space_group_symbol="P1")
+    from cctbx import crystal as cctbx_crystal
+    from cctbx.array_family import flex
+    symm = cctbx_crystal.symmetry(crystal.get_unit_cell(), "P1")
+    mset = symm.build_miller_set(anomalous_flag=True, d_min=2)
+    Famp = mset.array(data=flex.double(mset.size(), 100.)).set_observation_type_xray_amplitude()
+    return crystal, detector, beam, Famp
+
+
+def _simulate(crystal, detector, beam, Famp, rois):
+    return sim_spots(crystal, detector, beam, Famp, WAVELENGTHS, WEIGHTS, 1e12, mosaic_vol_A3=1000**3,
+                     add_noise=False, time_panels=False, rois=rois)
+
+
+def test_rois_match_full_panel():
+    crystal, detector, beam, Famp = _models()
+    fast_px, slow_px = predict_spots(crystal, detector, beam, WAVELENGTHS, WEIGHTS, Famp=Famp)[0]
+    rois = get_panel_rois(fast_px, slow_px, detector[0].get_image_size(), pad=10)
+    assert rois
+
+    full = _simulate(crystal, detector, beam, Famp, None)
+    sparse = _simulate(crystal, detector, beam, Famp, rois)
+    inside = np.zeros(full.shape, bool)
+    for fmin, fmax, smin, smax in rois:
+        inside[smin:smax+1, fmin:fmax+1] = True
+    assert np.allclose(sparse[inside], full[inside])
+    assert np.all(sparse[~inside] == 0)
+    assert full[inside].sum() > 0.9*full.sum()
+
+    assert np.all(_simulate(crystal, detector, beam, Famp, []) == 0)
@@ -0,0 +1,140 @@
+"""
+Tests of the lease, stale takeover and finalize logic of scheduler.py (no cctbx needed), run from the folder
+containing nanoBragg_multipanel:
+
+  libtbx.python -m pytest nanoBragg_multipanel/tests
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from nanoBragg_multipanel.noise import DEFAULT_CALIB_SEED
+from nanoBragg_multipanel.scheduler import ShotScheduler, make_manifest, run_worker
+
+IMAGE_SHAPE = (2, 4, 5)
+
+
+def _manifest(num_shots=4, shots_per_unit=2):
+    shots = [{"index": i, "rotation": np.eye(3).ravel().tolist(), "noise_seed": i+1} for i in range(num_shots)]
+    return {"num_shots": num_shots, "shots_per_unit": shots_per_unit,
+            "num_units": int(np.ceil(num_shots / float(shots_per_unit))), "random_state": 0, "shots": shots}
+
+
+def _simulate(shot):
+    return np.full(IMAGE_SHAPE, shot["index"], dtype=np.float32)
+
+
+def _run(scheduler, **kwargs):
+    return run_worker(scheduler, _simulate, {}, {}, IMAGE_SHAPE, verbose=False, detector_and_beam_are_dicts=True,
+                      **kwargs)
+
+
+def _make_stale(scheduler, unit):
+    lock_file = scheduler._lock_filename(unit)
+    old = time.time() - 2*scheduler.lease_timeout
+    os.utime(lock_file, (old, old))
+
+
+@pytest.fixture
+def campaign(tmpdir):
+    return str(tmpdir.join("campaign"))
+
+
+def test_lease_is_exclusive(campaign):
+    first = ShotScheduler.create(campaign, _manifest())
+    second = ShotScheduler(campaign)
+    assert first.next_unit() == 0
+    assert not second.lease(0)
+    assert second.next_unit() == 1
+    assert first.status() == {"done": 0, "leased": 2, "pending": 0}
+    assert first.next_unit() is None
+    first.release(0)
+    assert second.lease(0)
+
+
+def test_release_leaves_other_lease(campaign):
+    first = ShotScheduler.create(campaign, _manifest(), lease_timeout=60)
+    second = ShotScheduler(campaign, lease_timeout=60)
+    assert first.lease(0)
+    _make_stale(first, 0)
+    assert second.lease(0)  # takes over the stale lease
+    assert not first.owns(0)
+    assert not first.renew(0)
+    first.release(0)
+    assert second.owns(0)
+    assert os.path.exists(second._lock_filename(0))
+
+
+def test_stale_takeover_race(campaign):
+    a = ShotScheduler.create(campaign, _manifest(), lease_timeout=60)
+    b = ShotScheduler(campaign, lease_timeout=60)
+    owner = ShotScheduler(campaign, lease_timeout=60)
+    assert owner.lease(0)
+    _make_stale(owner, 0)
+    lock_file = a._lock_filename(0)
+    # b finds the lease stale, but a takes it over before b removes it
+    stale_lease = b._read_lease(lock_file)
+    assert b._lease_is_stale(*stale_lease)
+    assert a.lease(0)
+    assert not b._remove_lock(lock_file, stale_lease[0]["token"], stale_lease[1])
+    assert a.owns(0)
+    assert not b.lease(0)
+
+
+def test_dead_process_lease_is_stale(campaign):
+    sched = ShotScheduler.create(campaign, _manifest(), lease_timeout=3600)
+    lock_file = sched._lock_filename(0)
+    with open(lock_file, "w") as fout:
+        json.dump({"host": sched._hostname, "pid": 2**22 + 1, "time": time.time(), "token": "dead"}, fout)
+    assert sched.lease(0)
+
+
+def test_manifest_calib_seed():
+    manifest = make_manifest(5, shots_per_unit=2)
+    assert manifest["calib_seed"] == DEFAULT_CALIB_SEED
+    assert manifest["num_units"] == 3
+    assert not [shot for shot in manifest["shots"] if "calib_seed" in shot]
+    assert make_manifest(5, calib_seed=7)["calib_seed"] == 7
+
+
+def test_run_worker_and_finalize(campaign):
+    sched = ShotScheduler.create(campaign, _manifest(num_shots=5, shots_per_unit=2))
+    assert _run(sched, max_units=2) == [0, 1]
+    with pytest.raises(RuntimeError):
+        sched.finalize()
+    assert _run(ShotScheduler(campaign)) == [2]
+    assert _run(sched) == []
+    assert sched.status() == {"done": 3, "leased": 0, "pending": 0}
+    assert not [f for f in os.listdir(campaign) if ".tmp." in f or f.endswith(".lock")]
+
+    master = sched.finalize()
+    assert master is not None
+    assert ShotScheduler(campaign).finalize() is None  # only one process writes the master file
+    with h5py.File(master, "r") as h:
+        images = h["images"][()]
+    assert images.shape == (5,) + IMAGE_SHAPE
+    assert np.all(images[:, 0, 0, 0] == np.arange(5))
+
+
+def test_run_worker_lost_lease(campaign):
+    sched = ShotScheduler.create(campaign, _manifest(num_shots=2, shots_per_unit=2), lease_timeout=60)
+    thief = ShotScheduler(campaign, lease_timeout=60)
+
+    def simulate(shot):
+        # the lease is taken over as stale while the first shot is simulated
+        if shot["index"] == 0:
+            _make_stale(sched, 0)
+            assert thief.lease(0)
+        return _simulate(shot)
+
+    completed = run_worker(sched, simulate, {}, {}, IMAGE_SHAPE, max_units=1, verbose=False,
+                           detector_and_beam_are_dicts=True)
+    assert completed == []
+    assert not sched.is_done(0)
+    assert thief.owns(0)
@@ -0,0 +1,86 @@
+"""
+Tests of the virtual dataset master file of shards.py (no cctbx needed), run from the folder containing
+nanoBragg_multipanel:
+
+  libtbx.python -m pytest nanoBragg_multipanel/tests
+"""
+from __future__ import print_function
+
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from nanoBragg_multipanel.shards import finalize_shards, shard_filename, write_master
+from nanoBragg_multipanel.utils import H5AttributeGeomWriter
+
+IMAGE_SHAPE = (2, 3, 4)
+NUM_CHANNELS = 5
+
+
+def _write_shard(filename, first, num, capacity=None, detector=None, spectra=True):
+    if capacity is None:
+        capacity = num
+    writer = H5AttributeGeomWriter(filename, IMAGE_SHAPE, capacity, {} if detector is None else detector, {},
+                                   detector_and_beam_are_dicts=True, resizable=False,
+                                   spectrum_channels=NUM_CHANNELS if spectra else None)
+    with writer:
+        for i in range(first, first+num):
+            energies = np.linspace(9000, 9100, NUM_CHANNELS) + i
+            writer.add_image(np.full(IMAGE_SHAPE, i, dtype=np.float64),
+                             spectrum=(energies, np.ones(NUM_CHANNELS)) if spectra else None)
+
+
+def test_finalize_shards(tmpdir):
+    prefix = str(tmpdir.join("run"))
+    _write_shard(shard_filename(prefix, 0), 0, 3)
+    # a shard whose datasets were allocated past the last image written
+    _write_shard(shard_filename(prefix, 1), 3, 2, capacity=4)
+    with h5py.File(shard_filename(prefix, 1), "r") as h:
+        assert h["images"].shape[0] == 4
+        assert h["images"].attrs["num_images_written"] == 2
+
+    master = finalize_shards(prefix)
+    assert master == prefix + "_master.h5"
+    with h5py.File(master, "r") as h:
+        assert h["images"].is_virtual
+        assert h["images"].attrs["num_images_written"] == 5
+        images = h["images"][()]
+        energies = h["spectrum_energies"][()]
+        assert h["central_wavelengths"].shape == (5,)
+    assert images.shape == (5,) + IMAGE_SHAPE
+    assert np.all(images[:, 0, 0, 0] == np.arange(5))
+    assert np.allclose(energies[:, 0], 9000 + np.arange(5))
+
+
+def test_master_resolves_relative_to_its_folder(tmpdir):
+    shard_dir = tmpdir.mkdir("shards")
+    names = [str(shard_dir.join("s%d.h5" % i)) for i in range(2)]
+    _write_shard(names[0], 0, 2, spectra=False)
+    _write_shard(names[1], 2, 2, spectra=False)
+    assert write_master(str(shard_dir.join("master.h5")), names) == 4
+
+    # the shards are found from the master's folder, not from the working directory
+    moved = tmpdir.join("moved")
+    os.rename(str(shard_dir), str(moved))
+    cwd = os.getcwd()
+    try:
+        os.chdir(str(tmpdir))
+        with h5py.File(str(moved.join("master.h5")), "r") as h:
+            images = h["images"][()]
+    finally:
+        os.chdir(cwd)
+    assert np.all(images[:, 0, 0, 0] == np.arange(4))
+
+
+def test_inconsistent_shards(tmpdir):
+    names = [str(tmpdir.join("s%d.h5" % i)) for i in range(2)]
+    _write_shard(names[0], 0, 2)
+    _write_shard(names[1], 2, 2, spectra=False)
+    with pytest.raises(ValueError):
+        write_master(str(tmpdir.join("master.h5")), names)
+
+    _write_shard(names[1], 2, 2, detector={"panels": []})
+    with pytest.raises(ValueError):
+        write_master(str(tmpdir.join("master.h5")), names)
@@ -0,0 +1,83 @@
+"""
+Tests of the peak-only SparseShotWriter and the dense reconstruction of its shots (no cctbx needed), run from the
+folder containing nanoBragg_multipanel:
+
+  libtbx.python -m pytest nanoBragg_multipanel/tests
+"""
+from __future__ import print_function
+
+import h5py
+import numpy as np
+import pytest
+
+from nanoBragg_multipanel.utils import SparseShotWriter
+
+IMAGE_SHAPE = (2, 6, 7)
+THRESHOLD = 50
+
+
+def _write(filename, images, masks=None, **kwargs):
+    with SparseShotWriter(filename, IMAGE_SHAPE, {}, {}, detector_and_beam_are_dicts=True, **kwargs) as writer:
+        for i, image in enumerate(images):
+            writer.add_image(image, mask=None if masks is None else masks[i])
+    return writer
+
+
+def _read_dense(filename, index):
+    """dense shot as FormatHDF5AttributeGeometry rebuilds it (which needs dxtbx to import)"""
+    with h5py.File(filename, "r") as h:
+        group = h["sparse_images"]
+        shape = tuple(group.attrs["image_shape"])
+        if "background" in group:
+            image = group["background"][()].astype(np.float64)
+        else:
+            image = np.zeros(shape)
+        start = group["shot_start"][index]
+        sl = slice(start, start + group["shot_count"][index])
+        image[group["panel"][sl], group["slow"][sl], group["fast"][sl]] = group["value"][sl]
+    return image
+
+
+def _images(num):
+    images = np.random.RandomState(1).uniform(0, 10, size=(num,) + IMAGE_SHAPE)
+    for i in range(num):
+        images[i, i % 2, i % 6, :i+1] = 100 + i  # peaks
+    return images
+
+
+def test_dense_reconstruction(tmpdir):
+    filename = str(tmpdir.join("sparse.h5"))
+    images = _images(5)
+    background = np.full(IMAGE_SHAPE, 5.)
+    # small blocks, so the pixel lists grow and the shot offsets are flushed several times
+    writer = _write(filename, images, threshold=THRESHOLD, background=background, block_size=4, shot_block=2)
+    assert writer.num_images_written == 5
+    assert writer.num_pixels_written == sum(range(1, 6))
+    with h5py.File(filename, "r") as h:
+        assert h["sparse_images"].attrs["num_images_written"] == 5
+        assert h["sparse_images/value"].shape == (writer.num_pixels_written,)
+    for i, image in enumerate(images):
+        expected = np.where(image > THRESHOLD, image, background)
+        assert np.allclose(_read_dense(filename, i), expected)
+
+
+def test_mask_without_threshold(tmpdir):
+    filename = str(tmpdir.join("sparse.h5"))
+    images = _images(2)
+    masks = np.zeros(images.shape, bool)
+    masks[:, 1, 2:4, 3:5] = True
+    _write(filename, images, masks=masks)
+    for i, image in enumerate(images):
+        # only the masked pixels are kept, peaks outside the mask read back as the (zero) background
+        assert np.allclose(_read_dense(filename, i), np.where(masks[i], image, 0))
+
+    with pytest.raises(ValueError):
+        _write(filename, images)
+
+
+def test_bad_shapes(tmpdir):
+    filename = str(tmpdir.join("sparse.h5"))
+    with pytest.raises(ValueError):
+        _write(filename, [np.zeros((2, 6, 6))], threshold=THRESHOLD)
+    with pytest.raises(ValueError):
+        _write(filename, [], threshold=THRESHOLD, background=np.zeros((2, 6, 6)))
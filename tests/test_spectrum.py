@@ -0,0 +1,82 @@
+"""
+Tests of the spectrum reduction and SASE spectra in spectrum.py (no cctbx needed), run from the folder
+containing nanoBragg_multipanel:
+
+  libtbx.python -m pytest nanoBragg_multipanel/tests
+"""
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+from nanoBragg_multipanel.spectrum import ENERGY_CONV, compress_spectrum, sase_spectra, to_wavelengths
+
+
+def _mean_energy(wavelengths, weights):
+    return np.average(ENERGY_CONV / np.asarray(wavelengths), weights=weights)
+
+
+def _spectrum(num=300, seed=0):
+    rng = np.random.RandomState(seed)
+    wavelengths = np.linspace(1.28, 1.32, num)
+    weights = np.exp(-0.5*((wavelengths - 1.3) / 0.006)**2) * rng.uniform(0.2, 1, num)
+    weights[::7] = 0  # empty lines are dropped
+    return wavelengths, weights
+
+
+@pytest.mark.parametrize("method", ["merge", "quantile"])
+@pytest.mark.parametrize("num_channels", [1, 5, 40])
+def test_flux_and_mean_energy_conserved(method, num_channels):
+    wavelengths, weights = _spectrum()
+    chan_wavelengths, chan_weights, err = compress_spectrum(wavelengths, weights, num_channels=num_channels,
+                                                            method=method)
+    assert len(chan_wavelengths) <= num_channels
+    assert np.all(np.diff(chan_wavelengths) > 0)  # increasing wavelength, like the input
+    assert np.isclose(chan_weights.sum(), weights.sum())
+    assert np.isclose(_mean_energy(chan_wavelengths, chan_weights), _mean_energy(wavelengths, weights))
+    assert err >= 0
+
+
+def test_tolerance():
+    wavelengths, weights = _spectrum()
+    loose = compress_spectrum(wavelengths, weights, tolerance=0.05)
+    tight = compress_spectrum(wavelengths, weights, tolerance=0.001)
+    assert loose[2] <= 0.05 and tight[2] <= 0.001
+    assert len(loose[0]) <= len(tight[0]) < np.count_nonzero(weights)
+    assert np.isclose(tight[1].sum(), weights.sum())
+
+
+def test_bad_arguments():
+    wavelengths, weights = _spectrum()
+    with pytest.raises(ValueError):
+        compress_spectrum(wavelengths, weights)
+    with pytest.raises(ValueError):
+        compress_spectrum(wavelengths, weights, num_channels=4, tolerance=0.01)
+    with pytest.raises(ValueError):
+        compress_spectrum(wavelengths, weights, tolerance=0.01, method="quantile")
+    with pytest.raises(ValueError):
+        compress_spectrum(wavelengths, weights, num_channels=4, method="kmeans")
+
+
+def test_sase_spectra():
+    energies, weights = sase_spectra(400, 9500, bandwidth_eV=25, spike_width_eV=2, num_channels=128, seed=3)
+    assert energies.shape == weights.shape == (400, 128)
+    assert np.all(weights >= 0)
+    assert np.allclose(weights.sum(axis=1), 1)
+    mean_energies = (energies*weights).sum(axis=1)
+    # every shot is different, but on average the spectra are centered on the central energy
+    assert np.std(mean_energies) > 0.5
+    assert abs(np.mean(mean_energies) - 9500) < 1
+    assert np.all(sase_spectra(2, 9500, seed=3)[1] == sase_spectra(2, 9500, seed=3)[1])
+
+    jittered = sase_spectra(400, 9500, energy_jitter_eV=20, num_channels=128, seed=3)
+    assert np.std((jittered[0]*jittered[1]).sum(axis=1)) > np.std(mean_energies)
+
+
+def test_compress_sase_spectrum():
+    energies, weights = sase_spectra(1, 9500, seed=4)
+    wavelengths, weights = to_wavelengths(energies[0], weights[0])
+    assert np.all(weights >= 1e-3*weights.max())
+    chan_wavelengths, chan_weights, _ = compress_spectrum(wavelengths, weights, num_channels=10)
+    assert np.isclose(chan_weights.sum(), weights.sum())
+    assert np.isclose(_mean_energy(chan_wavelengths, chan_weights), _mean_energy(wavelengths, weights))
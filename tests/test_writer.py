@@ -0,0 +1,129 @@
+"""
+Tests of the resizable and append modes and the per-shot spectra of H5AttributeGeomWriter (no cctbx needed), run
+from the folder containing nanoBragg_multipanel:
+
+  libtbx.python -m pytest nanoBragg_multipanel/tests
+"""
+from __future__ import print_function
+
+import h5py
+import numpy as np
+import pytest
+
+from nanoBragg_multipanel.spectrum import ENERGY_CONV, sase_spectra
+from nanoBragg_multipanel.utils import H5AttributeGeomWriter
+
+IMAGE_SHAPE = (2, 3, 4)
+
+
+def _writer(filename, num_images, **kwargs):
+    return H5AttributeGeomWriter(filename, IMAGE_SHAPE, num_images, {}, {}, detector_and_beam_are_dicts=True,
+                                 **kwargs)
+
+
+def _image(i):
+    return np.full(IMAGE_SHAPE, i, dtype=np.float64)
+
+
+def _read(filename):
+    with h5py.File(filename, "r") as h:
+        dset = h["images"]
+        return dset[()], dset.attrs["num_images_written"], dset.maxshape, dset.chunks
+
+
+def test_resizable_grows_and_trims(tmpdir):
+    filename = str(tmpdir.join("images.h5"))
+    with _writer(filename, 2, growth_block=3) as writer:
+        for i in range(4):
+            writer.add_image(_image(i))
+        writer.add_images(np.array([_image(i) for i in range(4, 7)]))
+        assert writer.image_dset.shape[0] == 8  # 2, then grown by one block of 3 twice
+    images, num_written, maxshape, chunks = _read(filename)
+    assert num_written == 7
+    assert images.shape == (7,) + IMAGE_SHAPE  # trimmed on close
+    assert maxshape[0] is None
+    assert chunks == (1, 1) + IMAGE_SHAPE[1:]  # one panel of one image per chunk
+    assert np.all(images[:, 0, 0, 0] == np.arange(7))
+
+
+def test_fixed_size(tmpdir):
+    filename = str(tmpdir.join("images.h5"))
+    with _writer(filename, 2, resizable=False) as writer:
+        writer.add_image(_image(0))
+        writer.add_image(_image(1))
+        with pytest.raises(IndexError):
+            writer.add_image(_image(2))
+    images, num_written, maxshape, _ = _read(filename)
+    assert num_written == 2 and maxshape[0] == 2
+
+
+@pytest.mark.parametrize("resizable", [True, False])
+def test_append(tmpdir, resizable):
+    filename = str(tmpdir.join("images.h5"))
+    capacity = 2 if resizable else 5
+    with _writer(filename, capacity, resizable=resizable) as writer:
+        writer.add_images(np.array([_image(0), _image(1)]))
+    # in append mode the file decides whether it can grow, not the resizable argument
+    with _writer(filename, 3, mode="a", resizable=not resizable) as writer:
+        assert writer.resizable == resizable
+        assert writer.num_images_written == 2
+        for i in range(2, 5):
+            writer.add_image(_image(i))
+    images, num_written, _, _ = _read(filename)
+    assert num_written == 5
+    assert np.all(images[:, 0, 0, 0] == np.arange(5))
+
+    if not resizable:
+        with _writer(filename, 1, mode="a") as writer:
+            with pytest.raises(IndexError):
+                writer.add_image(_image(5))
+
+
+def test_append_wrong_shape(tmpdir):
+    filename = str(tmpdir.join("images.h5"))
+    with _writer(filename, 1) as writer:
+        writer.add_image(_image(0))
+    with pytest.raises(ValueError):
+        H5AttributeGeomWriter(filename, (2, 3, 5), 1, {}, {}, detector_and_beam_are_dicts=True, mode="a")
+
+
+@pytest.mark.parametrize("resizable", [True, False])
+def test_append_with_spectra(tmpdir, resizable):
+    filename = str(tmpdir.join("images.h5"))
+    energies, weights = sase_spectra(5, 9500, num_channels=8, seed=0)
+    capacity = 2 if resizable else 5
+    # spectra are written 2 at a time, so flushing happens both on a full chunk and on close
+    with _writer(filename, capacity, resizable=resizable, spectrum_channels=8, spectrum_chunk=2) as writer:
+        writer.add_images(np.array([_image(0), _image(1)]), spectra=(energies[:2], weights[:2]))
+        writer.add_image(_image(2), spectrum=(energies[2], weights[2]))
+    with _writer(filename, 2, mode="a", spectrum_chunk=2) as writer:
+        with pytest.raises(ValueError):
+            writer.add_image(_image(3))  # this file stores a spectrum with every image
+        for i in range(3, 5):
+            # a shorter spectrum is padded with zero weights
+            writer.add_image(_image(i), spectrum=(energies[i][:6], weights[i][:6]) if i == 4
+                             else (energies[i], weights[i]))
+    with h5py.File(filename, "r") as h:
+        assert h["images"].shape[0] == 5
+        stored_energies = h["spectrum_energies"][()]
+        stored_weights = h["spectrum_weights"][()]
+        central_wavelengths = h["central_wavelengths"][()]
+    assert np.all(stored_energies[:4] == energies[:4])
+    assert np.all(stored_weights[:4] == weights[:4])
+    assert np.all(stored_weights[4, 6:] == 0)
+    assert np.all(stored_weights[4, :6] == weights[4, :6])
+    mean_energies = (stored_energies*stored_weights).sum(axis=1) / stored_weights.sum(axis=1)
+    assert np.allclose(central_wavelengths, ENERGY_CONV / mean_energies)
+
+
+def test_spectrum_errors(tmpdir):
+    filename = str(tmpdir.join("images.h5"))
+    with _writer(filename, 1) as writer:
+        with pytest.raises(ValueError):
+            writer.add_image(_image(0), spectrum=([9500], [1]))  # no spectrum_channels
+    with _writer(filename, 1, spectrum_channels=2) as writer:
+        with pytest.raises(ValueError):
+            writer.add_image(_image(0), spectrum=([9500, 9501, 9502], [1, 1, 1]))
+        with pytest.raises(ValueError):
+            writer.add_image(_image(0), spectrum=([9500, 9501], [1]))
+        assert writer.num_images_written == 0
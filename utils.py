@@ -1,14 +1,20 @@
 
 import time
 import json
-import h5py
 import numpy as np
+from collections import OrderedDict
 
-from simtbx.nanoBragg import shapetype
-from simtbx.nanoBragg import nanoBragg
-from scitbx.array_family import flex
-from dxtbx_model_ext import flex_Beam
-from dxtbx.model import BeamFactory
+# simtbx, scitbx, dxtbx and h5py are imported in the functions that use them, so that importing this module
+# (e.g. in a spawned pool worker, or for --help) stays cheap
+
+from nanoBragg_multipanel.profiling import NULL_TIMER
+from nanoBragg_multipanel.structure_factors import PreparedFhkl
+from nanoBragg_multipanel.spectrum import ENERGY_CONV
+
+# water scattering, (sin theta over lambda, Fbg) pairs
+WATER_FBG_VS_STOL = [
+    (0, 2.57), (0.0365, 2.58), (0.07, 2.8), (0.12, 5), (0.162, 8), (0.2, 6.75), (0.18, 7.32),
+    (0.216, 6.75), (0.236, 6.5), (0.28, 4.5), (0.3, 4.3), (0.345, 4.36), (0.436, 3.77), (0.5, 3.17)]
 
 
 def sim_background(DETECTOR, BEAM,wavelengths, wavelength_weights,
@@ -23,7 +29,7 @@ def sim_background(DETECTOR, BEAM,wavelengths, wavelength_weights,
     :param total_flux: see sim_spots
     :param pidx: see sim_spots
     :param beam_size_mm: see sim_spots
-    :param Fbg_vs_stol: list of tuples where each tuple is (Fbg, sin theta over lambda)
+    :param Fbg_vs_stol: list of tuples where each tuple is (sin theta over lambda, Fbg), defaults to WATER_FBG_VS_STOL
     :param sample_thick_mm: path length of background that is exposed by the beam
     :param density_gcm3: density of background  (defaults to water)
     :param molecular_weight: molecular weight of background (defaults to water)
@@ -34,14 +40,13 @@ def sim_background(DETECTOR, BEAM,wavelengths, wavelength_weights,
     spectrum = list(zip(wavelengths, weights))
     xray_beams = get_xray_beams(spectrum, BEAM)
 
-
+    from simtbx.nanoBragg import nanoBragg
+    from scitbx.array_family import flex
     SIM = nanoBragg(DETECTOR, BEAM, panel_id=int(pidx))
     SIM.beamsize_mm = beam_size_mm
     SIM.xray_beams = xray_beams
     if Fbg_vs_stol is None:
-        Fbg_vs_stol = flex.vec2_double(
-        [(0, 2.57), (0.0365, 2.58), (0.07, 2.8), (0.12, 5), (0.162, 8), (0.2, 6.75), (0.18, 7.32),
-         (0.216, 6.75), (0.236, 6.5), (0.28, 4.5), (0.3, 4.3), (0.345, 4.36), (0.436, 3.77), (0.5, 3.17)])
+        Fbg_vs_stol = flex.vec2_double(WATER_FBG_VS_STOL)
     SIM.flux = total_flux
     SIM.Fbg_vs_stol = Fbg_vs_stol
     SIM.amorphous_sample_thick_mm = sample_thick_mm
@@ -65,12 +70,13 @@ def sim_spots(
         noise_seed=None, calib_seed=None, mosaic_seed=None,
         recenter=True, spot_scale_override=None, add_noise=True,
         adc_offset=10, readout_noise_adu=3,gain=1,
-        background_raw_pixels=None, background_scale=1):
+        background_raw_pixels=None, background_scale=1, rois=None, timer=None, out=None):
     """
     :param CRYSTAL:  dxtbx crystal model (e.g. from dials.index or dials.stills_process)
     :param DETECTOR: dxtbx detector model
     :param BEAM: dxtbx beam model
-    :param Famp: cctbx miller array (.data() attribute should point to SF amplitudes)
+    :param Famp: cctbx miller array (.data() attribute should point to SF amplitudes), or a
+        structure_factors.PreparedFhkl to skip the P1 expansion and conversion on every call
     :param wavelengths: wavelengths in Angstrom
     :param wavelength_weights: weights for each wavelength in Angstroms (for pink beam simulation)
     :param total_flux: total flux per pulse
@@ -95,111 +101,365 @@ def sim_spots(
     :param mosaic_seed: seed for generating mosaic spread
     :param recenter: recenter the panel after instantiating (do this if the detector and incident beam are not squred up, e.g. for tilted geometries)
     :param spot_scale_override: override the spot scale parameter which is currently determined by taking ration of crystal volume and mosaic domain volume
-    :param add_noise: whether to add noise
+    :param add_noise: whether to add noise (set to False and use noise.NoiseModel to draw many noise realizations from one simulation)
     :param adc_offset: offset to pixel values
     :param readout_noise_adu: readout noise level (default is 3)
     :param gain: quantum gain (default is 1)
-    :param background_raw_pixels: flex array of background pixels (output from sim_background function)
+    :param background_raw_pixels: flex or numpy array of background pixels (output from sim_background function, or loaded from a BackgroundCache)
     :param background_scale: option to boost ot decrease the background level
-    :return: simulated pixels as a numpy array, that can then be written to an hdf5 file
+    :param rois: only simulate spots inside these regions of interest, a list of non-overlapping (fast_min, fast_max,
+        slow_min, slow_max) pixel bounds (inclusive), e.g. from roi.get_panel_rois. An empty list skips the spot simulation
+        entirely. Background and noise are still applied to the whole panel
+    :param timer: a profiling.PhaseTimer, records the duration and memory of each phase of the simulation
+    :param out: optional numpy array (Nslow x Nfast) to store the result in, e.g. a view of one panel of a
+        preallocated (Npanel x Nslow x Nfast) buffer re-used across shots (see copy_into). It can be float32,
+        or an integer type (values are rounded, which makes sense after noise is added)
+    :return: simulated pixels as a numpy array, that can then be written to an hdf5 file (out, if provided)
     """
 
     assert len(wavelengths) == len(wavelength_weights)
-
-    wavelength_weights = np.array(wavelength_weights)
-    weights = (wavelength_weights / wavelength_weights.sum()) * total_flux
-    spectrum = list(zip(wavelengths, weights))
-    xray_beams = get_xray_beams(spectrum, BEAM)
+    if timer is None:
+        timer = NULL_TIMER
 
     tinit = time.time()
-    SIM = nanoBragg(DETECTOR, BEAM,
-                verbose=verbose, panel_id=int(pidx))
+    with timer.phase("xray_beams", pidx):
+        wavelength_weights = np.array(wavelength_weights)
+        weights = (wavelength_weights / wavelength_weights.sum()) * total_flux
+        spectrum = list(zip(wavelengths, weights))
+        xray_beams = get_xray_beams(spectrum, BEAM)
+
+    with timer.phase("construct", pidx):
+        from simtbx.nanoBragg import nanoBragg
+        from scitbx.array_family import flex
+        SIM = nanoBragg(DETECTOR, BEAM,
+                    verbose=verbose, panel_id=int(pidx))
+
+    with timer.phase("configure", pidx):
+        set_xtal_shape(SIM, profile)
+
+        if recenter:
+            SIM.beam_center_mm = DETECTOR[int(pidx)].get_beam_centre(BEAM.get_s0())
+
+        if printout_pix is not None:
+            SIM.printout_pixel_fastslow = printout_pix
+
+        if noise_seed is not None:
+            SIM.seed = noise_seed
+        if calib_seed is not None:
+            SIM.calib_seed = calib_seed
+        if mosaic_seed is not None:
+            SIM.mosaic_seed = mosaic_seed
+
+        SIM.exposure_s = 1
+
+        SIM.interpolate = interpolate
+
+        # Crystal properties
+        SIM.Ncells_abc = determine_Ncells_abc(CRYSTAL, mosaic_vol_A3)
+        SIM.mosaic_spread_deg = mos_spread
+        SIM.mosaic_domains = mos_dom
+
+    with timer.phase("Fhkl", pidx):
+        if isinstance(Famp, float):
+            SIM.default_F = Famp
+        elif isinstance(Famp, PreparedFhkl):
+            Famp.attach(SIM)  # also sets the unit cell, so before Amatrix too
+        else:
+            SIM.Fhkl = Famp  # setting Fhkl property overrides unit cell, so we should do this before setting Amatrix
+
+    with timer.phase("configure", pidx):
+        SIM.Amatrix = Amatrix_dials2nanoBragg(CRYSTAL)  # Amatrix takes priority for unit cell
+        SIM.spot_scale = determine_spot_scale(beam_size_mm, crystal_size_mm, mosaic_vol_A3)
+        if spot_scale_override is not None:
+            SIM.spot_scale = spot_scale_override
+
+        # Beam properties
+        # order is important here, first comes flux then comes xray beams
+        SIM.flux = total_flux
+        SIM.beamsize_mm = beam_size_mm
+        SIM.xray_beams = xray_beams
+
+        SIM.default_F = default_F
+
+        if cuda:
+            SIM.device_Id = int(device_Id)
+
+        if oversample > 0:
+            SIM.oversample = oversample
+
+    with timer.phase("add_spots", pidx):
+        if rois is None:
+            if cuda:
+                SIM.add_nanoBragg_spots_cuda()
+            else:
+                SIM.add_nanoBragg_spots()
+        else:
+            fast_dim, slow_dim = DETECTOR[int(pidx)].get_image_size()
+            spot_pixels = np.zeros((slow_dim, fast_dim))
+            for roi in rois:
+                fmin, fmax, smin, smax = [int(x) for x in roi]
+                SIM.region_of_interest = ((fmin, fmax), (smin, smax))
+                if cuda:
+                    SIM.add_nanoBragg_spots_cuda()
+                else:
+                    SIM.add_nanoBragg_spots()
+                # the ROIs do not overlap, so only the block of this ROI is copied out, without zeroing the panel
+                block = SIM.raw_pixels.matrix_copy_block(smin, fmin, smax-smin+1, fmax-fmin+1)
+                spot_pixels[smin:smax+1, fmin:fmax+1] = block.as_numpy_array()
+            SIM.region_of_interest = ((0, fast_dim-1), (0, slow_dim-1))
+            SIM.raw_pixels = flex.double(spot_pixels)
 
-    if profile is not None:
-        if profile == "gauss":
-            SIM.xtal_shape = shapetype.Gauss
-        elif profile == "tophat":
-            SIM.xtal_shape = shapetype.Tophat
-        elif profile == "round":
-            SIM.xtal_shape = shapetype.Round
-        elif profile == "square":
-            SIM.xtal_shape = shapetype.Square
+    if show_params:
+        SIM.show_params()
+        print("Mosaic domain volume: %2.7g (mm^3)" % mosaic_vol_A3)
+        print("spot scale: %2.7g" % SIM.spot_scale)
 
-    if recenter:
-        SIM.beam_center_mm = DETECTOR[int(pidx)].get_beam_centre(BEAM.get_s0())
+    with timer.phase("background", pidx):
+        SIM.raw_pixels /= len(wavelengths)
 
-    if printout_pix is not None:
-        SIM.printout_pixel_fastslow = printout_pix
+        if background_raw_pixels is not None:
+            if isinstance(background_raw_pixels, np.ndarray):
+                background_raw_pixels = flex.double(np.ascontiguousarray(background_raw_pixels, dtype=np.float64))
+            SIM.raw_pixels += background_raw_pixels*background_scale
 
-    if noise_seed is not None:
-        SIM.seed = noise_seed
-    if calib_seed is not None:
-        SIM.calib_seed = calib_seed
-    if mosaic_seed is not None:
-        SIM.mosaic_seed = mosaic_seed
+    if add_noise:
+        with timer.phase("noise", pidx):
+            SIM.adc_offset_adu = adc_offset
+            SIM.detector_psf_fwhm_mm = 0
+            SIM.quantum_gain = gain
+            SIM.readout_noise_adu = readout_noise_adu
+            SIM.add_noise()
+
+    with timer.phase("copy", pidx):
+        raw_pixels = SIM.raw_pixels.as_numpy_array()
+        if out is not None:
+            raw_pixels = copy_into(out, raw_pixels)
+    with timer.phase("free", pidx):
+        SIM.free_all()
+    if time_panels:
+        tdone = time.time()-tinit
+        print("Panel %d took %.4f seconds" % (pidx, tdone))
+    del SIM
+    return raw_pixels
 
-    SIM.exposure_s = 1
 
-    SIM.interpolate = interpolate
+class PanelSimulatorSession:
 
-    # Crystal properties
-    Nunit_cell = mosaic_vol_A3 / CRYSTAL.get_unit_cell().volume()
-    N = np.power(Nunit_cell, 1/3.)
-    SIM.Ncells_abc = int(N), int(N), int(N)
-    SIM.mosaic_spread_deg = mos_spread
-    SIM.mosaic_domains = mos_dom
-    if isinstance(Famp, float):
-        SIM.default_F = Famp
-    else:
-        SIM.Fhkl = Famp  # setting Fhkl property overrides unit cell, so we should do this before setting Amatrix
-    SIM.Amatrix = Amatrix_dials2nanoBragg(CRYSTAL)  # Amatrix takes priority for unit cell
-    SIM.spot_scale = determine_spot_scale(beam_size_mm, crystal_size_mm, mosaic_vol_A3)
-    if spot_scale_override is not None:
-        SIM.spot_scale = spot_scale_override
-
-    # Beam properties
-    # order is important here, first comes flux then comes xray beams
-    SIM.flux = total_flux
-    SIM.beamsize_mm = beam_size_mm
-    SIM.xray_beams = xray_beams
+    def __init__(self, DETECTOR, BEAM, Famp, wavelengths, wavelength_weights, total_flux,
+                 panel_ids=None, cuda=False, oversample=0, mosaic_vol_A3=3000**3, mos_dom=1, mos_spread=0,
+                 profile=None, crystal_size_mm=0.01, beam_size_mm=0.001, device_Id=0, verbose=0,
+                 default_F=0, interpolate=0, recenter=True, spot_scale_override=None, add_noise=True,
+                 adc_offset=10, readout_noise_adu=3, gain=1, background_raw_pixels=None, background_scale=1):
+        """
+        Keeps one configured nanoBragg instance per panel alive across shots. Everything that does
+        not change from shot to shot (geometry, spectrum, structure factors, noise model, ...) is set once
+        here, and `run` only updates the crystal orientation, unit cell size and seeds.
+        The arguments have the same meaning as in sim_spots.
+
+        :param Famp: see sim_spots, or a list with one entry per panel in DETECTOR (see resolution.prune_structure_factors)
+        :param panel_ids: which panels to simulate (defaults to all panels in DETECTOR)
+        :param background_raw_pixels: list of flex arrays of background pixels, one per entry in panel_ids
+        """
+        assert len(wavelengths) == len(wavelength_weights)
+        self.DETECTOR = DETECTOR
+        self.BEAM = BEAM
+        if panel_ids is None:
+            panel_ids = list(range(len(DETECTOR)))
+        self.panel_ids = [int(pidx) for pidx in panel_ids]
+        self.num_wavelengths = len(wavelengths)
+        self.cuda = cuda
+        self.mosaic_vol_A3 = mosaic_vol_A3
+        self.mos_dom = mos_dom
+        self.mos_spread = mos_spread
+        self.add_noise = add_noise
+        self.background_scale = background_scale
+        if background_raw_pixels is not None:
+            assert len(background_raw_pixels) == len(self.panel_ids)
+        self.background_raw_pixels = background_raw_pixels
+
+        wavelength_weights = np.array(wavelength_weights)
+        weights = (wavelength_weights / wavelength_weights.sum()) * total_flux
+        xray_beams = get_xray_beams(list(zip(wavelengths, weights)), BEAM)
+
+        spot_scale = determine_spot_scale(beam_size_mm, crystal_size_mm, mosaic_vol_A3)
+        if spot_scale_override is not None:
+            spot_scale = spot_scale_override
+
+        from simtbx.nanoBragg import nanoBragg
+        self.SIMs = []
+        self._state = []
+        tinit = time.time()
+        for pidx in self.panel_ids:
+            SIM = nanoBragg(DETECTOR, BEAM, verbose=verbose, panel_id=pidx)
+            set_xtal_shape(SIM, profile)
+            if recenter:
+                SIM.beam_center_mm = DETECTOR[pidx].get_beam_centre(BEAM.get_s0())
+            SIM.exposure_s = 1
+            SIM.interpolate = interpolate
+            SIM.mosaic_spread_deg = mos_spread
+            SIM.mosaic_domains = mos_dom
+            panel_Famp = Famp[pidx] if isinstance(Famp, (list, tuple)) else Famp
+            if isinstance(panel_Famp, float):
+                SIM.default_F = panel_Famp
+            elif isinstance(panel_Famp, PreparedFhkl):
+                panel_Famp.attach(SIM)  # must come before Amatrix, which is set in run
+            else:
+                SIM.Fhkl = panel_Famp  # must come before Amatrix, which is set in run
+            SIM.spot_scale = spot_scale
+            SIM.flux = total_flux
+            SIM.beamsize_mm = beam_size_mm
+            SIM.xray_beams = xray_beams
+            SIM.default_F = default_F
+            if cuda:
+                SIM.device_Id = int(device_Id)
+            if oversample > 0:
+                SIM.oversample = oversample
+            if add_noise:
+                SIM.adc_offset_adu = adc_offset
+                SIM.detector_psf_fwhm_mm = 0
+                SIM.quantum_gain = gain
+                SIM.readout_noise_adu = readout_noise_adu
+            self.SIMs.append(SIM)
+            self._state.append({})
+        self.build_time = time.time() - tinit
+        self.num_shots = 0
+        self.update_time = 0
+
+    @property
+    def image_shape(self):
+        fast_dim, slow_dim = self.DETECTOR[self.panel_ids[0]].get_image_size()
+        return len(self.panel_ids), slow_dim, fast_dim
+
+    @property
+    def setup_time_saved(self):
+        """
+        seconds of nanoBragg setup avoided so far, compared with building every panel from scratch on every shot
+        (0 until the session has run enough shots for the savings to outweigh the per-shot updates)
+        """
+        return max(0., self.num_shots * self.build_time - (self.build_time + self.update_time))
 
-    SIM.default_F = default_F
+    def _update(self, SIM, state, name, value):
+        # only touch nanoBragg properties whose value changed since the last shot
+        if state.get(name) != value:
+            setattr(SIM, name, value)
+            state[name] = value
+            return True
+        return False
 
-    if cuda:
-        SIM.device_Id = int(device_Id)
+    def run(self, crystal, seed=None, calib_seed=None, mosaic_seed=None, out=None, timer=None):
+        """
+        simulate one shot on all panels of the session
+
+        :param crystal: dxtbx crystal model
+        :param seed: seed for generating random poisson and readout noise
+        :param calib_seed: seed for generating gain calibration noise
+        :param mosaic_seed: seed for generating mosaic spread
+        :param out: optional numpy array (Npanel x Nslow x Nfast) to store the result in
+        :param timer: a profiling.PhaseTimer, records the duration and memory of each phase
+        :return: simulated pixels as a numpy array (Npanel x Nslow x Nfast)
+        """
+        if timer is None:
+            timer = NULL_TIMER
+        if out is None:
+            out = np.empty(self.image_shape)
+        Amatrix = Amatrix_dials2nanoBragg(crystal)
+        Ncells_abc = determine_Ncells_abc(crystal, self.mosaic_vol_A3)
+        for i_pan, (SIM, state) in enumerate(zip(self.SIMs, self._state)):
+            pidx = self.panel_ids[i_pan]
+            tupdate = time.time()
+            with timer.phase("configure", pidx):
+                self._update(SIM, state, "Ncells_abc", Ncells_abc)
+                self._update(SIM, state, "Amatrix", Amatrix)
+                if seed is not None:
+                    SIM.seed = seed
+                if calib_seed is not None:
+                    SIM.calib_seed = calib_seed
+                if mosaic_seed is not None and self._update(SIM, state, "mosaic_seed", mosaic_seed):
+                    # mosaic domains are only regenerated when the spread is set
+                    SIM.mosaic_spread_deg = self.mos_spread
+                    SIM.mosaic_domains = self.mos_dom
+                SIM.raw_pixels *= 0
+            self.update_time += time.time() - tupdate
+
+            with timer.phase("add_spots", pidx):
+                if self.cuda:
+                    SIM.add_nanoBragg_spots_cuda()
+                else:
+                    SIM.add_nanoBragg_spots()
+            with timer.phase("background", pidx):
+                SIM.raw_pixels /= self.num_wavelengths
+                if self.background_raw_pixels is not None:
+                    SIM.raw_pixels += self.background_raw_pixels[i_pan]*self.background_scale
+            if self.add_noise:
+                with timer.phase("noise", pidx):
+                    SIM.add_noise()
+            with timer.phase("copy", pidx):
+                copy_into(out[i_pan], SIM.raw_pixels.as_numpy_array())
+        self.num_shots += 1
+        return out
+
+    def report(self):
+        """
+        print a summary of the setup time the session has saved
+        """
+        print("Session built %d panels in %.4f seconds, %d shots, %.4f seconds spent updating, %.4f seconds saved"
+              % (len(self.panel_ids), self.build_time, self.num_shots, self.update_time, self.setup_time_saved))
 
-    if oversample > 0:
-        SIM.oversample = oversample
+    def free_all(self):
+        """
+        free the nanoBragg instances (if instantiated using `with`, then this is done automatically)
+        """
+        for SIM in self.SIMs:
+            SIM.free_all()
+        self.SIMs = []
 
-    if cuda:
-        SIM.add_nanoBragg_spots_cuda()
-    else:
-        SIM.add_nanoBragg_spots()
+    def __enter__(self):
+        return self
 
-    if show_params:
-        SIM.show_params()
-        print("Mosaic domain volume: %2.7g (mm^3)" % mosaic_vol_A3)
-        print("spot scale: %2.7g" % SIM.spot_scale)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.free_all()
 
-    SIM.raw_pixels /= len(wavelengths)
 
-    if background_raw_pixels is not None:
-        SIM.raw_pixels += background_raw_pixels*background_scale
+def copy_into(out, pixels):
+    """
+    :param out: numpy array to store the pixels in (any float or integer type)
+    :param pixels: numpy array of pixels, same shape as out
+    :return: out
+    """
+    if np.issubdtype(out.dtype, np.integer):
+        info = np.iinfo(out.dtype)
+        pixels = np.clip(np.rint(pixels), info.min, info.max)
+    np.copyto(out, pixels, casting="unsafe")
+    return out
 
-    if add_noise:
-        SIM.adc_offset_adu = adc_offset
-        SIM.detector_psf_fwhm_mm = 0
-        SIM.quantum_gain = gain
-        SIM.readout_noise_adu = readout_noise_adu
-        SIM.add_noise()
 
-    raw_pixels = SIM.raw_pixels.as_numpy_array()
-    SIM.free_all()
-    if time_panels:
-        tdone = time.time()-tinit
-        print("Panel %d took %.4f seconds" % (pidx, tdone))
-    del SIM
-    return raw_pixels
+def set_xtal_shape(SIM, profile):
+    """
+    :param SIM: nanoBragg instance
+    :param profile: profile of RELP (can be "round", "tophat", "square", or "gauss"), None leaves the nanoBragg default
+    """
+    if profile is not None:
+        from simtbx.nanoBragg import shapetype
+        if profile == "gauss":
+            SIM.xtal_shape = shapetype.Gauss
+        elif profile == "tophat":
+            SIM.xtal_shape = shapetype.Tophat
+        elif profile == "round":
+            SIM.xtal_shape = shapetype.Round
+        elif profile == "square":
+            SIM.xtal_shape = shapetype.Square
+
+
+def determine_Ncells_abc(CRYSTAL, mosaic_vol_A3):
+    """
+
+    :param CRYSTAL: dxtbx crystal model
+    :param mosaic_vol_A3: volume of a mosaic block in crystal (cubic angstrom)
+    :return: number of unit cells along each axis of a (cubic) mosaic block
+    """
+    Nunit_cell = mosaic_vol_A3 / CRYSTAL.get_unit_cell().volume()
+    N = np.power(Nunit_cell, 1/3.)
+    return int(N), int(N), int(N)
 
 
 def determine_spot_scale(beam_size_mm, crystal_thick_mm, mosaic_vol_A3):
@@ -217,13 +477,31 @@ def determine_spot_scale(beam_size_mm, crystal_thick_mm, mosaic_vol_A3):
     return illum_xtal_vol / mosaic_vol_A3 * (1e21)
 
 
-def get_xray_beams(spectrum, beam_originator):
+# recently built flex_Beam arrays, so every panel of a shot re-uses the one built for its spectrum
+_XRAY_BEAMS_CACHE = OrderedDict()
+_XRAY_BEAMS_CACHE_SIZE = 8
+
+
+def get_xray_beams(spectrum, beam_originator, use_cache=True):
     """
 
     :param spectrum:  list of tuples where one tuple is (wavelength_Angstrom, flux)
     :param beam_originator: beam where we derive the s0 vector and polarization and divergence
+    :param use_cache: return the flex_Beam built earlier for the same spectrum and beam, if any
+        (it is shared, so do not modify it)
     :return: flex_Beam array to be set as a nanoBragg property
     """
+    key = None
+    if use_cache:
+        key = (tuple((float(wavelen), float(flux)) for wavelen, flux in spectrum),
+               tuple(beam_originator.get_unit_s0()), beam_originator.get_polarization_fraction(),
+               beam_originator.get_divergence())
+        if key in _XRAY_BEAMS_CACHE:
+            _XRAY_BEAMS_CACHE.move_to_end(key)
+            return _XRAY_BEAMS_CACHE[key]
+
+    from dxtbx_model_ext import flex_Beam
+    from dxtbx.model import BeamFactory
     xray_beams = flex_Beam()
     for wavelen, flux in spectrum:
         beam = BeamFactory.simple(wavelen*1e-10)
@@ -233,6 +511,10 @@ def get_xray_beams(spectrum, beam_originator):
         beam.set_divergence(beam_originator.get_divergence())
         xray_beams.append(beam)
 
+    if key is not None:
+        _XRAY_BEAMS_CACHE[key] = xray_beams
+        while len(_XRAY_BEAMS_CACHE) > _XRAY_BEAMS_CACHE_SIZE:
+            _XRAY_BEAMS_CACHE.popitem(last=False)
     return xray_beams
 
 
@@ -265,16 +547,85 @@ def extract_omega_and_kahn_factors(DETECTOR, BEAM, pidx):
     return omega_kahn
 
 
+# integer encodings of the stored images, see encode_image
+ENCODINGS = {"uint16": np.uint16, "int32": np.int32, "jungfrau": np.uint16}
+# Jungfrau frames: 2 gain bits (G0=0b00, G1=0b01, G2=0b11) above a 14 bit ADC value
+JUNGFRAU_ADC_MAX = 2**14 - 1
+JUNGFRAU_GAIN_BITS = np.array([0, 1, 3], np.uint16)
+# pixel value per ADC count in each gain stage (approximate G0:G1:G2 gain ratios of a Jungfrau)
+JUNGFRAU_GAIN_DIVISORS = (1., 30., 400.)
+# stored value reserved for untrusted pixels (e.g. gaps marked -1) by the unsigned encodings, all bits set like
+# the gap pixels of real Eiger / Jungfrau frames. int32 stores negative values as they are
+UNTRUSTED_VALUES = {"uint16": 2**16 - 1, "jungfrau": 2**16 - 1}
+
+
+def _trusted_range_arrays(detector):
+    """
+    :param detector: dxtbx detector model or its dictionary
+    :return: lower and upper trusted values of each panel, shaped to broadcast over (Npanel x Nslow x Nfast)
+    """
+    if isinstance(detector, dict):
+        ranges = [panel["trusted_range"] for panel in detector["panels"]]
+    else:
+        ranges = [panel.get_trusted_range() for panel in detector]
+    ranges = np.array(ranges, dtype=np.float64)
+    return ranges[:, 0, None, None], ranges[:, 1, None, None]
+
+
+def encode_image(image, encoding, trusted_range=None, gain_divisors=JUNGFRAU_GAIN_DIVISORS):
+    """
+    Encode pixel values like a real detector readout. Values saturate at the trusted range and at the
+    limits of the integer type, and are rounded. FormatHDF5AttributeGeometry decodes them
+
+    :param image: numpy array of pixel values (Npanel x Nslow x Nfast, or a stack of those)
+    :param encoding: "uint16", "int32" or "jungfrau" (2 bit gain stage + 14 bit ADC value packed in a uint16,
+        the smallest gain stage whose ADC range holds the value is used, so larger values lose precision).
+        uint16 and jungfrau store negative pixels (untrusted, e.g. gaps marked -1) as UNTRUSTED_VALUES[encoding],
+        which is decoded to the panel's lower trusted value
+    :param trusted_range: optional (lower, upper) per panel, as returned by _trusted_range_arrays
+    :param gain_divisors: for jungfrau, pixel value per ADC count in each of the 3 gain stages
+    :return: numpy array of the encoded values
+    """
+    image = np.asarray(image, dtype=np.float64)
+    if trusted_range is not None:
+        image = np.clip(image, trusted_range[0], trusted_range[1])
+    if encoding in ("uint16", "int32"):
+        info = np.iinfo(ENCODINGS[encoding])
+        encoded = np.clip(np.rint(image), info.min, info.max).astype(ENCODINGS[encoding])
+    elif encoding == "jungfrau":
+        positive = np.maximum(image, 0)
+        gain_divisors = np.array(gain_divisors, dtype=np.float64)
+        stage = np.zeros(image.shape, np.intp)
+        stage[positive > JUNGFRAU_ADC_MAX*gain_divisors[0]] = 1
+        stage[positive > JUNGFRAU_ADC_MAX*gain_divisors[1]] = 2
+        adc = np.minimum(np.rint(positive / gain_divisors[stage]), JUNGFRAU_ADC_MAX).astype(np.uint16)
+        encoded = (JUNGFRAU_GAIN_BITS[stage] << 14) | adc
+    else:
+        raise ValueError("Unknown encoding %s, options are %s" % (encoding, sorted(ENCODINGS)))
+    untrusted_value = UNTRUSTED_VALUES.get(encoding)
+    if untrusted_value is not None:
+        # negative values (below a negative trusted lower bound, e.g. gaps) would read back as valid counts
+        encoded[encoded == untrusted_value] = untrusted_value - 1
+        encoded[image < 0] = untrusted_value
+    return encoded
+
+
+# per-shot spectrum datasets read by FormatHDF5AttributeGeometry
+SPECTRUM_DSETS = ["spectrum_energies", "spectrum_weights", "central_wavelengths"]
+
+
 class H5AttributeGeomWriter:
 
     def __init__(self, filename, image_shape, num_images, detector, beam, dtype=None,
-                 compression_args=None, detector_and_beam_are_dicts=False):
+                 compression_args=None, detector_and_beam_are_dicts=False, resizable=True,
+                 growth_block=None, chunks=None, mode="w", encoding=None, gain_divisors=JUNGFRAU_GAIN_DIVISORS,
+                 spectrum_channels=None, spectrum_chunk=256):
         """
         Simple class for writing dxtbx compatible HDF5 files
 
         :param filename:  input file path
         :param image_shape: shape of a single image (Npanel x Nfast x Nslow)
-        :param num_images: how many images will you be writing to the file
+        :param num_images: how many images will you be writing to the file (if resizable, this is just the initial size)
         :param detector: dxtbx detector model
         :param beam: dxtbx beam model
         :param dtype: datatype for storage
@@ -284,32 +635,201 @@ class H5AttributeGeomWriter:
               compression_args={"compression": "lzf"}  # Python only
               comression_args = {"compression": "gzip", "compression_opts":9}
         :param detector_and_beam_are_dicts:
+        :param resizable: whether the images dataset can grow beyond num_images. It grows by growth_block
+            images at a time, and is trimmed to the number of images written when the file is closed.
+            In append mode this is read from the existing images dataset instead
+        :param growth_block: number of images to add each time a resizable dataset is full (defaults to num_images,
+            in append mode num_images is the number of images about to be added)
+        :param chunks: h5py chunk shape. By default one chunk holds one panel of one image, so single panels
+            can be read cheaply. Pass True to let h5py guess
+        :param mode: "w" to create a new file, or "a" to append images to a file written by this class
+        :param encoding: store images as detector-like integers instead of dtype: "uint16" or "int32"
+            (saturating at each panel's trusted_range), or "jungfrau" (2 bit gain + 14 bit ADC), see encode_image.
+            4-8x smaller than float64, FormatHDF5AttributeGeometry decodes them when reading. Untrusted (negative)
+            pixels are kept. In append mode it must match the encoding of the existing images (or be None)
+        :param gain_divisors: pixel value per ADC count in the 3 jungfrau gain stages
+        :param spectrum_channels: store a spectrum with every image (see add_image) in the spectrum_energies and
+            spectrum_weights datasets (Nimages x spectrum_channels), plus its mean wavelength in central_wavelengths.
+            FormatHDF5AttributeGeometry sets the per-image beam from them
+        :param spectrum_chunk: spectra are buffered and written this many at a time (one chunk)
         """
         if compression_args is None:
             compression_args = {}
 
-        self.file_handle = h5py.File(filename, 'w')
+        import h5py
+        self.file_handle = h5py.File(filename, mode)
         self.beam = beam
         self.detector = detector
         self.detector_and_beam_are_dicts = detector_and_beam_are_dicts
+        self.resizable = resizable
+        if growth_block is None:
+            growth_block = num_images
+        self.growth_block = max(int(growth_block), 1)
         if dtype is None:
             dtype = np.float64
-        dset_shape = (num_images,) + tuple(image_shape)
+        image_shape = tuple(image_shape)
+        self.gain_divisors = tuple(gain_divisors)
+        self._trusted_range = None
+
+        if mode == "a" and "images" in self.file_handle:
+            self.image_dset = self.file_handle["images"]
+            if self.image_dset.shape[1:] != image_shape:
+                raise ValueError("Existing images have shape %s, not %s" % (self.image_dset.shape[1:], image_shape))
+            self._counter = int(self.image_dset.attrs.get("num_images_written", self.image_dset.shape[0]))
+            # whether the file can grow is decided by how it was created, not by the arguments
+            self.resizable = self.image_dset.maxshape[0] is None
+            self.encoding = self.image_dset.attrs.get("encoding")
+            if isinstance(self.encoding, bytes):
+                self.encoding = self.encoding.decode()
+            if encoding is not None and encoding != self.encoding:
+                raise ValueError("Existing images are stored with encoding %s, cannot append with encoding %s"
+                                 % (self.encoding, encoding))
+            if self.encoding is not None:
+                self._set_encoding(self.encoding)
+                self.gain_divisors = tuple(json.loads(self.image_dset.attrs["gain_divisors"]))
+            self._spectrum_dsets = [self.file_handle[name] for name in SPECTRUM_DSETS if name in self.file_handle]
+            self._init_spectrum_buffer(spectrum_chunk)
+            return
+
+        self.encoding = None
+        if encoding is not None:
+            self._set_encoding(encoding)
+            dtype = ENCODINGS[self.encoding]
+
+        if chunks is None and len(image_shape) == 3:
+            chunks = (1, 1) + image_shape[1:]
+        dset_shape = (num_images,) + image_shape
+        maxshape = None
+        if resizable:
+            maxshape = (None,) + image_shape
+            if chunks is None:
+                chunks = True
         self.image_dset = self.file_handle.create_dataset(
-            "images", shape=dset_shape,
+            "images", shape=dset_shape, maxshape=maxshape, chunks=chunks,
             dtype=dtype, **compression_args)
 
         self._write_geom()
+        if self.encoding is not None:
+            self.image_dset.attrs["encoding"] = self.encoding
+            self.image_dset.attrs["gain_divisors"] = json.dumps(self.gain_divisors)
+            if self.encoding in UNTRUSTED_VALUES:
+                self.image_dset.attrs["untrusted_value"] = UNTRUSTED_VALUES[self.encoding]
         self._counter = 0
 
-    def add_image(self, image):
+        self._spectrum_dsets = []
+        if spectrum_channels is not None:
+            rows = max(1, min(int(spectrum_chunk), max(num_images, 1)))
+            for name in SPECTRUM_DSETS:
+                item_shape = () if name == "central_wavelengths" else (int(spectrum_channels),)
+                self._spectrum_dsets.append(self.file_handle.create_dataset(
+                    name, shape=(num_images,) + item_shape, maxshape=(None if resizable else num_images,) + item_shape,
+                    chunks=(rows,) + item_shape, dtype=np.float64))
+        self._init_spectrum_buffer(spectrum_chunk)
+
+    def _init_spectrum_buffer(self, spectrum_chunk):
+        self.spectrum_chunk = max(int(spectrum_chunk), 1)
+        self._spectrum_buffer = []
+        self._spectra_written = self._counter
+
+    def _spectrum_row(self, spectrum):
         """
-        :param image: a single image as numpy image, same shape as used to instantiate the class
+        :return: (energies, weights, mean wavelength) of a shot, padded to the stored number of channels,
+            or None if this file stores no spectra
         """
-        if self._counter >= self.image_dset.shape[0]:  # TODO update dset size feature, which is possible
+        if not self._spectrum_dsets:
+            if spectrum is not None:
+                raise ValueError("Instantiate with spectrum_channels to store spectra")
+            return None
+        if spectrum is None:
+            raise ValueError("This file stores a spectrum with every image")
+        energies, weights = [np.asarray(x, dtype=np.float64).ravel() for x in spectrum]
+        num_channels = self._spectrum_dsets[0].shape[1]
+        if len(energies) == 0 or len(energies) != len(weights):
+            raise ValueError("Spectrum needs the same (non zero) number of energies and weights, got %d and %d"
+                             % (len(energies), len(weights)))
+        if len(energies) > num_channels:
+            raise ValueError("Spectrum has %d channels, the file stores %d" % (len(energies), num_channels))
+        mean_wavelength = ENERGY_CONV / (np.sum(energies*weights) / np.sum(weights))
+        # shorter spectra are padded with zero-weight channels
+        pad = num_channels - len(energies)
+        energies = np.concatenate([energies, np.full(pad, energies[-1])])
+        weights = np.concatenate([weights, np.zeros(pad)])
+        return energies, weights, mean_wavelength
+
+    def _add_spectra(self, rows):
+        """buffer the spectrum rows of images that were written"""
+        if not self._spectrum_dsets:
+            return
+        self._spectrum_buffer.extend(rows)
+        if len(self._spectrum_buffer) >= self.spectrum_chunk:
+            self._flush_spectra()
+
+    def _flush_spectra(self):
+        if not self._spectrum_buffer:
+            return
+        start = self._spectra_written
+        stop = start + len(self._spectrum_buffer)
+        for dset, column in zip(self._spectrum_dsets, zip(*self._spectrum_buffer)):
+            dset[start: stop] = np.array(column)
+        self._spectra_written = stop
+        self._spectrum_buffer = []
+
+    def _set_encoding(self, encoding):
+        if isinstance(encoding, bytes):
+            encoding = encoding.decode()
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding %s, options are %s" % (encoding, sorted(ENCODINGS)))
+        self.encoding = encoding
+        self._trusted_range = _trusted_range_arrays(self.detector)
+
+    def _encode(self, images):
+        if self.encoding is None:
+            return images
+        return encode_image(images, self.encoding, self._trusted_range, self.gain_divisors)
+
+    def _reserve(self, num):
+        """make room for num more images"""
+        needed = self._counter + num
+        if needed <= self.image_dset.shape[0]:
+            return
+        if not self.resizable:
             raise IndexError("Maximum number of images is %d" % (self.image_dset.shape[0]))
-        self.image_dset[self._counter] = image
+        nblocks = int(np.ceil((needed - self.image_dset.shape[0]) / float(self.growth_block)))
+        new_size = self.image_dset.shape[0] + nblocks*self.growth_block
+        for dset in [self.image_dset] + self._spectrum_dsets:
+            dset.resize(new_size, axis=0)
+
+    def add_image(self, image, spectrum=None):
+        """
+        :param image: a single image as numpy image, same shape as used to instantiate the class
+        :param spectrum: (energies, weights) of the shot (energies in eV), required if instantiated with
+            spectrum_channels. E.g. a row of spectrum.sase_spectra
+        """
+        self._reserve(1)
+        row = self._spectrum_row(spectrum)
+        # spectra are only buffered once their image is written, so they cannot get out of step with the images
+        self.image_dset[self._counter] = self._encode(image)
         self._counter += 1
+        self._add_spectra([row])
+
+    def add_images(self, images, spectra=None):
+        """
+        write a batch of images in one call
+
+        :param images: numpy array of images (Nimages x image_shape)
+        :param spectra: energies and weights of the shots (each Nimages x Nchannels), see add_image
+        """
+        images = np.asarray(images)
+        num = images.shape[0]
+        self._reserve(num)
+        rows = [self._spectrum_row(None if spectra is None else (spectra[0][i], spectra[1][i])) for i in range(num)]
+        self.image_dset[self._counter: self._counter+num] = self._encode(images)
+        self._counter += num
+        self._add_spectra(rows)
+
+    @property
+    def num_images_written(self):
+        return self._counter
 
     def _write_geom(self):
         beam = self.beam
@@ -321,9 +841,19 @@ class H5AttributeGeomWriter:
         self.image_dset.attrs["dxtbx_beam_string"] = json.dumps(beam)
         self.image_dset.attrs["dxtbx_detector_string"] = json.dumps(det)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def _finalize(self):
+        if not self.file_handle:  # already closed
+            return
+        self._flush_spectra()
+        if self.resizable and self.image_dset.shape[0] > self._counter:
+            for dset in [self.image_dset] + self._spectrum_dsets:
+                dset.resize(self._counter, axis=0)
+        self.image_dset.attrs["num_images_written"] = self._counter
         self.file_handle.close()
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._finalize()
+
     def __enter__(self):
         return self
 
@@ -331,4 +861,142 @@ class H5AttributeGeomWriter:
         """
         close the file handle (if instantiated using `with`, then this is done automatically)
         """
+        self._finalize()
+
+
+class SparseShotWriter:
+
+    def __init__(self, filename, image_shape, detector, beam, threshold=None, background=None, dtype=np.float32,
+                 compression_args=None, detector_and_beam_are_dicts=False, block_size=2**20, shot_block=1024):
+        """
+        Peak-only alternative to H5AttributeGeomWriter: per shot, only the pixels above threshold (or inside a mask,
+        e.g. from roi.predicted_spot_mask) are stored as (panel, slow, fast, value) lists.
+        FormatHDF5AttributeGeometry reads the file like a dense one, filling the other pixels with the background
+
+        :param filename: output file path
+        :param image_shape: shape of a single image (Npanel x Nslow x Nfast)
+        :param detector: dxtbx detector model
+        :param beam: dxtbx beam model
+        :param threshold: keep pixels whose value is above this (None to only keep masked pixels)
+        :param background: optional numpy array (image_shape) stored once and used to fill the pixels that are
+            not kept (e.g. the expected background from sim_background, or a BackgroundCache entry). Default is 0
+        :param dtype: datatype of the stored values
+        :param compression_args: compression arguments for h5py, see H5AttributeGeomWriter
+        :param detector_and_beam_are_dicts: see H5AttributeGeomWriter
+        :param block_size: the pixel lists grow by this many entries at a time
+        :param shot_block: the start and count of each shot's pixels are buffered and written this many shots at a time
+        """
+        if compression_args is None:
+            compression_args = {}
+        image_shape = tuple(image_shape)
+        if max(image_shape) > np.iinfo(np.uint16).max:
+            raise ValueError("Image dimensions must fit in uint16, got %s" % (image_shape,))
+        self.image_shape = image_shape
+        self.threshold = threshold
+        self.block_size = int(block_size)
+        self.shot_block = max(int(shot_block), 1)
+        import h5py
+        self.file_handle = h5py.File(filename, "w")
+        self.group = self.file_handle.create_group("sparse_images")
+        self._pixel_dsets = {}
+        for name, dt in [("panel", np.uint16), ("slow", np.uint16), ("fast", np.uint16), ("value", dtype)]:
+            self._pixel_dsets[name] = self.group.create_dataset(
+                name, shape=(self.block_size,), maxshape=(None,), chunks=(min(self.block_size, 2**16),),
+                dtype=dt, **compression_args)
+        self._shot_dsets = {}
+        for name in ["shot_start", "shot_count"]:
+            self._shot_dsets[name] = self.group.create_dataset(name, shape=(0,), maxshape=(None,),
+                                                               chunks=(self.shot_block,), dtype=np.int64)
+        self._shot_buffer = []
+        self._shots_written = 0
+        if background is not None:
+            background = np.asarray(background)
+            if background.shape != image_shape:
+                raise ValueError("background shape %s does not match image shape %s" % (background.shape, image_shape))
+            self.group.create_dataset("background", data=background.astype(dtype), **compression_args)
+
+        if not detector_and_beam_are_dicts:
+            beam = beam.to_dict()
+            detector = detector.to_dict()
+        self.group.attrs["dxtbx_beam_string"] = json.dumps(beam)
+        self.group.attrs["dxtbx_detector_string"] = json.dumps(detector)
+        self.group.attrs["image_shape"] = image_shape
+        if threshold is not None:
+            self.group.attrs["threshold"] = threshold
+        self._num_pixels = 0
+        self._counter = 0
+
+    def add_image(self, image, mask=None):
+        """
+        :param image: a single image as numpy array, same shape as used to instantiate the class
+        :param mask: optional boolean array (image shape), pixels where it is True are kept whatever their value
+        """
+        image = np.asarray(image)
+        if image.shape != self.image_shape:
+            raise ValueError("image shape %s does not match %s" % (image.shape, self.image_shape))
+        if self.threshold is None and mask is None:
+            raise ValueError("Provide a mask, or instantiate with a threshold")
+        keep = np.zeros(image.shape, bool) if self.threshold is None else image > self.threshold
+        if mask is not None:
+            keep |= mask
+        panel, slow, fast = np.nonzero(keep)
+        count = len(panel)
+
+        needed = self._num_pixels + count
+        size = self._pixel_dsets["value"].shape[0]
+        if needed > size:
+            size += int(np.ceil((needed - size) / float(self.block_size))) * self.block_size
+            for dset in self._pixel_dsets.values():
+                dset.resize(size, axis=0)
+        sl = slice(self._num_pixels, needed)
+        self._pixel_dsets["panel"][sl] = panel
+        self._pixel_dsets["slow"][sl] = slow
+        self._pixel_dsets["fast"][sl] = fast
+        self._pixel_dsets["value"][sl] = image[keep]
+
+        self._shot_buffer.append((self._num_pixels, count))
+        self._num_pixels = needed
+        self._counter += 1
+        if len(self._shot_buffer) >= self.shot_block:
+            self._flush_shots()
+
+    def _flush_shots(self):
+        if not self._shot_buffer:
+            return
+        start = self._shots_written
+        stop = start + len(self._shot_buffer)
+        for dset, column in zip([self._shot_dsets["shot_start"], self._shot_dsets["shot_count"]],
+                                zip(*self._shot_buffer)):
+            dset.resize(stop, axis=0)
+            dset[start: stop] = column
+        self._shots_written = stop
+        self._shot_buffer = []
+
+    @property
+    def num_images_written(self):
+        return self._counter
+
+    @property
+    def num_pixels_written(self):
+        return self._num_pixels
+
+    def _finalize(self):
+        if not self.file_handle:  # already closed
+            return
+        self._flush_shots()
+        for dset in self._pixel_dsets.values():
+            dset.resize(self._num_pixels, axis=0)
+        self.group.attrs["num_images_written"] = self._counter
         self.file_handle.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._finalize()
+
+    def __enter__(self):
+        return self
+
+    def close_file(self):
+        """
+        close the file handle (if instantiated using `with`, then this is done automatically)
+        """
+        self._finalize()